@@ -0,0 +1,14 @@
+'''
+Statistics that the benchmarks report
+'''
+
+from typing import List
+
+
+def percentile(values: List[float], percent: float) -> float:
+    '''
+    Returns the nearest-rank percentile of values
+    '''
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
@@ -0,0 +1,124 @@
+'''
+Benchmark of the CPU and bandwidth cost of live monitoring.
+It runs simulated devices in a DeviceCoordinator and compares a client
+polling MonitoringEndpoint, as the monitoring web application does, with a
+client of MonitoringStream. The client runs in another process, so the
+reported CPU time is the cost on the acquisition side: the coordinator,
+the device queues and the server threads.
+
+Usage: python benchmarks/monitoring_stream.py -d 30 -p 0.5
+'''
+
+import os
+import sys
+import time
+import socket
+import tempfile
+import argparse
+import multiprocessing
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from octopus_sensing.device_coordinator import DeviceCoordinator
+from octopus_sensing.devices.testdevice_streaming import TestDeviceStreaming
+try:
+    from octopus_sensing.monitoring_endpoint import MonitoringEndpoint
+except ImportError:
+    # It is renamed in newer octopus_sensing versions
+    from octopus_sensing.realtime_data_endpoint import RealtimeDataEndpoint as MonitoringEndpoint
+
+from monitoring_stream import MonitoringStream
+
+ENDPOINT_PORT = 9340
+STREAM_PORT = 9341
+# (name, sampling rate) of simulated devices
+DEVICES = [("eeg", 125), ("shimmer", 128)]
+
+
+def poll_endpoint(port, duration, interval, encoding, result_queue):
+    received = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        request = urllib.request.Request("http://localhost:{0}/?duration=3".format(port),
+                                         headers={"Accept": "application/" + encoding})
+        with urllib.request.urlopen(request) as response:
+            received += len(response.read())
+        time.sleep(max(0, interval - (time.monotonic() - start)))
+    result_queue.put(received)
+
+
+def read_stream(port, duration, result_queue):
+    client = socket.create_connection(("localhost", port))
+    client.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+                   b"Connection: Upgrade\r\nSec-WebSocket-Version: 13\r\n"
+                   b"Sec-WebSocket-Key: YmVuY2htYXJrLWNsaWVudA==\r\n\r\n")
+    response = b""
+    while b"\r\n\r\n" not in response:
+        response += client.recv(4096)
+    # Bytes after the handshake are WebSocket frames, like the rest of the stream
+    received = len(response.split(b"\r\n\r\n", 1)[1])
+    client.settimeout(0.5)
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        try:
+            received += len(client.recv(65536))
+        except socket.timeout:
+            pass
+    client.close()
+    result_queue.put(received)
+
+
+def measure(mode, duration, interval, encoding):
+    '''
+    Returns the server CPU time in seconds and the received bytes
+    '''
+    # Recordings of the test devices are removed after the measurement
+    with tempfile.TemporaryDirectory(prefix="monitoring-stream-") as output_path:
+        device_coordinator = DeviceCoordinator()
+        device_coordinator.add_devices(
+            [TestDeviceStreaming(rate, name=name, output_path=output_path)
+             for name, rate in DEVICES])
+        if mode == "stream":
+            server = MonitoringStream(device_coordinator, port=STREAM_PORT, interval=interval)
+            client_args = (STREAM_PORT, duration)
+            client = read_stream
+        else:
+            server = MonitoringEndpoint(device_coordinator, port=ENDPOINT_PORT)
+            client_args = (ENDPOINT_PORT, duration, interval, encoding)
+            client = poll_endpoint
+        server.start()
+        # Waiting for devices to fill their buffers
+        time.sleep(3)
+
+        result_queue = multiprocessing.Queue()
+        client_process = multiprocessing.Process(target=client, args=client_args + (result_queue,))
+        cpu_start = time.process_time()
+        client_process.start()
+        received = result_queue.get()
+        cpu_time = time.process_time() - cpu_start
+        client_process.join()
+
+        server.stop()
+        device_coordinator.terminate()
+    return cpu_time, received
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--duration", help="Seconds of monitoring", type=float, default=30)
+    parser.add_argument("-p", "--interval", help="Seconds between updates", type=float,
+                        default=0.5)
+    parser.add_argument("-e", "--encoding", help="The encoding of endpoint responses",
+                        choices=["json", "msgpack", "pickle"], default="json")
+    args = parser.parse_args()
+
+    for mode in ["endpoint", "stream"]:
+        cpu_time, received = measure(mode, args.duration, args.interval, args.encoding)
+        print("{0:<8} CPU: {1:6.2f}% of a core  bandwidth: {2:9.1f} kB/s".format(
+            mode, 100 * cpu_time / args.duration, received / args.duration / 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+'''
+Benchmark of image swap latency for the image window backends.
+For each backend it alternates the session images on a window and reports
+p50/p99 of the time from set_image until the frame is presented, and the
+CPU time that the GTK thread spends in set_image.
+
+It runs without monitors under Xvfb with Mesa's software OpenGL:
+
+    LIBGL_ALWAYS_SOFTWARE=1 xvfb-run -s "-screen 0 1920x1080x24" \
+        python benchmarks/presenter_swap.py -n 200
+
+Usage: python benchmarks/presenter_swap.py -n 200 -b pixbuf gl
+'''
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk, GLib
+
+from image_cache import PixbufCache
+from windows import make_image_window
+
+from benchmark_stats import percentile
+
+IMAGES = ["images/gray_image.jpg",
+          "images/fixation_cross.jpg",
+          "images/done_image.jpg",
+          "images/start.jpg"]
+
+
+def measure(backend, count, monitor_no):
+    '''
+    Returns the swap latencies and the set_image CPU times in milliseconds
+    '''
+    window = make_image_window("benchmark", monitor_no=monitor_no,
+                               image_cache=PixbufCache(), backend=backend)
+    window.preload(IMAGES)
+    latencies = []
+    cpu_times = []
+
+    def swap():
+        image_path = IMAGES[len(latencies) % len(IMAGES)]
+        start = time.monotonic()
+        cpu_start = time.process_time()
+        window.set_image(image_path)
+        cpu_times.append((time.process_time() - cpu_start) * 1000)
+        window.call_on_present(lambda presentation_time: on_present(start, presentation_time))
+        return False
+
+    def on_present(start, presentation_time):
+        latencies.append((presentation_time - start) * 1000)
+        if len(latencies) < count:
+            # The next swap is in the next main loop iteration, not in the paint cycle
+            GLib.idle_add(swap)
+        else:
+            Gtk.main_quit()
+
+    window.connect("map-event", lambda *args: GLib.timeout_add(500, swap))
+    window.show_window()
+    Gtk.main()
+    window.destroy()
+    return latencies, cpu_times
+
+
+def report(name, latencies, cpu_times):
+    print("{0:<7} swap p50: {1:.3f} ms  p99: {2:.3f} ms  max: {3:.3f} ms  "
+          "set_image CPU mean: {4:.3f} ms".format(
+              name, percentile(latencies, 50), percentile(latencies, 99),
+              max(latencies), statistics.mean(cpu_times)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", help="The number of swaps", type=int, default=200)
+    parser.add_argument("-m", "--monitor", help="The monitor ID", type=int, default=0)
+    parser.add_argument("-b", "--backends", nargs="+", choices=["pixbuf", "gl"],
+                        default=["pixbuf", "gl"])
+    args = parser.parse_args()
+    # Image paths are relative to the repository
+    os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+    for backend in args.backends:
+        report(backend, *measure(backend, args.count, args.monitor))
+
+
+if __name__ == "__main__":
+    main()
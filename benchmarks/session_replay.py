@@ -0,0 +1,320 @@
+'''
+Headless replay of the f2f.py and remote.py trial flow, for measuring timing
+without monitors, devices or a participant.
+
+Each simulated session runs the real BackgroudWindow with a device
+coordinator that only records dispatched triggers. Message windows are
+acknowledged and conversation timers are closed automatically. Timelines
+can be compressed with --speed to run hundreds of sessions.
+
+For remote.py, triggers go through a TriggerSender to a UDPTriggerEndpoint
+on this machine, so their delivery latency is included.
+
+It needs two monitors, which Xvfb provides with Xinerama:
+
+    xvfb-run -a -s "+xinerama -screen 0 1920x1080x24 -screen 1 1920x1080x24" \
+        python benchmarks/session_replay.py -n 200 --speed 10 -o replay.json
+
+The report has the count, mean, standard deviation (jitter) and percentiles
+in milliseconds of:
+
+- onset error of each scheduled phase (actual - planned)
+- presentation latency of the fixation cross and the stimulus
+- trigger latency, from the presentation of the fixation cross to the
+  START trigger reaching the device coordinator
+- startup steps of a session
+
+Reports are saved as JSON with -o and compared with a previous report with -c.
+
+Usage: python benchmarks/session_replay.py -s f2f -n 200 --speed 10 -c replay.json
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import datetime
+import importlib
+import statistics
+import subprocess
+import tempfile
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+REPOSITORY_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import GLib
+
+from epoch_index import read_epoch_index
+from readiness import StartupReport
+from prepare_stimuli import load_manifest, read_cohort_order
+
+from benchmark_stats import percentile
+
+# Sessions that do not end in this many seconds, after speeding up, are stopped
+SESSION_TIMEOUT_MARGIN = 60
+
+
+class ReplayDeviceCoordinator():
+    '''
+    Stands in for DeviceCoordinator. Dispatched messages are recorded with
+    their arrival time instead of being sent to devices.
+    '''
+    def __init__(self):
+        # (monotonic time, message)
+        self.messages: List[Any] = []
+
+    def dispatch(self, message) -> None:
+        self.messages.append((time.monotonic(), message))
+
+    def get_devices(self) -> List[Any]:
+        return []
+
+    def get_realtime_data(self, duration: int, device_list=None) -> Dict[str, Any]:
+        return {}
+
+    def terminate(self) -> None:
+        pass
+
+
+def replay_windows(module, ack_delay: float, conversation: float):
+    '''
+    Replaces the windows that a participant closes in a session module with
+    ones that close themselves
+    '''
+    class AcknowledgedMessageWindow(module.MessageButtonWindow):
+        def show(self):
+            GLib.timeout_add(int(ack_delay * 1000), self._on_click_ok_button, None)
+            super().show()
+
+    class ClosedTimerWindow(module.TimerWindow):
+        def show_window(self):
+            GLib.timeout_add(int(conversation * 1000), self._on_click_timer_button, None)
+            super().show_window()
+
+    module.MessageButtonWindow = AcknowledgedMessageWindow
+    module.TimerWindow = ClosedTimerWindow
+
+
+def replay_stimuli_order(module, script: str) -> None:
+    '''
+    Replaces the stimuli order of a session module with one that is not
+    written to stimuli/. Subjects of the cohort orders keep their order;
+    otherwise two stimuli of each category are used, as in a real order.
+    '''
+    def read_stimuli_order(subject_id):
+        order = read_cohort_order(subject_id, script)
+        if order is not None:
+            return order
+        categories: Dict[str, List[str]] = {}
+        for stimulus in load_manifest().values():
+            if stimulus["selected"]:
+                categories.setdefault(stimulus["category"], []).append(
+                    os.path.basename(stimulus["path"]))
+        skip = 0 if script == "f2f" else 2
+        return [file_name for category in sorted(categories)
+                for file_name in sorted(categories[category])[skip:skip + 2]]
+
+    module.read_stimuli_order = read_stimuli_order
+
+
+def speed_up(module, speed: float) -> float:
+    '''
+    Compresses the timelines of a session module
+
+    Returns
+    -------
+    duration: float
+        The scheduled time of a trial in seconds
+    '''
+    module.SESSION_TIMELINE = [(phase, onset / speed) for phase, onset in module.SESSION_TIMELINE]
+    module.TRIAL_TIMELINE = [(phase, onset / speed) for phase, onset in module.TRIAL_TIMELINE]
+    return max(onset for _, onset in module.TRIAL_TIMELINE)
+
+
+def run_session(module, script: str, session_no: int, args, output_path: str) -> Dict[str, Any]:
+    '''
+    Runs one session and returns its measurements in milliseconds
+    '''
+    device_coordinator = ReplayDeviceCoordinator()
+    startup_report = StartupReport()
+    session_path = os.path.join(output_path, "session{0}".format(session_no))
+    epoch_index_path = os.path.join(session_path, "epochs.csv")
+    # Logs are written to the temporary output, not to logs/ of the repository
+    log_paths = {"log_path": os.path.join(output_path, "session.log"),
+                 "events_path": os.path.join(session_path, "events.jsonl")}
+    experiment_id = "{0}-{1}".format(str(args.subject_id).zfill(2), str(session_no).zfill(2))
+    trigger_endpoint = None
+    if script == "remote":
+        from trigger_endpoint import UDPTriggerEndpoint
+        trigger_endpoint = UDPTriggerEndpoint(device_coordinator, port=0)
+        trigger_endpoint.start()
+        window = module.BackgroudWindow(experiment_id, args.subject_id,
+                                        "127.0.0.1:{0}".format(trigger_endpoint.get_port()),
+                                        transport="udp", epoch_index_path=epoch_index_path,
+                                        image_backend=args.backend,
+                                        startup_report=startup_report, **log_paths)
+    else:
+        window = module.BackgroudWindow(experiment_id, args.subject_id, device_coordinator,
+                                        epoch_index_path=epoch_index_path,
+                                        image_backend=args.backend,
+                                        startup_report=startup_report, **log_paths)
+
+    stalled = []
+
+    def stop_stalled_session():
+        stalled.append(True)
+        window.destroy()
+        return False
+
+    timeout = GLib.timeout_add_seconds(int(args.session_timeout), stop_stalled_session)
+    window.show()
+    if not stalled:
+        GLib.source_remove(timeout)
+    if trigger_endpoint is not None:
+        # Waiting for the last triggers to arrive
+        time.sleep(0.5)
+        trigger_endpoint.stop()
+
+    measurements: Dict[str, List[float]] = {}
+
+    def add(metric, value_ms):
+        measurements.setdefault(metric, []).append(value_ms)
+
+    for scheduler in (window._session_scheduler, window._trial_scheduler):
+        for record in scheduler.records:
+            if record["planned"] is not None:
+                add("onset_error." + record["phase"],
+                    (record["actual"] - record["planned"]) * 1000)
+    for trial in read_epoch_index(epoch_index_path):
+        if trial["fixation_presented"] is not None:
+            add("presentation.fixation_cross",
+                (trial["fixation_presented"] - trial["fixation_onset"]) * 1000)
+        if trial["stimulus_presented"] is not None:
+            add("presentation.stimulus",
+                (trial["stimulus_presented"] - trial["stimulus_onset"]) * 1000)
+    for arrival_time, message in device_coordinator.messages:
+        payload = message.payload if isinstance(message.payload, dict) else {}
+        if message.type == "START" and payload.get("presentation_time") is not None:
+            add("trigger_latency.START", (arrival_time - payload["presentation_time"]) * 1000)
+    for step, duration in startup_report.steps:
+        add("startup." + step.replace(" ", "_"), duration * 1000)
+    return {"stalled": bool(stalled), "measurements": measurements,
+            "triggers": len(device_coordinator.messages)}
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {"count": len(values),
+            "mean": statistics.mean(values),
+            "std": statistics.pstdev(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": max(values)}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=REPOSITORY_PATH, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def print_report(report: Dict[str, Any], baseline: Dict[str, Any] = None) -> None:
+    print("{0} sessions of {1} at {2}x speed, {3} stalled, revision {4}".format(
+        report["sessions"], report["script"], report["speed"], report["stalled"],
+        report["revision"]))
+    header = "{0:<32} {1:>6} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9}".format(
+        "metric (ms)", "count", "mean", "std", "p50", "p99", "max")
+    if baseline is not None:
+        header += " {0:>10} {1:>10}".format("d p50", "d p99")
+    print(header)
+    for metric, summary in sorted(report["metrics"].items()):
+        line = "{0:<32} {1:>6} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>9.3f} {6:>9.3f}".format(
+            metric, summary["count"], summary["mean"], summary["std"],
+            summary["p50"], summary["p99"], summary["max"])
+        if baseline is not None and metric in baseline["metrics"]:
+            previous = baseline["metrics"][metric]
+            line += " {0:>+10.3f} {1:>+10.3f}".format(summary["p50"] - previous["p50"],
+                                                      summary["p99"] - previous["p99"])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--script", help="The session script", choices=["f2f", "remote"],
+                        default="f2f")
+    parser.add_argument("-n", "--sessions", help="The number of sessions", type=int, default=100)
+    parser.add_argument("--speed", help="How many times faster than the real timeline",
+                        type=float, default=10)
+    parser.add_argument("--ack-delay", help="Seconds until a message window is acknowledged",
+                        type=float, default=0.2)
+    parser.add_argument("--conversation", help="Seconds until the conversation timer is closed",
+                        type=float, default=0.5)
+    parser.add_argument("-b", "--backend", help="The image rendering backend",
+                        choices=["pixbuf", "gl"], default="pixbuf")
+    parser.add_argument("--subject_id", help="The subject ID of the stimuli order", default=1)
+    parser.add_argument("--session-timeout", help="Seconds until a session is counted as stalled",
+                        type=float, default=None)
+    parser.add_argument("-o", "--output", help="Saves the report as JSON")
+    parser.add_argument("-c", "--compare", help="A previous JSON report to compare with")
+    args = parser.parse_args()
+
+    # Images and stimuli are relative to the repository
+    os.chdir(REPOSITORY_PATH)
+    module = importlib.import_module(args.script)
+    # remote.py logs everything to the console
+    logging.getLogger().setLevel(logging.WARNING)
+    trial_duration = speed_up(module, args.speed)
+    replay_windows(module, args.ack_delay, args.conversation)
+    replay_stimuli_order(module, args.script)
+    if args.session_timeout is None:
+        # Eight trials with two messages, and the 3 s done image
+        args.session_timeout = \
+            8 * (trial_duration + args.conversation + 2 * args.ack_delay) + \
+            3 + SESSION_TIMEOUT_MARGIN
+
+    output_path = tempfile.mkdtemp(prefix="session-replay-")
+    measurements: Dict[str, List[float]] = {}
+    sessions = 0
+    stalled = 0
+    try:
+        for session_no in range(args.sessions):
+            result = run_session(module, args.script, session_no, args, output_path)
+            sessions += 1
+            for metric, values in result["measurements"].items():
+                measurements.setdefault(metric, []).extend(values)
+            if result["stalled"]:
+                stalled += 1
+                print("Session {0} stalled. Stopping the replay".format(session_no))
+                break
+            print("Session {0}: {1} triggers".format(session_no, result["triggers"]))
+    finally:
+        shutil.rmtree(output_path, ignore_errors=True)
+
+    report = {"script": args.script,
+              "sessions": sessions,
+              "stalled": stalled,
+              "speed": args.speed,
+              "backend": args.backend,
+              "revision": git_revision(),
+              "date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "metrics": {metric: summarize(values) for metric, values in measurements.items()}}
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, "r") as report_file:
+            baseline = json.load(report_file)
+    print_report(report, baseline)
+    if args.output is not None:
+        with open(args.output, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+'''
+Micro-benchmark of trigger message encode + decode cost.
+It compares pickle and msgpack (what DeviceMessageHTTPEndpoint accepts)
+with the fixed-width format of trigger_codec.
+
+Usage: python benchmarks/trigger_codec.py -n 100000
+'''
+
+import os
+import sys
+import pickle
+import timeit
+import argparse
+
+import msgpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import trigger_codec
+
+MESSAGE = {'type': 'START',
+           'seq': 42,
+           'experiment_id': '01-01',
+           'stimulus_id': '33',
+           'payload': {'timestamp': 1234.567891, 'presentation_time': 1234.551234}}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", help="The number of iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    codecs = {"pickle": (pickle.dumps, pickle.loads),
+              "msgpack": (msgpack.packb, msgpack.unpackb),
+              "struct": (trigger_codec.encode, trigger_codec.decode)}
+
+    for name, (encode, decode) in codecs.items():
+        data = encode(MESSAGE)
+        assert decode(data)['stimulus_id'] == MESSAGE['stimulus_id']
+        encode_time = min(timeit.repeat(lambda: encode(MESSAGE), number=args.count, repeat=3))
+        decode_time = min(timeit.repeat(lambda: decode(data), number=args.count, repeat=3))
+        print("{0:<8} {1:>4} bytes  encode: {2:.3f} us  decode: {3:.3f} us  total: {4:.3f} us".format(
+            name, len(data),
+            encode_time / args.count * 1e6, decode_time / args.count * 1e6,
+            (encode_time + decode_time) / args.count * 1e6))
+
+
+if __name__ == "__main__":
+    main()
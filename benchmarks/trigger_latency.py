@@ -0,0 +1,87 @@
+'''
+Loopback benchmark of trigger delivery latency.
+It sends START/STOP triggers to a local HTTPTriggerEndpoint and a local
+UDPTriggerEndpoint and reports p50/p99 of the time until each trigger is acknowledged.
+
+Usage: python benchmarks/trigger_latency.py -n 2000
+'''
+
+import os
+import sys
+import time
+import socket
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from octopus_sensing.device_coordinator import DeviceCoordinator
+
+from trigger_endpoint import HTTPTriggerEndpoint, UDPTriggerEndpoint
+from trigger_sender import HTTPTriggerTransport, UDPTriggerTransport
+
+from benchmark_stats import percentile
+
+
+def wait_for_port(host, port, timeout=5):
+    '''
+    Waits until a TCP server accepts connections
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def measure(transport, count):
+    latencies = []
+    for i in range(count):
+        message = {'type': 'START' if i % 2 == 0 else 'STOP',
+                   'experiment_id': '00-01',
+                   'stimulus_id': '11',
+                   'payload': {'timestamp': time.monotonic()}}
+        start = time.perf_counter()
+        transport.send(message)
+        latencies.append((time.perf_counter() - start) * 1000)
+    transport.close()
+    return latencies
+
+
+def report(name, latencies):
+    print("{0:<6} p50: {1:.3f} ms  p99: {2:.3f} ms  mean: {3:.3f} ms  max: {4:.3f} ms".format(
+        name, percentile(latencies, 50), percentile(latencies, 99),
+        statistics.mean(latencies), max(latencies)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", help="The number of triggers", type=int, default=1000)
+    parser.add_argument("-p", "--port", help="The endpoints' port", type=int, default=9331)
+    args = parser.parse_args()
+
+    device_coordinator = DeviceCoordinator()
+    host = "127.0.0.1:{0}".format(args.port)
+
+    http_endpoint = HTTPTriggerEndpoint(device_coordinator, port=args.port)
+    http_endpoint.start()
+    udp_endpoint = UDPTriggerEndpoint(device_coordinator, port=args.port)
+    udp_endpoint.start()
+    try:
+        wait_for_port("127.0.0.1", args.port)
+        # Warming up connections
+        measure(HTTPTriggerTransport(host), 10)
+        measure(UDPTriggerTransport(host), 10)
+        report("http", measure(HTTPTriggerTransport(host), args.count))
+        report("udp", measure(UDPTriggerTransport(host), args.count))
+    finally:
+        udp_endpoint.stop()
+        http_endpoint.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+'''
+Webcam recording with capture and encoding in separate processes.
+
+A grabber process reads frames from the camera and writes them to a ring
+buffer in shared memory, and an encoder process compresses them to video
+files. A stalled encoder or disk only fills the ring; frames are dropped
+(and counted) only when the ring is full, and the grabber never waits.
+
+Each video {name}-{experiment_id}-{stimulus_id}.avi has a
+{name}-{experiment_id}-{stimulus_id}-timestamps.csv with the sequence number,
+the driver's timestamp of the buffer (V4L2) and the Unix time of every frame.
+'''
+
+import csv
+import time
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import cv2
+
+from octopus_sensing.devices import CameraStreaming
+from octopus_sensing.common.message_creators import MessageType
+
+# Indexes of the shared counters
+CAPTURED = 0
+WRITTEN = 1
+ENCODED = 2
+DROPPED = 3
+MAX_DEPTH = 4
+COUNTER_NAMES = ["captured", "written", "encoded", "dropped", "max_queue_depth"]
+
+# (sequence, hardware time in ms, Unix time) of each slot
+_METADATA_SIZE = 3
+# The time in seconds that the encoder waits when the ring is empty
+_POLL_INTERVAL = 0.002
+
+
+class FrameRing():
+    '''
+    A single-producer single-consumer ring of frames in shared memory.
+    Counters are in a shared array, so they can be read from the process
+    that made the device even after the ring is closed.
+
+    Parameters
+    ----------
+    slots: int
+        The number of frames that the ring can hold
+
+    frame_shape: Tuple[int, int, int]
+        (height, width, channels) of frames
+
+    counters: multiprocessing.Array
+        An array of int64 with len(COUNTER_NAMES) items
+    '''
+    def __init__(self, slots: int, frame_shape: Tuple[int, int, int], counters: Any,
+                 name: Optional[str] = None):
+        self._slots = slots
+        self._frame_shape = frame_shape
+        self._counters = counters
+        frame_size = int(np.prod(frame_shape))
+        size = slots * (frame_size + _METADATA_SIZE * 8)
+        if name is None:
+            self._memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+        self._metadata = np.ndarray((slots, _METADATA_SIZE), dtype=np.float64,
+                                    buffer=self._memory.buf)
+        self._frames = np.ndarray((slots,) + tuple(frame_shape), dtype=np.uint8,
+                                  buffer=self._memory.buf, offset=slots * _METADATA_SIZE * 8)
+
+    def __getstate__(self):
+        # Child processes attach to the same shared memory by its name
+        return (self._slots, self._frame_shape, self._counters, self._memory.name)
+
+    def __setstate__(self, state):
+        self.__init__(*state[:3], name=state[3])
+
+    def written(self) -> int:
+        return self._counters[WRITTEN]
+
+    def encoded(self) -> int:
+        return self._counters[ENCODED]
+
+    def count_captured(self) -> None:
+        self._counters[CAPTURED] += 1
+
+    def put(self, frame: np.ndarray, sequence: int, hardware_time: float,
+            unix_time: float) -> bool:
+        '''
+        Copies a frame to the ring. It is called only by the producer.
+
+        Returns
+        -------
+        written: bool
+            False if the ring was full and the frame is dropped
+        '''
+        written = self._counters[WRITTEN]
+        depth = written - self._counters[ENCODED]
+        if depth >= self._slots:
+            self._counters[DROPPED] += 1
+            return False
+        slot = written % self._slots
+        if frame.shape != self._frames.shape[1:]:
+            frame = cv2.resize(frame, (self._frame_shape[1], self._frame_shape[0]))
+        self._frames[slot] = frame
+        self._metadata[slot] = (sequence, hardware_time, unix_time)
+        # The frame is visible to the consumer only after it is complete
+        self._counters[WRITTEN] = written + 1
+        if depth + 1 > self._counters[MAX_DEPTH]:
+            self._counters[MAX_DEPTH] = depth + 1
+        return True
+
+    def peek(self) -> Optional[Tuple[int, np.ndarray, np.ndarray]]:
+        '''
+        Returns (index, frame, metadata) of the oldest frame that is not
+        consumed, or None if the ring is empty. The frame is a view that is
+        valid until `advance` is called. It is called only by the consumer.
+        '''
+        index = self._counters[ENCODED]
+        if index >= self._counters[WRITTEN]:
+            return None
+        slot = index % self._slots
+        return index, self._frames[slot], self._metadata[slot]
+
+    def advance(self) -> None:
+        self._counters[ENCODED] += 1
+
+    def latest(self) -> Optional[np.ndarray]:
+        '''
+        Returns a copy of the last written frame, for monitoring
+        '''
+        written = self._counters[WRITTEN]
+        if written == 0:
+            return None
+        return self._frames[(written - 1) % self._slots].copy()
+
+    def close(self) -> None:
+        # Views must be released before the memory can be closed
+        self._metadata = None
+        self._frames = None
+        self._memory.close()
+
+    def unlink(self) -> None:
+        self._memory.unlink()
+
+
+def _grab_frames(camera_number: Any, video_size: Tuple[int, int], ring: FrameRing,
+                 recording: Any, stop: Any, frame_rate: Any) -> None:
+    '''
+    The grabber process. Frames are decoded and written to the ring only while recording.
+    '''
+    video_capture = cv2.VideoCapture(camera_number)
+    try:
+        video_capture.set(cv2.CAP_PROP_FRAME_WIDTH, video_size[0])
+        video_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, video_size[1])
+    except Exception as error:
+        print("Could not set the camera resolution. Continuing.", error)
+    frame_rate.value = video_capture.get(cv2.CAP_PROP_FPS) or 30
+    sequence = 0
+    while not stop.is_set():
+        if not video_capture.grab():
+            time.sleep(_POLL_INTERVAL)
+            continue
+        unix_time = time.time()
+        # The driver's timestamp of the buffer, in milliseconds
+        hardware_time = video_capture.get(cv2.CAP_PROP_POS_MSEC)
+        sequence += 1
+        ring.count_captured()
+        if not recording.is_set():
+            continue
+        ret, frame = video_capture.retrieve()
+        if ret:
+            ring.put(frame, sequence, hardware_time, unix_time)
+    video_capture.release()
+    ring.close()
+
+
+def _encode_frames(ring: FrameRing, commands: Any, video_size: Tuple[int, int]) -> None:
+    '''
+    The encoder process. Commands are ("start", file_name, first index, frame rate),
+    ("stop", index after the last frame) and ("terminate",). Frames outside of
+    a start and a stop are skipped.
+    '''
+    codec = cv2.VideoWriter_fourcc(*'XVID')  # type: ignore[attr-defined]
+    segments = []
+    writer = None
+    timestamps_file = None
+    timestamps_writer = None
+    frame_count = 0
+    terminating = False
+
+    while True:
+        while not commands.empty():
+            command = commands.get()
+            if command[0] == "start":
+                segments.append({"file_name": command[1], "start": command[2],
+                                 "stop": None, "frame_rate": command[3]})
+            elif command[0] == "stop" and segments and segments[-1]["stop"] is None:
+                segments[-1]["stop"] = command[1]
+            elif command[0] == "terminate":
+                terminating = True
+
+        # Closing the current video when all of its frames are encoded
+        if segments and segments[0]["stop"] is not None and \
+                ring.encoded() >= segments[0]["stop"]:
+            if writer is not None:
+                writer.release()
+                timestamps_file.close()
+                print("Saving to file {0} is done ({1} frames)".format(
+                    segments[0]["file_name"], frame_count))
+                writer = None
+            segments.pop(0)
+            continue
+
+        item = ring.peek()
+        if item is None:
+            if terminating and not segments:
+                break
+            time.sleep(_POLL_INTERVAL)
+            continue
+        index, frame, metadata = item
+        if not segments or index < segments[0]["start"]:
+            ring.advance()
+            continue
+        if writer is None:
+            segment = segments[0]
+            writer = cv2.VideoWriter(segment["file_name"], codec, segment["frame_rate"],
+                                     video_size)
+            timestamps_file = open(segment["file_name"][:-4] + "-timestamps.csv", "w",
+                                   newline="")
+            timestamps_writer = csv.writer(timestamps_file)
+            timestamps_writer.writerow(["frame", "sequence", "hardware_time_ms", "unix_time"])
+            frame_count = 0
+        writer.write(frame)
+        timestamps_writer.writerow([frame_count, int(metadata[0]), metadata[1], metadata[2]])
+        frame_count += 1
+        ring.advance()
+    ring.close()
+
+
+class SharedMemoryCameraStreaming(CameraStreaming):
+    '''
+    Records video like CameraStreaming, with capture and encoding in two
+    child processes that share frames through a FrameRing. The device's own
+    process only handles messages and realtime data.
+
+    Frames are resized to image_width x image_height if the camera does not
+    support that resolution.
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    ring_seconds: float, default: 4
+        The time of video that the ring holds at 30 fps, before frames are dropped
+
+    Other parameters are the same as CameraStreaming
+
+    Example
+    -------
+    >>> camera = SharedMemoryCameraStreaming(name="webcam",
+    ...                                      output_path="./output",
+    ...                                      camera_path=main_camera,
+    ...                                      image_width=640,
+    ...                                      image_height=480)
+    >>> device_coordinator.add_device(camera)
+    >>> camera.get_counters()
+    '''
+    def __init__(self, *args, ring_seconds: float = 4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ring_slots = max(2, int(ring_seconds * 30))
+        # Shared with this process, so counters can be logged by the experiment
+        self._counters = multiprocessing.Array("q", len(COUNTER_NAMES), lock=False)
+        self._ring: Optional[FrameRing] = None
+        self._frame_rate = multiprocessing.Value("d", 0, lock=False)
+
+    def get_counters(self) -> Dict[str, int]:
+        '''
+        Returns the number of captured, written, encoded and dropped frames
+        and the maximum number of frames that waited for the encoder
+        '''
+        return dict(zip(COUNTER_NAMES, self._counters[:]))
+
+    def _run(self):
+        self._ring = FrameRing(self._ring_slots,
+                               (self._image_height, self._image_width, 3),
+                               self._counters)
+        recording = multiprocessing.Event()
+        stop = multiprocessing.Event()
+        commands = multiprocessing.Queue()
+        grabber = multiprocessing.Process(
+            target=_grab_frames, name=self.name + "-grabber",
+            args=(self._camera_number, self._video_size, self._ring, recording, stop,
+                  self._frame_rate))
+        encoder = multiprocessing.Process(
+            target=_encode_frames, name=self.name + "-encoder",
+            args=(self._ring, commands, self._video_size))
+        grabber.start()
+        encoder.start()
+        print(f"[{self.name}] Initialized video device: video size: {self._video_size}")
+
+        while True:
+            message = self.message_queue.get()
+            if message is None:
+                continue
+            if message.type == MessageType.START:
+                if self._state == "START":
+                    print("Video streaming has already started")
+                else:
+                    file_name = "{0}/{1}-{2}-{3}.avi".format(self.output_path,
+                                                            self.name,
+                                                            message.experiment_id,
+                                                            str(message.stimulus_id).zfill(2))
+                    commands.put(("start", file_name, self._ring.written(),
+                                  self._frame_rate.value or self._fps))
+                    recording.set()
+                    self._state = "START"
+
+            elif message.type == MessageType.STOP:
+                if self._state == "STOP":
+                    print(f"[{self.name}] Video streaming has already stopped")
+                else:
+                    recording.clear()
+                    commands.put(("stop", self._ring.written()))
+                    logging.debug("[{0}] Frames: {1}".format(self.name, self.get_counters()))
+                    self._state = "STOP"
+
+            elif message.type == MessageType.TERMINATE:
+                if self._state == "START":
+                    recording.clear()
+                    commands.put(("stop", self._ring.written()))
+                commands.put(("terminate",))
+                stop.set()
+                break
+
+        grabber.join()
+        encoder.join()
+        self._ring.close()
+        self._ring.unlink()
+        logging.info("[{0}] video terminated. Frames: {1}".format(self.name, self.get_counters()))
+
+    def _get_realtime_data(self, duration: int) -> Dict[str, Any]:
+        '''
+        Returns the last recorded frame, with the same format as CameraStreaming
+        '''
+        frame = self._ring.latest() if self._ring is not None else None
+        return {"data": [] if frame is None else [frame],
+                "metadata": {"frame_rate": self._frame_rate.value or self._fps,
+                             "type": self.__class__.__name__}}
@@ -1,5 +1,311 @@
+'''
+Lists audio capture devices and profiles their latency and stability.
+
+Each capture device is opened at every candidate buffer size and sample
+rate, and the profiler measures:
+
+- callback jitter: the standard deviation and maximum of the time between
+  callbacks, compared with the buffer period
+- overruns: late callbacks (more than twice the buffer period) and frames
+  that were not delivered, compared with the elapsed time
+- round-trip latency, with --loopback: clicks are played on a playback
+  device and detected in the capture. It needs the output connected to the
+  input with a cable, or a speaker next to the microphone.
+
+A configuration is stable when it has no late callbacks and loses less
+than one buffer of frames. AudioStreaming always captures at 44100 Hz with
+1000 ms buffers, so that configuration is always profiled and devices are
+ranked only by it: a device must be stable there, and stable devices are
+compared by measured round trip when all of them have one, otherwise by
+jitter. Other configurations are only reported. With -o the recommended
+device is saved for f2f.py and endpoint.py, which find the device by its
+name because indexes change when devices are plugged in.
+
+Usage:
+    python check_audio.py -l
+    python check_audio.py -d 5 -b 10,20,50,100 -r 44100,48000 --loopback -o audio_profile.json
+'''
+
+import json
+import time
+import array
+import argparse
+import statistics
+from typing import Any, Dict, List, Optional
+
 import miniaudio
-devices = miniaudio.Devices()
-captures = devices.get_captures()
-for d in enumerate(captures):
-    print("{num} = {name}".format(num=d[0], name=d[1]['name']))
\ No newline at end of file
+
+# The profile that the recording scripts read
+AUDIO_PROFILE = "audio_profile.json"
+# AudioStreaming records 16 bit stereo at 44100 Hz with 1000 ms buffers
+CHANNELS = 2
+SAMPLE_SIZE = 2
+STREAMING_SAMPLE_RATE = 44100
+STREAMING_BUFFERSIZE_MSEC = 1000
+# A callback later than this many buffer periods is counted as an overrun
+LATE_CALLBACK_PERIODS = 2
+# Clicks of the loopback test
+CLICK_INTERVAL = 0.5
+CLICK_DURATION = 0.002
+CLICK_AMPLITUDE = 16000
+# Captured samples louder than this many times the noise floor are a click
+CLICK_THRESHOLD = 8
+
+
+def list_captures() -> List[Dict[str, Any]]:
+    return miniaudio.Devices().get_captures()
+
+
+def _callback_timer(callback_times: List[float], frame_counts: List[int]):
+    _ = yield
+    while True:
+        data = yield
+        callback_times.append(time.perf_counter())
+        frame_counts.append(len(data) // (CHANNELS * SAMPLE_SIZE))
+
+
+def measure_callbacks(device_id: Any, sample_rate: int, buffersize_msec: int,
+                      duration: float) -> Dict[str, Any]:
+    '''
+    Captures for `duration` seconds and returns the callback statistics
+    '''
+    callback_times: List[float] = []
+    frame_counts: List[int] = []
+    capture = miniaudio.CaptureDevice(input_format=miniaudio.SampleFormat.SIGNED16,
+                                      nchannels=CHANNELS,
+                                      sample_rate=sample_rate,
+                                      buffersize_msec=buffersize_msec,
+                                      device_id=device_id)
+    timer = _callback_timer(callback_times, frame_counts)
+    next(timer)
+    capture.start(timer)
+    time.sleep(duration)
+    capture.stop()
+    capture.close()
+
+    if len(callback_times) < 3:
+        return {"callbacks": len(callback_times), "stable": False}
+    # The first callback comes after the device starts, so it is the reference
+    intervals = [later - earlier for earlier, later in zip(callback_times, callback_times[1:])]
+    period = statistics.median(frame_counts) / sample_rate
+    elapsed = callback_times[-1] - callback_times[0]
+    lost_frames = max(0, round(elapsed * sample_rate) - sum(frame_counts[1:]))
+    late_callbacks = sum(1 for interval in intervals if interval > LATE_CALLBACK_PERIODS * period)
+    return {"callbacks": len(callback_times),
+            "period_ms": period * 1000,
+            "jitter_ms": statistics.pstdev(intervals) * 1000,
+            "max_interval_ms": max(intervals) * 1000,
+            "late_callbacks": late_callbacks,
+            "lost_frames": lost_frames,
+            "stable": late_callbacks == 0 and lost_frames < statistics.median(frame_counts)}
+
+
+def _click_loop(sample_rate: int, captured: List[bytes]):
+    '''
+    The duplex callback. It plays a click every CLICK_INTERVAL seconds and
+    keeps the captured data, which starts at the same frame as the playback.
+    '''
+    click = [CLICK_AMPLITUDE] * int(CLICK_DURATION * sample_rate)
+    interval = int(CLICK_INTERVAL * sample_rate)
+    played = 0
+    data = yield b""
+    while True:
+        captured.append(bytes(data))
+        frames = len(data) // (CHANNELS * SAMPLE_SIZE)
+        samples = []
+        for frame in range(played, played + frames):
+            position = frame % interval
+            # No click in the first interval, which is the noise floor
+            value = click[position] if frame >= interval and position < len(click) else 0
+            samples.extend([value] * CHANNELS)
+        played += frames
+        data = yield array.array("h", samples).tobytes()
+
+
+def measure_round_trip(device_id: Any, playback_id: Any, sample_rate: int,
+                       buffersize_msec: int, duration: float) -> Optional[Dict[str, float]]:
+    '''
+    Plays clicks and returns the median and maximum time in milliseconds
+    until they are captured, or None if no click was detected
+    '''
+    captured: List[bytes] = []
+    stream = miniaudio.DuplexStream(playback_format=miniaudio.SampleFormat.SIGNED16,
+                                    playback_channels=CHANNELS,
+                                    capture_format=miniaudio.SampleFormat.SIGNED16,
+                                    capture_channels=CHANNELS,
+                                    sample_rate=sample_rate,
+                                    buffersize_msec=buffersize_msec,
+                                    playback_device_id=playback_id,
+                                    capture_device_id=device_id)
+    clicks = _click_loop(sample_rate, captured)
+    next(clicks)
+    stream.start(clicks)
+    time.sleep(max(duration, 3 * CLICK_INTERVAL))
+    stream.stop()
+    stream.close()
+
+    samples = array.array("h")
+    samples.frombytes(b"".join(captured))
+    # The first channel is enough
+    signal = [abs(sample) for sample in samples[::CHANNELS]]
+    interval = int(CLICK_INTERVAL * sample_rate)
+    noise_floor = max(1.0, statistics.mean(signal[:interval])) if len(signal) > interval else 1.0
+    latencies = []
+    for click_frame in range(interval, len(signal) - interval, interval):
+        window = signal[click_frame:click_frame + interval]
+        for offset, value in enumerate(window):
+            if value > CLICK_THRESHOLD * noise_floor:
+                latencies.append(offset / sample_rate * 1000)
+                break
+    if not latencies:
+        return None
+    return {"round_trip_ms": statistics.median(latencies),
+            "round_trip_max_ms": max(latencies),
+            "clicks": len(latencies)}
+
+
+def profile_device(device: Dict[str, Any], buffer_sizes: List[int], sample_rates: List[int],
+                   duration: float, loopback: bool, playback_id: Any) -> List[Dict[str, Any]]:
+    results = []
+    for sample_rate in sample_rates:
+        for buffersize_msec in buffer_sizes:
+            result: Dict[str, Any] = {"sample_rate": sample_rate,
+                                      "buffersize_msec": buffersize_msec}
+            try:
+                result.update(measure_callbacks(device["id"], sample_rate, buffersize_msec,
+                                                duration))
+                if loopback and result["stable"]:
+                    result["loopback"] = measure_round_trip(device["id"], playback_id,
+                                                            sample_rate, buffersize_msec,
+                                                            duration)
+            except miniaudio.MiniaudioError as error:
+                result.update({"stable": False, "error": str(error)})
+            results.append(result)
+            print_result(result)
+    return results
+
+
+def streaming_result(results: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    '''
+    Returns the result of AudioStreaming's configuration if it is stable
+    '''
+    for result in results:
+        if result["sample_rate"] == STREAMING_SAMPLE_RATE and \
+                result["buffersize_msec"] == STREAMING_BUFFERSIZE_MSEC and result["stable"]:
+            return result
+    return None
+
+
+def rank(candidates: List[Dict[str, Any]]) -> Dict[str, Any]:
+    '''
+    Returns the best of stable results. Round trips are only compared when
+    all of them were measured, otherwise the jitter is compared
+    '''
+    if all(candidate.get("loopback") for candidate in candidates):
+        return min(candidates, key=lambda candidate: (candidate["loopback"]["round_trip_ms"],
+                                                      candidate["jitter_ms"]))
+    return min(candidates, key=lambda candidate: candidate["jitter_ms"])
+
+
+def print_result(result: Dict[str, Any]) -> None:
+    line = "  {0:>6} Hz {1:>5} ms  ".format(result["sample_rate"], result["buffersize_msec"])
+    if "error" in result:
+        print(line + "could not open: " + result["error"])
+        return
+    if "jitter_ms" not in result:
+        print(line + "{0} callbacks".format(result["callbacks"]))
+        return
+    line += "jitter {0:7.3f} ms  max interval {1:8.3f} ms  late {2:3}  lost frames {3:6}".format(
+        result["jitter_ms"], result["max_interval_ms"], result["late_callbacks"],
+        result["lost_frames"])
+    if result.get("loopback"):
+        line += "  round trip {0:7.2f} ms".format(result["loopback"]["round_trip_ms"])
+    elif "loopback" in result:
+        line += "  no click detected"
+    print(line + ("" if result["stable"] else "  UNSTABLE"))
+
+
+def recommended_capture_device(profile_path: str = AUDIO_PROFILE, default: int = 0) -> int:
+    '''
+    Returns the index of the capture device that the profile recommends,
+    for AudioStreaming, or `default` if there is no profile or the device
+    is not connected
+    '''
+    try:
+        with open(profile_path, "r") as profile_file:
+            name = json.load(profile_file)["recommended"]["device"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return default
+    for index, device in enumerate(list_captures()):
+        if device["name"] == name:
+            return index
+    print("The recommended audio device {0} is not connected".format(name))
+    return default
+
+
+def get_input_parameters():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l", "--list", help="Only lists capture devices", action="store_true")
+    parser.add_argument("-i", "--devices", help="Comma separated indexes of devices to profile")
+    parser.add_argument("-b", "--buffer-sizes", help="Comma separated buffer sizes in ms",
+                        default="10,20,50,100,200,1000")
+    parser.add_argument("-r", "--sample-rates", help="Comma separated sample rates",
+                        default="44100,48000")
+    parser.add_argument("-d", "--duration", help="Seconds of capture for each configuration",
+                        type=float, default=5)
+    parser.add_argument("--loopback", help="Measures round-trip latency with clicks",
+                        action="store_true")
+    parser.add_argument("-p", "--playback", help="The playback device index for --loopback",
+                        type=int, default=None)
+    parser.add_argument("-o", "--output", help="Saves the profile as JSON")
+    return parser.parse_args()
+
+
+def main():
+    args = get_input_parameters()
+    captures = list_captures()
+    for index, device in enumerate(captures):
+        print("{num} = {name}".format(num=index, name=device['name']))
+    if args.list:
+        return
+
+    indexes = range(len(captures)) if args.devices is None else \
+        [int(index) for index in args.devices.split(",")]
+    buffer_sizes = [int(size) for size in args.buffer_sizes.split(",")]
+    sample_rates = [int(rate) for rate in args.sample_rates.split(",")]
+    if STREAMING_BUFFERSIZE_MSEC not in buffer_sizes:
+        buffer_sizes.append(STREAMING_BUFFERSIZE_MSEC)
+    if STREAMING_SAMPLE_RATE not in sample_rates:
+        sample_rates.append(STREAMING_SAMPLE_RATE)
+    playback_id = None
+    if args.playback is not None:
+        playback_id = miniaudio.Devices().get_playbacks()[args.playback]["id"]
+
+    profile: Dict[str, Any] = {"devices": [], "recommended": None}
+    candidates = []
+    for index in indexes:
+        device = captures[index]
+        print("Profiling {0} = {1}".format(index, device["name"]))
+        results = profile_device(device, buffer_sizes, sample_rates, args.duration,
+                                 args.loopback, playback_id)
+        result = streaming_result(results)
+        if result is None:
+            print("  Not stable at {0} Hz with {1} ms buffers, which AudioStreaming uses".format(
+                STREAMING_SAMPLE_RATE, STREAMING_BUFFERSIZE_MSEC))
+        else:
+            candidates.append(dict(result, device=device["name"], index=index))
+        profile["devices"].append({"index": index, "name": device["name"],
+                                   "results": results})
+
+    if candidates:
+        profile["recommended"] = rank(candidates)
+    if profile["recommended"] is not None:
+        print("Use device {index} = {device}: {sample_rate} Hz, {buffersize_msec} ms buffer"
+              .format(**profile["recommended"]))
+    if args.output is not None:
+        with open(args.output, "w") as profile_file:
+            json.dump(profile, profile_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,489 @@
+'''
+Throughput and health metrics of the devices of a DeviceCoordinator,
+watched during a session instead of finding gaps after preprocessing.
+
+A background thread polls the coordinator's realtime data and counts the
+new samples of each device, like MonitoringStream. For every device it keeps:
+
+- the effective sample rate over the last `window` seconds, and the
+  nominal rate that it should have
+- gaps: times between new samples longer than `gap_threshold`. Gaps shorter
+  than the poll interval cannot be seen
+- the depth of the device's message queue, and for cameras with a frame
+  ring (SharedMemoryCameraStreaming) the frames waiting for the encoder
+  and the dropped frames
+- write latency: the time from a STOP or SAVE message to the end of the
+  writes to the device's output folder. It needs a MeteredDeviceCoordinator,
+  which tells the metrics about dispatched messages
+
+Metrics are served in the Prometheus text format on http://{ip}:{port}/metrics
+and appended every poll to a JSON-lines file, {"t": Unix time, "devices":
+{name: metrics}}. An alert is logged and written to the file, as {"t",
+"alert", "device", "message"}, when a device falls below `alert_ratio` of
+its nominal rate, drops frames or stops.
+
+Some devices, like AudioStreaming, only capture between START and STOP, so
+the rate and gaps are only checked while recording. With a
+MeteredDeviceCoordinator, recording starts at a START and ends at a STOP;
+with other coordinators the session is always recording.
+'''
+
+import os
+import json
+import time
+import queue
+import pickle
+import logging
+import threading
+import collections
+import http.server
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from octopus_sensing.device_coordinator import DeviceCoordinator
+from octopus_sensing.common.message_creators import MessageType
+
+from monitoring_stream import RealtimeDataPoller
+
+# AudioStreaming records are buffers of 16 bit stereo frames
+AUDIO_FRAME_SIZE = 4
+# The time in seconds to wait for the realtime data of devices
+REALTIME_DATA_TIMEOUT = 0.5
+# The time in seconds that realtime data is reused for requests of the same duration
+REALTIME_DATA_CACHE = 0.1
+# A pending write is forgotten when nothing is written for this many seconds
+WRITE_TIMEOUT = 60
+# Alert kinds
+ALERT_LOW_RATE = "low_rate"
+ALERT_DROPPED = "dropped"
+ALERT_NOT_ALIVE = "not_alive"
+
+
+class MeteredDeviceCoordinator(DeviceCoordinator):
+    '''
+    A DeviceCoordinator that calls its listeners with every dispatched
+    message, and that can be polled for realtime data from several threads,
+    e.g. by the monitoring endpoint, DeviceMetrics and readiness checks.
+
+    Example
+    -------
+    >>> device_coordinator = MeteredDeviceCoordinator()
+    >>> device_metrics = DeviceMetrics(device_coordinator)
+    '''
+    def __init__(self) -> None:
+        super().__init__()
+        self._dispatch_listeners: List[Callable[[Any], None]] = []
+        self._realtime_data_lock = threading.Lock()
+        # Replies of each device that were not read before their request timed out
+        self._stale_replies: Dict[str, int] = collections.defaultdict(int)
+        # (monotonic time, duration, device list, realtime data) of the last request
+        self._realtime_data_cache: Optional[Tuple[float, int, Any, Dict[str, Any]]] = None
+
+    def add_dispatch_listener(self, listener: Callable[[Any], None]) -> None:
+        self._dispatch_listeners.append(listener)
+
+    def dispatch(self, message) -> None:
+        super().dispatch(message)
+        for listener in self._dispatch_listeners:
+            listener(message)
+
+    def get_realtime_data(self, duration: int,
+                          device_list: Optional[List[str]] = None) -> Dict[str, Any]:
+        '''
+        The same as DeviceCoordinator.get_realtime_data, but requests are
+        serialized, so concurrent callers do not read each other's replies.
+        A reply that comes after its request timed out is dropped, instead
+        of being returned to the next request as fresh data.
+        '''
+        with self._realtime_data_lock:
+            now = time.monotonic()
+            cache = self._realtime_data_cache
+            if cache is not None and now - cache[0] < REALTIME_DATA_CACHE and \
+                    cache[1] == duration and cache[2] == device_list:
+                return cache[3]
+
+            requested = []
+            # The realtime data queues are private in DeviceCoordinator
+            for in_queue, out_queue, device in self._DeviceCoordinator__realtime_data_queues:
+                if device_list is not None and device.name not in device_list:
+                    continue
+                try:
+                    in_queue.put(str(duration), timeout=REALTIME_DATA_TIMEOUT)
+                    requested.append((out_queue, device.name))
+                except queue.Full:
+                    logging.warning("Could not request realtime data of {0}".format(device.name))
+
+            result: Dict[str, Any] = {}
+            deadline = time.monotonic() + REALTIME_DATA_TIMEOUT
+            for out_queue, name in requested:
+                try:
+                    # Devices reply in order, so older replies come first
+                    while True:
+                        reply = out_queue.get(timeout=max(0, deadline - time.monotonic()))
+                        if self._stale_replies[name] == 0:
+                            break
+                        self._stale_replies[name] -= 1
+                    result[name] = pickle.loads(reply)
+                except queue.Empty:
+                    self._stale_replies[name] += 1
+                    logging.warning("No realtime data from {0} in {1} s".format(
+                        name, REALTIME_DATA_TIMEOUT))
+                except pickle.PickleError as error:
+                    logging.warning("Invalid realtime data from {0}: {1}".format(name, error))
+
+            self._realtime_data_cache = (time.monotonic(), duration, device_list, result)
+            return result
+
+
+class _DeviceState():
+    def __init__(self, nominal_rate: Optional[float]):
+        self.nominal_rate = nominal_rate
+        self.samples = 0
+        # (monotonic time, samples) of polls in the rate window
+        self.history: collections.deque = collections.deque()
+        self.last_sample_time: Optional[float] = None
+        self.gaps = 0
+        self.max_gap = 0.0
+        self.dropped = 0
+        self.alerts = 0
+        self.alerting: Dict[str, bool] = {}
+        # Unix time of the STOP or SAVE message that a write is expected for
+        self.write_requested: Optional[float] = None
+        self.write_mtime: Optional[float] = None
+        self.write_latency: Optional[float] = None
+        self.metrics: Dict[str, Any] = {}
+
+
+def _count_samples(records: List[Any]) -> int:
+    if records and isinstance(records[0], bytes):
+        return sum(len(record) for record in records) // AUDIO_FRAME_SIZE
+    return len(records)
+
+
+def _newest_mtime(path: str) -> Optional[float]:
+    if not os.path.isdir(path):
+        path = os.path.dirname(path)
+    try:
+        with os.scandir(path) as entries:
+            return max((entry.stat().st_mtime for entry in entries if entry.is_file()),
+                       default=None)
+    except OSError:
+        return None
+
+
+class DeviceMetrics():
+    '''
+    Tracks the throughput of devices and serves it as Prometheus metrics
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    device_coordinator: DeviceCoordinator
+        An instance of DeviceCoordinator class. Write latency is measured
+        only with MeteredDeviceCoordinator
+
+    nominal_rates: Dict[str, float], optional
+        The sampling rate of each device by name. Devices that are not in it
+        use the `sampling_rate` or `frame_rate` of their realtime data
+
+    port: int, default: 9332
+        TCP port of the Prometheus endpoint
+
+    file_path: str, optional
+        The JSON-lines metrics file of the session
+
+    interval: float, default: 1
+        The time in seconds between polls
+
+    window: int, default: 10
+        The time in seconds that effective rates are measured over. Rate
+        alerts start after the first window of each recording
+
+    gap_threshold: float, default: 2
+        The minimum time in seconds between samples that is counted as a gap
+
+    alert_ratio: float, default: 0.9
+        A device alerts when its effective rate is below this ratio of its nominal rate
+
+    alert_callback: Callable[[str, str, str], None], optional
+        Called with the device name, alert kind and message on the polling thread
+
+    Example
+    -------
+    >>> device_metrics = DeviceMetrics(device_coordinator,
+    ...                                nominal_rates={"eeg": 125, "shimmer": 128},
+    ...                                file_path="output/p01/metrics-01-01.jsonl")
+    >>> device_metrics.start()
+    >>> # curl http://{ip}:9332/metrics
+    >>> device_metrics.stop()
+    '''
+    def __init__(self, device_coordinator, nominal_rates: Optional[Dict[str, float]] = None,
+                 port: int = 9332, file_path: Optional[str] = None, interval: float = 1,
+                 window: int = 10, gap_threshold: float = 2, alert_ratio: float = 0.9,
+                 alert_callback: Optional[Callable[[str, str, str], None]] = None):
+        self._device_coordinator = device_coordinator
+        self._nominal_rates = nominal_rates or {}
+        self._file_path = file_path
+        self._interval = interval
+        self._window = window
+        self._gap_threshold = gap_threshold
+        self._alert_ratio = alert_ratio
+        self._alert_callback = alert_callback
+        self._states: Dict[str, _DeviceState] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._start_time: Optional[float] = None
+        # Monotonic time of the START of the current recording, None between recordings
+        self._recording_since: Optional[float] = None
+        self._tracks_recording = hasattr(device_coordinator, "add_dispatch_listener")
+        self._poller = RealtimeDataPoller(device_coordinator, window)
+        self._metrics_file = None
+        self._thread: Optional[threading.Thread] = None
+        self._server_thread: Optional[threading.Thread] = None
+
+        if hasattr(device_coordinator, "add_dispatch_listener"):
+            device_coordinator.add_dispatch_listener(self._on_dispatch)
+        self._server = http.server.ThreadingHTTPServer(("", port), self._make_handler())
+
+    def get_port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> None:
+        '''
+        Starts polling and serving metrics in background threads
+        '''
+        if self._file_path is not None:
+            self._metrics_file = open(self._file_path, "a")
+        self._thread = threading.Thread(target=self._run, name="DeviceMetrics-Poll",
+                                        daemon=True)
+        self._server_thread = threading.Thread(target=self._server.serve_forever,
+                                               name="DeviceMetrics-Endpoint", daemon=True)
+        self._thread.start()
+        self._server_thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
+        self._server.shutdown()
+        self._server.server_close()
+        if self._metrics_file is not None:
+            self._metrics_file.close()
+
+    def get_metrics(self) -> Dict[str, Dict[str, Any]]:
+        '''
+        Returns the last metrics of each device
+        '''
+        with self._lock:
+            return {name: dict(state.metrics) for name, state in self._states.items()}
+
+    def render(self) -> str:
+        '''
+        Returns the metrics in the Prometheus text format
+        '''
+        metrics = self.get_metrics()
+        lines = []
+        for metric, metric_type, description in _PROMETHEUS_METRICS:
+            lines.append("# HELP octopus_device_{0} {1}".format(metric, description))
+            lines.append("# TYPE octopus_device_{0} {1}".format(metric, metric_type))
+            for device, values in sorted(metrics.items()):
+                value = values.get(metric)
+                if value is None:
+                    continue
+                lines.append('octopus_device_{0}{{device="{1}"}} {2}'.format(
+                    metric, device, float(value)))
+        return "\n".join(lines) + "\n"
+
+    def _make_handler(self):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("UTF-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _on_dispatch(self, message) -> None:
+        if message.type == MessageType.START:
+            with self._lock:
+                self._recording_since = time.monotonic()
+                for state in self._states.values():
+                    # The time between recordings is not a gap
+                    state.last_sample_time = None
+            return
+        if message.type not in (MessageType.STOP, MessageType.SAVE):
+            return
+        request_time = time.time()
+        with self._lock:
+            if message.type == MessageType.STOP:
+                self._recording_since = None
+            for state in self._states.values():
+                # A SAVE after a STOP is the request if nothing is written yet
+                if state.write_mtime is None:
+                    state.write_requested = request_time
+
+    def _run(self) -> None:
+        self._start_time = time.monotonic()
+        if not self._tracks_recording:
+            self._recording_since = self._start_time
+        while not self._stop_event.is_set():
+            start = time.monotonic()
+            try:
+                self._poll()
+            except Exception as error:
+                logging.error("Device metrics poll failed: {0}".format(error))
+            self._stop_event.wait(max(0, self._interval - (time.monotonic() - start)))
+
+    def _poll(self) -> None:
+        now = time.monotonic()
+        realtime_data = self._poller.poll()
+
+        alerts = []
+        for device in self._device_coordinator.get_devices():
+            data, metadata = realtime_data.get(device.name, ([], {}))
+            with self._lock:
+                state = self._states.get(device.name)
+                if state is None:
+                    state = _DeviceState(self._nominal_rates.get(device.name))
+                    self._states[device.name] = state
+                alerts.extend(self._update(device, state, data, metadata, now))
+
+        unix_time = time.time()
+        if self._metrics_file is not None:
+            self._metrics_file.write(json.dumps({"t": unix_time,
+                                                 "devices": self.get_metrics()}) + "\n")
+        for device, kind, message in alerts:
+            logging.warning("Device {0}: {1}".format(device, message))
+            if self._metrics_file is not None:
+                self._metrics_file.write(json.dumps({"t": unix_time, "alert": kind,
+                                                     "device": device,
+                                                     "message": message}) + "\n")
+            if self._alert_callback is not None:
+                self._alert_callback(device, kind, message)
+        if self._metrics_file is not None:
+            self._metrics_file.flush()
+
+    def _update(self, device, state: _DeviceState, records: List[Any],
+                metadata: Dict[str, Any], now: float) -> List[Any]:
+        if state.nominal_rate is None:
+            state.nominal_rate = metadata.get("sampling_rate") or metadata.get("frame_rate")
+        metrics: Dict[str, Any] = {"nominal_rate_hz": state.nominal_rate}
+
+        if hasattr(device, "get_counters"):
+            # Cameras only return their last frame, so frames are counted by the device
+            counters = device.get_counters()
+            new_samples = counters["captured"] - state.samples
+            metrics["buffer_depth"] = counters["written"] - counters["encoded"]
+            metrics["dropped_total"] = counters["dropped"]
+        else:
+            new_samples = _count_samples(self._poller.new_records(device.name, records))
+        state.samples += new_samples
+
+        recording = self._recording_since is not None
+        if new_samples > 0:
+            if recording and state.last_sample_time is not None:
+                gap = now - state.last_sample_time
+                if gap > self._gap_threshold:
+                    state.gaps += 1
+                state.max_gap = max(state.max_gap, gap)
+            state.last_sample_time = now
+        state.history.append((now, state.samples))
+        while now - state.history[0][0] > self._window:
+            state.history.popleft()
+        first_time, first_samples = state.history[0]
+        rate = (state.samples - first_samples) / (now - first_time) if now > first_time else None
+
+        metrics.update({"samples_total": state.samples,
+                        "effective_rate_hz": rate,
+                        "gaps_total": state.gaps,
+                        "max_gap_seconds": state.max_gap,
+                        "seconds_since_last_sample":
+                            None if state.last_sample_time is None
+                            else now - state.last_sample_time,
+                        "alive": int(device.is_alive())})
+        try:
+            metrics["queue_depth"] = device.message_queue.qsize()
+        except (AttributeError, NotImplementedError):
+            # qsize is not implemented on macOS
+            pass
+        self._update_write_latency(device, state)
+        metrics["write_latency_seconds"] = state.write_latency
+
+        alerts = []
+        warmed_up = recording and now - self._recording_since >= self._window
+        low = bool(warmed_up and rate is not None and state.nominal_rate and
+                   rate < self._alert_ratio * state.nominal_rate)
+        if self._alert(state, ALERT_LOW_RATE, low):
+            alerts.append((device.name, ALERT_LOW_RATE,
+                           "effective rate {0:.1f} Hz is below the nominal {1:.1f} Hz"
+                           .format(rate, state.nominal_rate)))
+        dropped = metrics.get("dropped_total", 0)
+        if self._alert(state, ALERT_DROPPED, dropped > state.dropped):
+            alerts.append((device.name, ALERT_DROPPED,
+                           "{0} frames dropped".format(dropped - state.dropped)))
+        state.dropped = dropped
+        if self._alert(state, ALERT_NOT_ALIVE, not metrics["alive"]):
+            alerts.append((device.name, ALERT_NOT_ALIVE, "the device process is not alive"))
+
+        metrics["alerts_total"] = state.alerts
+        state.metrics = metrics
+        return alerts
+
+    @staticmethod
+    def _alert(state: _DeviceState, kind: str, condition: bool) -> bool:
+        '''
+        Returns True when a condition starts, so an alert is raised once until it ends
+        '''
+        started = condition and not state.alerting.get(kind, False)
+        state.alerting[kind] = condition
+        if started:
+            state.alerts += 1
+        return started
+
+    @staticmethod
+    def _update_write_latency(device, state: _DeviceState) -> None:
+        '''
+        A write is complete when the newest file of the output folder is
+        modified after the request and then stays the same for a poll
+        '''
+        if state.write_requested is None:
+            return
+        mtime = _newest_mtime(device.output_path)
+        if mtime is None or mtime <= state.write_requested:
+            if time.time() - state.write_requested > WRITE_TIMEOUT:
+                state.write_requested = None
+            return
+        if mtime != state.write_mtime:
+            state.write_mtime = mtime
+            return
+        state.write_latency = mtime - state.write_requested
+        state.write_requested = None
+        state.write_mtime = None
+
+
+# (metric, type, description) in the Prometheus endpoint
+_PROMETHEUS_METRICS = [
+    ("nominal_rate_hz", "gauge", "The sampling rate that the device should have"),
+    ("effective_rate_hz", "gauge", "The measured sampling rate over the last window"),
+    ("samples_total", "counter", "Received samples, or captured frames of cameras"),
+    ("gaps_total", "counter", "Times between samples longer than the gap threshold"),
+    ("max_gap_seconds", "gauge", "The longest time between samples"),
+    ("seconds_since_last_sample", "gauge", "The time since the last new sample"),
+    ("queue_depth", "gauge", "Messages waiting in the device's message queue"),
+    ("buffer_depth", "gauge", "Frames waiting for the encoder"),
+    ("dropped_total", "counter", "Frames dropped because the encoder was behind"),
+    ("write_latency_seconds", "gauge", "The time from the last STOP or SAVE to the end of writes"),
+    ("alive", "gauge", "1 if the device process is alive"),
+    ("alerts_total", "counter", "Raised alerts"),
+]
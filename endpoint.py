@@ -9,31 +9,40 @@ Steps:
 import os
 import time
 import sys
+import logging
 import argparse
 sys.path.insert(0, '../octopus-sensing/')
-from octopus_sensing.device_coordinator import DeviceCoordinator
 from octopus_sensing.devices import AudioStreaming
-from octopus_sensing.devices import CameraStreaming
 from octopus_sensing.devices import BrainFlowOpenBCIStreaming
 from octopus_sensing.devices.shimmer3_streaming import Shimmer3Streaming
 
 from octopus_sensing.monitoring_endpoint import MonitoringEndpoint
-from octopus_sensing.preprocessing.preprocess_devices import preprocess_devices
-from octopus_sensing.device_message_endpoint import DeviceMessageHTTPEndpoint
+from trigger_endpoint import HTTPTriggerEndpoint, UDPTriggerEndpoint
+from monitoring_stream import MonitoringStream
+from camera_pipeline import SharedMemoryCameraStreaming
+from check_audio import recommended_capture_device
+from device_metrics import DeviceMetrics, MeteredDeviceCoordinator
+from preprocessing_driver import PreprocessingDriver, device_jobs
 
 def get_input_parameters():
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--subject_id", help="The subject ID", default=0)
     #parser.add_argument("-t", "--task_id", help="The task ID", default=1)
+    parser.add_argument("-r", "--transport", help="The trigger transport, http or udp",
+                        choices=["http", "udp"], default="udp")
+    parser.add_argument("-m", "--monitoring",
+                        help="The monitoring server, endpoint (HTTP polling) or stream "
+                             "(decimated data over WebSocket)",
+                        choices=["endpoint", "stream"], default="endpoint")
     args = parser.parse_args()
     subject_id = args.subject_id
     task_id = 1  # args.task_id
-    return subject_id, task_id
+    return subject_id, task_id, args.transport, args.monitoring
 
 def main():
-    device_coordinator = DeviceCoordinator()
     main_camera = "/dev/v4l/by-id/usb-Intel_R__RealSense_TM__Depth_Camera_415_Intel_R__RealSense_TM__Depth_Camera_415-video-index0"
-    subject_id, task_id = get_input_parameters()
+    subject_id, task_id, transport, monitoring = get_input_parameters()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
     experiment_id = str(subject_id).zfill(2) + "-" + str(task_id).zfill(2)
     output_path = "output_remote/p{0}".format(str.zfill(subject_id,2))
     if not os.path.exists(output_path):
@@ -55,23 +64,40 @@ def main():
     shimmer = Shimmer3Streaming(name="shimmer", output_path=output_path)
     
     
-    audio = AudioStreaming(2, name="audio", output_path=output_path)
+    # The device that check_audio.py recommended, found by its name
+    audio = AudioStreaming(recommended_capture_device(default=2),
+                           name="audio",
+                           output_path=output_path)
 
     camera = \
-        CameraStreaming(name="webcam",
-                        output_path=output_path,
-                        #camera_no=os.path.realpath(main_camera),
-                        camera_path=main_camera,
-                        image_width=640,
-                        image_height=480)
-    device_coordinator = DeviceCoordinator()
+        SharedMemoryCameraStreaming(name="webcam",
+                                    output_path=output_path,
+                                    #camera_no=os.path.realpath(main_camera),
+                                    camera_path=main_camera,
+                                    image_width=640,
+                                    image_height=480)
+    device_coordinator = MeteredDeviceCoordinator()
     device_coordinator.add_devices([camera, audio, openbci, shimmer])
+    device_metrics = DeviceMetrics(device_coordinator,
+                                   nominal_rates={"eeg": 125, "shimmer": 128},
+                                   port=9332,
+                                   file_path=os.path.join(
+                                       output_path, "metrics-{0}.jsonl".format(experiment_id)))
+    device_metrics.start()
 
-    monitoring_endpoint = MonitoringEndpoint(device_coordinator)
+    if monitoring == "stream":
+        monitoring_endpoint = MonitoringStream(device_coordinator, port=9330)
+    else:
+        monitoring_endpoint = MonitoringEndpoint(device_coordinator)
     monitoring_endpoint.start()
 
     # Add your devices
-    message_endpoint = DeviceMessageHTTPEndpoint(device_coordinator, port=9331)
+    if transport == "udp":
+        # Clock offset and marker files are saved next to the recordings
+        message_endpoint = UDPTriggerEndpoint(device_coordinator, port=9331,
+                                              output_path=output_path)
+    else:
+        message_endpoint = HTTPTriggerEndpoint(device_coordinator, port=9331)
     print("start listening")
     message_endpoint.start()
 
@@ -83,15 +109,18 @@ def main():
     
     message_endpoint.stop()
     monitoring_endpoint.stop()
+    device_metrics.stop()
     try:
         device_coordinator.terminate()
     except:
         pass
+    logging.info("Webcam frames: {0}".format(camera.get_counters()))
 
-    preprocess_devices(device_coordinator,
-                       "preprocessed_remote_output",
-                       openbci_sampling_rate=125,
-                       signal_preprocess=True,
-                       shimmer3_sampling_rate=128)
+    preprocessing_driver = PreprocessingDriver(openbci_sampling_rate=125,
+                                               shimmer3_sampling_rate=128,
+                                               signal_preprocess=True)
+    preprocessing_driver.start(device_jobs(device_coordinator, "preprocessed_remote_output"))
+    preprocessing_driver.wait()
 
-main()
+if __name__ == "__main__":
+    main()
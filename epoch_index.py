@@ -0,0 +1,163 @@
+'''
+A per-session index of trials, written while the experiment runs.
+Each trial is one row of a csv file:
+
+    trial, stimulus_id, emotion,
+    fixation_onset, fixation_presented, stimulus_onset, stimulus_presented,
+    conversation_onset, questionnaire_onset, questionnaire_offset, clock_offset,
+    endpoint_offset
+
+Times are on the monotonic clock in seconds. Each phase ends at the onset of
+the next one, and the questionnaire ends when its message window is closed.
+`*_presented` are the times that images reached the screen, when the window
+reported them. Recordings are stamped with time.time(), which is a monotonic
+time plus `clock_offset`, so trial data can be found with a binary search
+on the recording's time column, e.g. with SessionReader.time_slice.
+
+`clock_offset` is the clock of the machine that wrote the index, so it only
+converts times to the recordings' clock when the devices record on the same
+machine (f2f). In remote sessions the devices record on the endpoint machine;
+`endpoint_offset` is the endpoint's monotonic clock minus this machine's
+monotonic clock, from the trigger sender's clock synchronization, and the
+endpoint's time.time() minus its monotonic clock is `unix_time - receive_time`
+of its clock_offset.csv.
+'''
+
+import os
+import csv
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+COLUMNS = ["trial", "stimulus_id", "emotion",
+           "fixation_onset", "fixation_presented",
+           "stimulus_onset", "stimulus_presented",
+           "conversation_onset", "questionnaire_onset", "questionnaire_offset",
+           "clock_offset", "endpoint_offset"]
+
+# The column of each TrialScheduler phase
+PHASE_COLUMNS = {"fixation_cross": "fixation_onset",
+                 "stimuli": "stimulus_onset",
+                 "timer": "conversation_onset",
+                 "questionnaire": "questionnaire_onset"}
+
+# The column that each phase ends at
+PHASE_OFFSETS = {"fixation": "stimulus_onset",
+                 "stimulus": "conversation_onset",
+                 "conversation": "questionnaire_onset",
+                 "questionnaire": "questionnaire_offset"}
+
+TIME_COLUMNS = COLUMNS[3:]
+
+
+class EpochIndex():
+    '''
+    Writes the epoch index of a session. A row is appended as soon as its
+    trial ends, so the index is complete up to the last finished trial even
+    if the experiment is stopped.
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    file_path: str
+        The csv file. Rows are appended if it exists
+
+    Example
+    -------
+    >>> epoch_index = EpochIndex("output/p01/epochs.csv")
+    >>> epoch_index.start_trial(1, "11", "High-Valence, High-Arousal")
+    >>> epoch_index.add_records(trial_scheduler.records)
+    >>> epoch_index.set_time("stimulus_presented", presentation_time)
+    >>> epoch_index.end_trial()
+    '''
+    def __init__(self, file_path: str):
+        self._file_path = file_path
+        self._row: Optional[Dict[str, Any]] = None
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(file_path):
+            self._write_row(COLUMNS)
+
+    def start_trial(self, trial: int, stimulus_id: str, emotion: str) -> None:
+        self._row = {"trial": trial, "stimulus_id": stimulus_id, "emotion": emotion}
+
+    def add_records(self, records: List[Dict[str, Any]]) -> None:
+        '''
+        Takes the actual onsets of phases from TrialScheduler records.
+        Records of phases that are not in PHASE_COLUMNS are ignored.
+        '''
+        for record in records:
+            column = PHASE_COLUMNS.get(record["phase"])
+            if column is not None:
+                self.set_time(column, record["actual"])
+
+    def set_time(self, column: str, value: float) -> None:
+        if self._row is not None:
+            self._row[column] = value
+
+    def end_trial(self, offset: Optional[float] = None,
+                  endpoint_offset: Optional[float] = None) -> None:
+        '''
+        Writes the current trial. By default the questionnaire ends now.
+        endpoint_offset is set in remote sessions; see the module docstring.
+        '''
+        if self._row is None:
+            return
+        self._row["questionnaire_offset"] = time.monotonic() if offset is None else offset
+        self._row["clock_offset"] = time.time() - time.monotonic()
+        if endpoint_offset is not None:
+            self._row["endpoint_offset"] = endpoint_offset
+        self._write_row([self._row.get(column, "") for column in COLUMNS])
+        self._row = None
+
+    def _write_row(self, row: List[Any]) -> None:
+        with open(self._file_path, 'a') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(row)
+
+
+def read_epoch_index(file_path: str) -> List[Dict[str, Any]]:
+    '''
+    Reads an epoch index. Times are floats, and missing times are None.
+    '''
+    trials = []
+    with open(file_path, "r") as csv_file:
+        for row in csv.DictReader(csv_file):
+            trial: Dict[str, Any] = dict(row)
+            trial["trial"] = int(row["trial"])
+            for column in TIME_COLUMNS:
+                trial[column] = float(row[column]) if row.get(column) else None
+            trials.append(trial)
+    return trials
+
+
+def phase_times(trial: Dict[str, Any], phase: str, unix_time: bool = True,
+                endpoint_clock_offset: Optional[float] = None) -> Tuple[float, float]:
+    '''
+    Returns the onset and offset of a phase of a trial from read_epoch_index
+
+    Parameters
+    ----------
+    phase: str
+        One of fixation, stimulus, conversation and questionnaire
+
+    unix_time: bool, default: True
+        If True times are converted to time.time(), the clock of recordings
+
+    endpoint_clock_offset: float, default: None
+        The endpoint's time.time() minus its monotonic clock. It is required
+        for converting the times of remote sessions (with endpoint_offset)
+    '''
+    onset = trial[phase + "_onset"]
+    offset = trial[PHASE_OFFSETS[phase]]
+    if not unix_time:
+        return onset, offset
+    if trial.get("endpoint_offset") is None:
+        clock_offset = trial["clock_offset"]
+    elif endpoint_clock_offset is None:
+        raise ValueError("endpoint_clock_offset is required for a remote session")
+    else:
+        clock_offset = trial["endpoint_offset"] + endpoint_clock_offset
+    return onset + clock_offset, offset + clock_offset
@@ -0,0 +1,137 @@
+'''
+Records experiment events as JSON lines from a background thread.
+
+Recording an event only takes a monotonic timestamp and puts a tuple in a
+queue, so it is cheap enough for stimulus onsets on the GTK thread.
+Formatting and writing are done in batches by the writer thread.
+Each line is {"t": monotonic time, "event": name, ...fields}, and the
+first line is a "clock" event with the Unix time of monotonic time zero,
+so events can be matched to recordings afterwards.
+'''
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# (monotonic time, event name, fields)
+Event = Tuple[float, str, Dict[str, Any]]
+
+
+class EventRecorder(threading.Thread):
+    '''
+    A JSON-lines event log that is written by a background thread
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    file_path: str
+        The JSON-lines file. Events are appended if it exists
+
+    flush_interval: float, default: 0.5
+        The maximum time in seconds that an event waits before being written
+
+    fsync_interval: float, default: 5
+        The time in seconds between syncing the file to the disk
+
+    Example
+    -------
+    >>> recorder = EventRecorder("logs/events.jsonl")
+    >>> recorder.start()
+    >>> recorder.record("stimulus_onset", stimulus_id="11")
+    >>> recorder.stop()
+    '''
+    def __init__(self, file_path: str, flush_interval: float = 0.5,
+                 fsync_interval: float = 5):
+        super().__init__(name="EventRecorder", daemon=True)
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file_path = file_path
+        self._flush_interval = flush_interval
+        self._fsync_interval = fsync_interval
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.record("clock", unix_offset=time.time() - time.monotonic())
+
+    def record(self, event: str, timestamp: Optional[float] = None, **fields: Any) -> None:
+        '''
+        Queues an event. Fields should be JSON serializable.
+
+        Parameters
+        ----------
+        event: str
+            The event name
+
+        timestamp: float, default: None
+            The monotonic time of the event. By default it is now
+        '''
+        self._queue.put((time.monotonic() if timestamp is None else timestamp,
+                         event, fields))
+
+    def stop(self, timeout: float = 5) -> None:
+        '''
+        Writes the queued events, syncs the file and stops the thread
+        '''
+        self._queue.put(None)
+        self.join(timeout)
+
+    def run(self) -> None:
+        last_sync = time.monotonic()
+        stopped = False
+        with open(self._file_path, "a") as events_file:
+            while not stopped:
+                batch, stopped = self._next_batch()
+                if batch:
+                    events_file.write("".join(self._format(event) for event in batch))
+                    events_file.flush()
+                if stopped or time.monotonic() - last_sync >= self._fsync_interval:
+                    os.fsync(events_file.fileno())
+                    last_sync = time.monotonic()
+
+    def _next_batch(self) -> Tuple[List[Event], bool]:
+        '''
+        Waits for the first event, then takes every event queued until the flush interval
+        '''
+        batch: List[Event] = []
+        try:
+            event = self._queue.get(timeout=self._flush_interval)
+        except queue.Empty:
+            return batch, False
+        deadline = time.monotonic() + self._flush_interval
+        while event is not None:
+            batch.append(event)
+            try:
+                event = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    @staticmethod
+    def _format(event: Event) -> str:
+        timestamp, name, fields = event
+        try:
+            return json.dumps(dict(fields, t=timestamp, event=name)) + "\n"
+        except (TypeError, ValueError) as error:
+            logging.error("Could not record event {0}: {1}".format(name, error))
+            return ""
+
+
+def read_events(file_path: str) -> Iterator[Dict[str, Any]]:
+    '''
+    Replays a recorded event log. Each event has `t` and `event` keys,
+    and `unix_time` is added with the clock event before it.
+    '''
+    unix_offset = None
+    with open(file_path, "r") as events_file:
+        for line in events_file:
+            event = json.loads(line)
+            if event["event"] == "clock":
+                unix_offset = event["unix_offset"]
+            elif unix_offset is not None:
+                event["unix_time"] = event["t"] + unix_offset
+            yield event
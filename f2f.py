@@ -6,11 +6,14 @@ Steps:
 3- Run monitoring (Get the IP address before) before pressing the start button
 '''
 
+import time
+# The start of the startup timing report, before the imports
+STARTUP_TIME = time.monotonic()
+
 import os
 import logging
 import datetime
 import sys
-import time
 import argparse
 import csv
 from scipy import signal
@@ -20,16 +23,23 @@ sys.path.insert(0, '../octopus-sensing/')
 
 from octopus_sensing.windows.timer_window import TimerWindow
 from octopus_sensing.devices import AudioStreaming
-from octopus_sensing.devices import CameraStreaming
 from octopus_sensing.devices import BrainFlowOpenBCIStreaming
 from octopus_sensing.devices.shimmer3_streaming import Shimmer3Streaming
-from octopus_sensing.device_coordinator import DeviceCoordinator
 from octopus_sensing.monitoring_endpoint import MonitoringEndpoint
-from octopus_sensing.preprocessing.preprocess_devices import preprocess_devices
-from octopus_sensing.common.message_creators import start_message, stop_message
-
-from windows import ImageWindow, MessageButtonWindow
-from prepare_stimuli import prepare_stimuli_list
+from octopus_sensing.common.message_creators import start_message, stop_message, save_message
+
+from windows import make_image_window, ImagePresenter, MessageButtonWindow
+from image_cache import PixbufCache, ImagePrefetcher
+from prepare_stimuli import prepare_stimuli_list, get_stimulus_file, read_cohort_order
+from trial_scheduler import TrialScheduler
+from epoch_index import EpochIndex
+from event_recorder import EventRecorder
+from preprocessing_driver import PreprocessingDriver, device_jobs
+from readiness import ReadinessGate, StartupReport, device_checks, port_check
+from monitoring_stream import MonitoringStream
+from camera_pipeline import SharedMemoryCameraStreaming
+from check_audio import recommended_capture_device
+from device_metrics import DeviceMetrics, MeteredDeviceCoordinator
 
 import gi
 from gi.repository import Gtk, GdkPixbuf, GLib, Gdk
@@ -43,6 +53,11 @@ EMOTIONS = {"1": "High-Valence, High-Arousal",
             "4": "Low-Valence, Low-Arousal"}
 
 def read_stimuli_order(subject_id):
+    # Orders of a generated cohort (prepare_stimuli.py --cohort) are used first
+    order = read_cohort_order(subject_id, "f2f")
+    if order is not None:
+        print(order)
+        return order
     stimuli_order_file_path = "stimuli/f2f/p{}_stimuli.csv".format(str(subject_id).zfill(2))
     print(stimuli_order_file_path)
     if not os.path.exists(stimuli_order_file_path):
@@ -51,25 +66,65 @@ def read_stimuli_order(subject_id):
     with open(stimuli_order_file_path, "r") as csv_file:
         reader = csv.reader(csv_file)
         for row in reader:
-            order.append(row[0])
+            # Orders have file names. Stimuli that are not in the manifest raise KeyError
+            order.append(get_stimulus_file(os.path.splitext(row[0])[0]))
     print(order)
     return order
 
 STIMULI_PATH = "stimuli/all_images/"
+FIXED_IMAGES = ["images/gray_image.jpg",
+                "images/fixation_cross.jpg",
+                "images/done_image.jpg"]
+
+# Onset of each phase in seconds. The session starts when all components are ready
+SESSION_TIMELINE = [("start", 0)]
+MONITORING_PORT = 9330
+METRICS_PORT = 9332
+# Sampling rates that devices are checked against during the session
+NOMINAL_RATES = {"eeg": 125, "shimmer": 128}
+# The maximum time in seconds to wait for devices and the monitoring endpoint
+READINESS_TIMEOUT = 30
+# The delay in seconds between STOP and saving the trial, so devices can
+# attach the STOP trigger to a recorded sample first. If the next trial
+# starts earlier, the trial is saved right before its START
+SAVE_DELAY = 1
+TRIAL_TIMELINE = [("fixation_cross", 0),
+                  ("stimuli", 3),
+                  ("timer", 9)]
 
 class BackgroudWindow(Gtk.Window):
-    def __init__(self, experiment_id, subject_id, device_coordinator):
+    def __init__(self, experiment_id, subject_id, device_coordinator,
+                 preprocessing_driver=None, epoch_index_path=None,
+                 image_backend="pixbuf", readiness_checks=None, startup_report=None,
+                 log_path=None, events_path=None):
         os.makedirs("logs", exist_ok=True)
         time_str = datetime.datetime.strftime(datetime.datetime.now(),
                                               "%Y-%m-%dT%H-%M-%S")
-        logging.basicConfig(filename='logs/exp2_f2f_log_{0}_{1}.log'.format(experiment_id, time_str),
-                            level=logging.DEBUG)
+        if log_path is None:
+            log_path = 'logs/exp2_f2f_log_{0}_{1}.log'.format(experiment_id, time_str)
+        logging.basicConfig(filename=log_path, level=logging.DEBUG)
+        if epoch_index_path is None:
+            epoch_index_path = 'logs/exp2_f2f_epochs_{0}_{1}.csv'.format(experiment_id, time_str)
+        self._epoch_index = EpochIndex(epoch_index_path)
+        # Events on the timing-critical path are written by a background thread
+        if events_path is None:
+            events_path = 'logs/exp2_f2f_events_{0}_{1}.jsonl'.format(experiment_id, time_str)
+        self._events = EventRecorder(events_path)
+        self._events.start()
         self._device_coordinator = device_coordinator
+        self._preprocessing_driver = preprocessing_driver
         self._experiment_id = experiment_id
+        self._startup_report = startup_report or StartupReport()
 
         self._stimuli_list = read_stimuli_order(subject_id)
 
         self._index = 0
+        # (GLib source ID, stimulus ID) of the trial that waits for SAVE_DELAY
+        self._pending_save = None
+        self._session_scheduler = TrialScheduler(SESSION_TIMELINE, recorder=self._events)
+        self._trial_scheduler = TrialScheduler(TRIAL_TIMELINE, recorder=self._events)
+        # The number of trial scheduler records that are in the epoch index
+        self._indexed_records = 0
         logging.info("Emotion order is {}".format(self._stimuli_list))
 
         Gtk.Window.__init__(self, title="")
@@ -79,19 +134,36 @@ class BackgroudWindow(Gtk.Window):
         image_height = monitors[0].height
         print(image_width, image_height)
         background_path = "images/gray_image.jpg"
-        pixbuf = \
-            GdkPixbuf.Pixbuf.new_from_file_at_scale(background_path,
-                                                    image_width,
-                                                    image_height, False)
+        self._image_cache = PixbufCache()
+        self._prefetcher = ImagePrefetcher(self._image_cache)
+        pixbuf = self._image_cache.get(background_path, image_width, image_height, 0)
         image = Gtk.Image()
         image.set_from_pixbuf(pixbuf)
         image_box.pack_start(image, False, False, 0)
         self.add(image_box)
 
-        self.image_window = ImageWindow("image_window", monitor_no=1)
-        self.image_window.set_image(background_path)
-        self.navigator_image_window = ImageWindow("image_window", monitor_no=0)
-        self.navigator_image_window.set_image(background_path)
+        # Decoding all images before the first trial
+        session_images = \
+            FIXED_IMAGES + [STIMULI_PATH + stimulus for stimulus in self._stimuli_list]
+        self.image_window = make_image_window("image_window", monitor_no=1,
+                                              image_cache=self._image_cache,
+                                              backend=image_backend)
+        self.navigator_image_window = make_image_window("image_window", monitor_no=0,
+                                                        image_cache=self._image_cache,
+                                                        backend=image_backend)
+        self._presenter = ImagePresenter([self.image_window, self.navigator_image_window],
+                                         self._image_cache)
+        self._startup_report.mark("window creation")
+        self._presenter.preload(session_images)
+        self._presenter.set_image(background_path)
+        self._startup_report.mark("asset preload")
+
+        readiness_checks = dict(readiness_checks or {})
+        readiness_checks["stimulus cache"] = lambda: all(
+            self._image_cache.contains(window.get_cache_key(image_path))
+            for window in [self.image_window, self.navigator_image_window]
+            for image_path in session_images)
+        self._readiness_gate = ReadinessGate(readiness_checks, timeout=READINESS_TIMEOUT)
 
 
     def show(self, *args):
@@ -104,19 +176,25 @@ class BackgroudWindow(Gtk.Window):
         self.image_window.show_window()
         self.navigator_image_window.show_window()
 
-        GLib.timeout_add_seconds(5, self._show_message)
-        GLib.timeout_add_seconds(1, self._move_image_window)
+        self._readiness_gate.wait(self._on_ready)
         Gtk.main()
 
-    def _move_image_window(self, *args):
-        os.system("wmctrl -ir $(wmctrl -l |grep image_window |grep -v grep |cut -d ' ' -f1) -e 0,1200,0,-1,-1")
+    def _on_ready(self, not_ready):
+        '''
+        Starts the session when devices, the monitoring endpoint and the stimulus cache are ready
+        '''
+        self._startup_report.mark("readiness wait")
+        self._startup_report.log()
+        self._events.record("ready", not_ready=not_ready,
+                            ready_times=self._readiness_gate.ready_times)
+        self._session_scheduler.start({"start": self._show_message})
 
     def _show_message(self, *args, message="Start"):
         '''
         Showing a message before each stimuli
         '''
 
-        logging.info("Start time {0}".format(datetime.datetime.now()))
+        self._events.record("message", index=self._index)
         message = \
             MessageButtonWindow("Info", message)
         message.show()
@@ -124,39 +202,72 @@ class BackgroudWindow(Gtk.Window):
         if self._index >= 8:
             message.connect("destroy", self._done)
         else:
-            message.connect("destroy", self._show_fixation_cross)
+            message.connect("destroy", self._start_trial)
+
+    def _start_trial(self, *args):
+        '''
+        Scheduling all phases of a trial from now
+        '''
+        self._end_epoch()
+        self._epoch_index.start_trial(self._index + 1,
+                                      self._stimuli_list[self._index][:-4],
+                                      EMOTIONS[self._stimuli_list[self._index][0]])
+        self._trial_scheduler.start({"fixation_cross": self._show_fixation_cross,
+                                     "stimuli": self._show_stimuli,
+                                     "timer": self._show_timer})
+
+    def _end_epoch(self):
+        '''
+        Writing the finished trial to the epoch index, when its questionnaire is closed
+        '''
+        records = self._trial_scheduler.records
+        self._epoch_index.add_records(records[self._indexed_records:])
+        self._indexed_records = len(records)
+        self._epoch_index.end_trial()
 
     def _show_fixation_cross(self, *args):
         '''
         Showing fixation cross before each stimuli
         '''
-        logging.info("Fixation cross {0}".format(datetime.datetime.now()))
-        self.image_window.set_image("images/fixation_cross.jpg")
-        self.navigator_image_window.set_image("images/fixation_cross.jpg")
+        self._events.record("fixation_cross", stimulus=self._stimuli_list[self._index])
+        self._presenter.set_image("images/fixation_cross.jpg")
+        self.image_window.call_on_present(self._send_start)
+
+    def _send_start(self, presentation_time):
+        '''
+        Sending START marker with the time that fixation cross reached the screen
+        '''
+        self._events.record("fixation_cross_presented", presentation_time,
+                            stimulus=self._stimuli_list[self._index])
+        self._epoch_index.set_time("fixation_presented", presentation_time)
+        self._flush_save()
         message = \
             start_message(self._experiment_id,
-                          self._stimuli_list[self._index][:-4])
+                          self._stimuli_list[self._index][:-4],
+                          payload={"presentation_time": presentation_time})
         self._device_coordinator.dispatch(message)
-
-        GLib.timeout_add_seconds(3, self._show_stimuli)
+        self._events.record("trigger", type="START", stimulus_id=message.stimulus_id)
 
     def _show_stimuli(self, *args):
         '''
         Showing stimuli
         '''
-        logging.info("Stimuli {0} - {1}".format(self._stimuli_list[self._index],
-                                                datetime.datetime.now()))
+        self._events.record("stimuli", stimulus=self._stimuli_list[self._index])
         image_path = STIMULI_PATH + self._stimuli_list[self._index]
-        self.image_window.set_image(image_path)
-        self.navigator_image_window.set_image(image_path)
-        GLib.timeout_add_seconds(6, self._show_timer)
+        self._prefetcher.check(self.image_window.get_cache_key(image_path))
+        self._presenter.set_image(image_path)
+        self.image_window.call_on_present(self._log_stimuli_onset)
+
+    def _log_stimuli_onset(self, presentation_time):
+        self._epoch_index.set_time("stimulus_presented", presentation_time)
+        self._events.record("stimuli_presented", presentation_time,
+                            stimulus=self._stimuli_list[self._index])
 
     def _show_timer(self, *args):
         '''
         Showing timer
         '''
-        logging.info("Start of Conversation {0} - {1}".format(self._stimuli_list[self._index],
-                                                              datetime.datetime.now()))
+        self._events.record("conversation", stimulus=self._stimuli_list[self._index])
 
         image_path = STIMULI_PATH + self._stimuli_list[self._index]
         timer = TimerWindow("Timer", message=EMOTIONS[self._stimuli_list[self._index][0]],
@@ -164,27 +275,80 @@ class BackgroudWindow(Gtk.Window):
                             font_size=20)
         timer.show_window()
         timer.connect("destroy", self._questionnaire)
+        self._prefetch_next_stimuli()
+
+    def _prefetch_next_stimuli(self):
+        '''
+        Loading the next trial's stimuli in background while the current trial is running
+        '''
+        next_index = self._index + 1
+        if next_index >= len(self._stimuli_list):
+            return
+        image_path = STIMULI_PATH + self._stimuli_list[next_index]
+        for window in (self.image_window, self.navigator_image_window):
+            self._prefetcher.prefetch(window.get_cache_key(image_path))
 
     def _questionnaire(self, *args):
+        self._trial_scheduler.mark("questionnaire")
+        stimulus_id = self._stimuli_list[self._index][:-4]
         message = \
-            stop_message(self._experiment_id,
-                         self._stimuli_list[self._index][:-4])
+            stop_message(self._experiment_id, stimulus_id)
         self._device_coordinator.dispatch(message)
+        self._events.record("trigger", type="STOP", stimulus_id=stimulus_id)
+        self._pending_save = (GLib.timeout_add_seconds(SAVE_DELAY, self._save_trial, stimulus_id),
+                              stimulus_id)
         self._index += 1
         self._show_message(message="Please answer the questionnaire.")
 
-    def _done(self, *args):
+    def _save_trial(self, stimulus_id):
+        '''
+        Saving the finished trial's data and preprocessing it in background
+        while the subject answers the questionnaire.
+        Devices clear their buffer after writing it to the file, and samples
+        that are recorded in between are lost. So SAVE is only dispatched
+        between a STOP and the next START, where lost samples are not in a trial.
+        '''
+        self._pending_save = None
+        self._device_coordinator.dispatch(save_message(self._experiment_id))
+        if self._preprocessing_driver is not None:
+            self._preprocessing_driver.start_trial(
+                device_jobs(self._device_coordinator, "preprocessed_output"),
+                self._experiment_id, stimulus_id)
+        self._log_camera_counters()
+        return False
+
+    def _flush_save(self):
+        '''
+        Saving the previous trial now if it is still waiting for SAVE_DELAY
+        '''
+        if self._pending_save is not None:
+            source_id, stimulus_id = self._pending_save
+            GLib.source_remove(source_id)
+            self._save_trial(stimulus_id)
 
+    def _log_camera_counters(self):
+        for device in self._device_coordinator.get_devices():
+            if isinstance(device, SharedMemoryCameraStreaming):
+                logging.info("{0} frames: {1}".format(device.name, device.get_counters()))
+
+    def _done(self, *args):
+        # All trials are already being preprocessed. Only merging them
+        # is left, which main does after the windows are closed.
+        self._end_epoch()
+        self._flush_save()
         self._device_coordinator.terminate()
-        self.image_window.set_image("images/done_image.jpg")
+        self._presenter.set_image("images/done_image.jpg")
         self.image_window.show_and_destroy_window(3)
         self.image_window.connect("destroy", self._terminate)
-        self.navigator_image_window.set_image("images/done_image.jpg")
         self.navigator_image_window.show_and_destroy_window(3)
         self.navigator_image_window.connect("destroy", self._terminate)
 
     def _terminate(self, *args):
+        logging.info("Stimuli prefetch hits: {0}, misses: {1}".format(
+            self._prefetcher.hits, self._prefetcher.misses))
+        self._log_camera_counters()
         logging.info("End time{0}".format(datetime.datetime.now()))
+        self._events.stop()
         self.destroy()
 
 
@@ -192,17 +356,25 @@ def get_input_parameters():
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--subject_id", help="The subject ID", default=0)
     #parser.add_argument("-t", "--task_id", help="The task ID", default=1)
+    parser.add_argument("-b", "--backend", help="The image rendering backend, pixbuf or gl",
+                        choices=["pixbuf", "gl"], default="pixbuf")
+    parser.add_argument("-m", "--monitoring",
+                        help="The monitoring server, endpoint (HTTP polling) or stream "
+                             "(decimated data over WebSocket)",
+                        choices=["endpoint", "stream"], default="endpoint")
     args = parser.parse_args()
     subject_id = args.subject_id
     task_id = 1  # args.task_id
-    return subject_id, task_id
+    return subject_id, task_id, args.backend, args.monitoring
 
 
 def main():
     main_camera = "/dev/v4l/by-id/usb-Intel_R__RealSense_TM__Depth_Camera_415_Intel_R__RealSense_TM__Depth_Camera_415-video-index0"
 
     #main_camera = "/dev/v4l/by-id/usb-046d_081b_97E6A7D0-video-index0"
-    subject_id, task_id = get_input_parameters()
+    startup_report = StartupReport(STARTUP_TIME)
+    startup_report.mark("import")
+    subject_id, task_id, image_backend, monitoring = get_input_parameters()
     experiment_id = str(subject_id).zfill(2) + "-" + str(task_id).zfill(2)
     output_path = "output/p{0}".format(str(subject_id).zfill(2))
     if not os.path.exists(output_path):
@@ -224,30 +396,49 @@ def main():
     
     
     shimmer = Shimmer3Streaming(name="shimmer", output_path=output_path)
-    audio = AudioStreaming(2, name="Audio", output_path=output_path)
+    # The device that check_audio.py recommended, found by its name
+    audio = AudioStreaming(recommended_capture_device(default=2),
+                           name="Audio",
+                           output_path=output_path)
 
     camera = \
-        CameraStreaming(name="webcam",
-                        output_path=output_path,
-                        camera_path=main_camera,
-                        image_width=640,
-                        image_height=480)
-    device_coordinator = DeviceCoordinator()
+        SharedMemoryCameraStreaming(name="webcam",
+                                    output_path=output_path,
+                                    camera_path=main_camera,
+                                    image_width=640,
+                                    image_height=480)
+    device_coordinator = MeteredDeviceCoordinator()
     device_coordinator.add_devices([audio, camera, openbci, shimmer])
-
-    # Make delay for initializing all processes
-    time.sleep(5)
-    monitoring_endpoint = MonitoringEndpoint(device_coordinator)
+    device_metrics = DeviceMetrics(device_coordinator,
+                                   nominal_rates=NOMINAL_RATES,
+                                   port=METRICS_PORT,
+                                   file_path=os.path.join(
+                                       output_path, "metrics-{0}.jsonl".format(experiment_id)))
+    device_metrics.start()
+
+    # The session waits for devices and the endpoint to be ready, instead of a fixed delay
+    if monitoring == "stream":
+        monitoring_endpoint = MonitoringStream(device_coordinator, port=MONITORING_PORT)
+    else:
+        monitoring_endpoint = MonitoringEndpoint(device_coordinator, port=MONITORING_PORT)
     monitoring_endpoint.start()
-    main_window = BackgroudWindow(experiment_id, subject_id, device_coordinator)
+    startup_report.mark("device init")
+    readiness_checks = device_checks(device_coordinator)
+    readiness_checks["monitoring endpoint"] = port_check("localhost", MONITORING_PORT)
+    preprocessing_driver = PreprocessingDriver(openbci_sampling_rate=125,
+                                               shimmer3_sampling_rate=128,
+                                               signal_preprocess=True)
+    main_window = BackgroudWindow(experiment_id, subject_id, device_coordinator,
+                                  preprocessing_driver=preprocessing_driver,
+                                  epoch_index_path=os.path.join(output_path, "epochs.csv"),
+                                  image_backend=image_backend,
+                                  readiness_checks=readiness_checks,
+                                  startup_report=startup_report)
     main_window.show()
     monitoring_endpoint.stop()
-
-    preprocess_devices(device_coordinator,
-                       "preprocessed_output",
-                       openbci_sampling_rate=125,
-                       signal_preprocess=True,
-                       shimmer3_sampling_rate=128)
+    device_metrics.stop()
+    preprocessing_driver.merge()
 
 
-main()
+if __name__ == "__main__":
+    main()
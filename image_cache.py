@@ -0,0 +1,216 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional, Set, Tuple
+
+from gi.repository import GdkPixbuf, GLib
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+
+from prepare_stimuli import find_asset, fit_image
+
+
+# (image path, width, height, monitor number)
+CacheKey = Tuple[str, int, int, int]
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def load_pixbuf(image_path: str, width: int, height: int) -> GdkPixbuf.Pixbuf:
+    '''
+    Reads, decodes and scales an image to the requested size, the same way as
+    pre-resized assets. If an asset is built for the size
+    (prepare_stimuli.py --assets), its pixels are read without decoding or scaling.
+
+    Parameters
+    ----------
+    image_path: str
+        The path of image
+
+    width: int
+        The width of scaled image in pixel
+
+    height: int
+        The height of scaled image in pixel
+
+    Returns
+    -------
+    pixbuf: GdkPixbuf.Pixbuf
+        The decoded image
+    '''
+    asset_path = find_asset(image_path, width, height)
+    if asset_path is not None:
+        with open(asset_path, "rb") as asset_file:
+            pixels = GLib.Bytes.new(asset_file.read())
+        return GdkPixbuf.Pixbuf.new_from_bytes(pixels, GdkPixbuf.Colorspace.RGB,
+                                               False, 8, width, height, width * 3)
+    return fit_image(GdkPixbuf.Pixbuf.new_from_file(image_path), width, height)
+
+
+def pixbuf_size(pixbuf: GdkPixbuf.Pixbuf) -> int:
+    '''
+    Returns the number of bytes that the pixels of a pixbuf take in memory
+    '''
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+class PixbufCache():
+    '''
+    Keeps decoded and scaled images in memory, so showing an image does not
+    need any disk access or JPEG decoding on the GTK main thread.
+    Images are kept by (path, width, height, monitor) and the least recently
+    used ones are evicted when the memory cap is reached.
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    max_bytes: int, default: 512 MB
+        The maximum memory that cached pixels can take
+    '''
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self._max_bytes = max_bytes
+        self._pixbufs: "OrderedDict[CacheKey, GdkPixbuf.Pixbuf]" = OrderedDict()
+        self._size = 0
+
+    def get(self, image_path: str, width: int, height: int,
+            monitor_no: int = 0) -> GdkPixbuf.Pixbuf:
+        '''
+        Returns the cached image. The image will be loaded and cached if
+        it is not in the cache.
+        '''
+        key = (image_path, width, height, monitor_no)
+        pixbuf = self._pixbufs.get(key)
+        if pixbuf is None:
+            logging.debug("Image cache miss {0}".format(image_path))
+            pixbuf = load_pixbuf(image_path, width, height)
+            self.put(key, pixbuf)
+        else:
+            self._pixbufs.move_to_end(key)
+        return pixbuf
+
+    def contains(self, key: CacheKey) -> bool:
+        '''
+        Checks if an image is in the cache
+        '''
+        return key in self._pixbufs
+
+    def put(self, key: CacheKey, pixbuf: GdkPixbuf.Pixbuf) -> None:
+        '''
+        Adds an already loaded image to the cache and evicts the least
+        recently used images if the cache is full
+        '''
+        if key in self._pixbufs:
+            self._size -= pixbuf_size(self._pixbufs.pop(key))
+        self._pixbufs[key] = pixbuf
+        self._size += pixbuf_size(pixbuf)
+
+        # The newest image is always kept, even if it is bigger than the cap
+        while self._size > self._max_bytes and len(self._pixbufs) > 1:
+            old_key, old_pixbuf = self._pixbufs.popitem(last=False)
+            self._size -= pixbuf_size(old_pixbuf)
+            logging.debug("Evicted {0} from the image cache".format(old_key[0]))
+
+    def is_full(self, width: int, height: int) -> bool:
+        '''
+        Checks if one more image of the given size would exceed the memory cap
+        '''
+        # 4 bytes per pixel is an upper bound for RGB(A) pixbufs with padding
+        return self._size + width * height * 4 > self._max_bytes
+
+    def preload(self, image_paths: Iterable[str], width: int, height: int,
+                monitor_no: int = 0) -> int:
+        '''
+        Loads a list of images into the cache. Loading stops when the cache
+        is full, so images at the beginning of the list will be kept.
+
+        Returns
+        -------
+        count: int
+            The number of images that are in the cache
+        '''
+        count = 0
+        for image_path in image_paths:
+            if not self.contains((image_path, width, height, monitor_no)) and \
+                    self.is_full(width, height):
+                logging.warning(
+                    "Image cache is full. {0} and the rest of images will be "
+                    "loaded on demand".format(image_path))
+                break
+            self.get(image_path, width, height, monitor_no)
+            count += 1
+        logging.info("Preloaded {0} images for monitor {1} ({2} MB in cache)".format(
+            count, monitor_no, self._size // (1024 * 1024)))
+        return count
+
+
+class ImagePrefetcher():
+    '''
+    Decodes and scales images in a background thread and adds them to the
+    image cache in the GTK main loop. It is used for loading the next trial's
+    stimulus while the current trial is running, when the whole session
+    does not fit in the cache.
+
+    Attributes
+    ----------
+    hits: int
+        The number of shown images that were ready in the cache
+
+    misses: int
+        The number of shown images that had to be loaded on demand
+
+    Parameters
+    ----------
+    image_cache: PixbufCache
+        The cache that prefetched images will be added to
+    '''
+    def __init__(self, image_cache: PixbufCache):
+        self._image_cache = image_cache
+        # Only accessed from the GTK main thread
+        self._pending: Set[CacheKey] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def prefetch(self, key: CacheKey) -> None:
+        '''
+        Starts loading an image in background if it is not in the cache
+
+        Parameters
+        ----------
+        key: CacheKey
+            The cache key of image, (path, width, height, monitor)
+        '''
+        if self._image_cache.contains(key) or key in self._pending:
+            return
+        self._pending.add(key)
+        thread = threading.Thread(target=self._decode, args=(key,), daemon=True)
+        thread.start()
+
+    def check(self, key: CacheKey) -> bool:
+        '''
+        Counts a hit if the image is ready in the cache, and a miss otherwise.
+        It should be called right before showing the image.
+        '''
+        hit = self._image_cache.contains(key)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        logging.info("Prefetch {0} for {1}. hits: {2}, misses: {3}".format(
+            "hit" if hit else "miss", key[0], self.hits, self.misses))
+        return hit
+
+    def _decode(self, key: CacheKey) -> None:
+        pixbuf: Optional[GdkPixbuf.Pixbuf] = None
+        try:
+            pixbuf = load_pixbuf(key[0], key[1], key[2])
+        except GLib.Error as error:
+            logging.error("Prefetching {0} failed: {1}".format(key[0], error))
+        GLib.idle_add(self._on_decoded, key, pixbuf)
+
+    def _on_decoded(self, key: CacheKey, pixbuf: Optional[GdkPixbuf.Pixbuf]) -> bool:
+        self._pending.discard(key)
+        if pixbuf is not None:
+            self._image_cache.put(key, pixbuf)
+        return False
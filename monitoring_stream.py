@@ -0,0 +1,574 @@
+'''
+A low-cost alternative to MonitoringEndpoint for watching signals during a
+session.
+
+Instead of answering every poll with seconds of full-rate data, it polls the
+device coordinator itself, keeps the last `window` seconds of each device in
+a ring buffer, and pushes compact binary frames to the connected clients
+over one persistent WebSocket connection:
+
+- signals are decimated to the minimum and maximum of fixed-size buckets,
+  about `points` per window, which keeps spikes visible, as float32.
+  A new client receives the whole window once, then only the new buckets.
+- camera frames are downscaled JPEG thumbnails
+
+Devices are not polled while nobody is connected, and the poll interval
+grows when the stream uses more than `cpu_budget` of a core.
+
+Every frame starts with a header in network byte order:
+
+    magic        2s   b"OM"
+    version      B    FORMAT_VERSION
+    kind         B    FRAME_SIGNAL, FRAME_SIGNAL_UPDATE or FRAME_THUMBNAIL
+    device       16s  UTF-8, zero padded
+    time         d    Unix time of the frame
+
+A signal frame continues with the sampling rate (f), the number of samples
+in a bucket (H), the number of channels (H) and buckets (H), then float32
+values with the shape of (channels, buckets, 2). FRAME_SIGNAL replaces the
+client's window of a device and FRAME_SIGNAL_UPDATE is appended to it.
+A thumbnail frame continues with its width (H) and height (H), then the JPEG.
+'''
+
+import math
+import time
+import base64
+import socket
+import struct
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+MAGIC = b"OM"
+FORMAT_VERSION = 1
+FRAME_SIGNAL = 1
+FRAME_THUMBNAIL = 2
+FRAME_SIGNAL_UPDATE = 3
+
+ID_SIZE = 16
+_HEADER = struct.Struct("!2sBB{0}sd".format(ID_SIZE))
+_SIGNAL_HEADER = struct.Struct("!fHHH")
+_THUMBNAIL_HEADER = struct.Struct("!HH")
+
+# Audio records are raw 16 bit chunks without a sampling rate in older octopus_sensing versions
+AUDIO_SAMPLING_RATE = 44100
+
+_WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class RingBuffer():
+    '''
+    Keeps the last `capacity` rows of a (rows, channels) signal
+    '''
+    def __init__(self, capacity: int, channels: int):
+        self._data = np.zeros((capacity, channels), dtype=np.float32)
+        self._position = 0
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def channels(self) -> int:
+        return self._data.shape[1]
+
+    def extend(self, rows: np.ndarray) -> None:
+        capacity = len(self._data)
+        rows = rows[-capacity:]
+        count = len(rows)
+        end = self._position + count
+        if end <= capacity:
+            self._data[self._position:end] = rows
+        else:
+            split = capacity - self._position
+            self._data[self._position:] = rows[:split]
+            self._data[:count - split] = rows[split:]
+        self._position = end % capacity
+        self._size = min(capacity, self._size + count)
+
+    def latest(self) -> np.ndarray:
+        '''
+        Returns the stored rows from the oldest to the newest
+        '''
+        return self.tail(self._size)
+
+    def tail(self, count: int) -> np.ndarray:
+        '''
+        Returns a copy of the newest `count` rows, from the oldest to the newest
+        '''
+        count = min(count, self._size)
+        start = self._position - count
+        if start >= 0:
+            return self._data[start:self._position].copy()
+        return np.concatenate([self._data[start:], self._data[:self._position]])
+
+
+def decimate_min_max(data: np.ndarray, bucket_size: int) -> np.ndarray:
+    '''
+    Reduces a (rows, channels) signal to the minimum and maximum of each
+    bucket of `bucket_size` rows, with the shape of (channels, buckets, 2).
+    Rows after the last complete bucket are ignored, and NaNs are skipped.
+    '''
+    buckets = len(data) // bucket_size
+    data = data[:buckets * bucket_size].reshape(buckets, bucket_size, data.shape[1])
+    return np.stack([np.fmin.reduce(data, axis=1).T,
+                     np.fmax.reduce(data, axis=1).T], axis=2).astype(np.float32)
+
+
+def encode_signal_frame(device: str, unix_time: float, sampling_rate: float,
+                        bucket_size: int, envelope: np.ndarray,
+                        kind: int = FRAME_SIGNAL) -> bytes:
+    channels, buckets, _ = envelope.shape
+    return (_HEADER.pack(MAGIC, FORMAT_VERSION, kind,
+                         device.encode("utf-8")[:ID_SIZE], unix_time) +
+            _SIGNAL_HEADER.pack(sampling_rate, bucket_size, channels, buckets) +
+            envelope.astype(">f4").tobytes())
+
+
+def encode_thumbnail_frame(device: str, unix_time: float, width: int, height: int,
+                           jpeg: bytes) -> bytes:
+    return (_HEADER.pack(MAGIC, FORMAT_VERSION, FRAME_THUMBNAIL,
+                         device.encode("utf-8")[:ID_SIZE], unix_time) +
+            _THUMBNAIL_HEADER.pack(width, height) + jpeg)
+
+
+def decode_frame(frame: bytes) -> Dict[str, Any]:
+    '''
+    Decodes a frame to a dictionary with `kind`, `device` and `time` keys, and
+    `sampling_rate`, `bucket_size` and `envelope` for signals or `width`,
+    `height` and `jpeg` for thumbnails
+
+    Raises
+    ------
+    ValueError
+        If it is not a monitoring frame
+    '''
+    magic, version, kind, device, unix_time = _HEADER.unpack_from(frame)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("Not a monitoring frame of version {0}".format(FORMAT_VERSION))
+    decoded: Dict[str, Any] = {"kind": kind,
+                               "device": device.rstrip(b"\0").decode("utf-8"),
+                               "time": unix_time}
+    offset = _HEADER.size
+    if kind in (FRAME_SIGNAL, FRAME_SIGNAL_UPDATE):
+        sampling_rate, bucket_size, channels, buckets = \
+            _SIGNAL_HEADER.unpack_from(frame, offset)
+        decoded["sampling_rate"] = sampling_rate
+        decoded["bucket_size"] = bucket_size
+        decoded["envelope"] = np.frombuffer(frame, dtype=">f4",
+                                            offset=offset + _SIGNAL_HEADER.size) \
+            .reshape(channels, buckets, 2)
+    elif kind == FRAME_THUMBNAIL:
+        decoded["width"], decoded["height"] = _THUMBNAIL_HEADER.unpack_from(frame, offset)
+        decoded["jpeg"] = frame[offset + _THUMBNAIL_HEADER.size:]
+    else:
+        raise ValueError("Unknown frame kind {0}".format(kind))
+    return decoded
+
+
+def _websocket_frame(payload: bytes) -> bytes:
+    '''
+    Wraps a payload in an unmasked binary WebSocket frame
+    '''
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x82, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x82, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x82, 127, length)
+    return header + payload
+
+
+def same_record(first: Any, second: Any) -> bool:
+    if isinstance(first, np.ndarray) or isinstance(second, np.ndarray):
+        return np.array_equal(np.asarray(first, dtype=object), np.asarray(second, dtype=object))
+    return bool(first == second)
+
+
+class RealtimeDataPoller():
+    '''
+    Polls the realtime data of a device coordinator for consumers that
+    process each record once, like MonitoringStream and DeviceMetrics
+
+    Attributes
+    ----------
+    duration: int
+        The duration in seconds of realtime data that the last poll requested
+
+    Parameters
+    ----------
+    device_coordinator: DeviceCoordinator
+        An instance of DeviceCoordinator class
+
+    window: int
+        The duration in seconds of the first poll, and the maximum duration
+    '''
+    def __init__(self, device_coordinator, window: int):
+        self._device_coordinator = device_coordinator
+        self._window = window
+        self._last_poll_time: Optional[float] = None
+        self._last_records: Dict[str, Any] = {}
+        self.duration = window
+
+    def poll(self) -> Dict[str, Tuple[List[Any], Dict[str, Any]]]:
+        '''
+        Requests enough data to cover the time since the last poll, with a
+        second to spare
+
+        Returns
+        -------
+        realtime_data: Dict[str, Tuple[List[Any], Dict[str, Any]]]
+            (records, metadata) of each device
+        '''
+        now = time.monotonic()
+        if self._last_poll_time is None:
+            self.duration = self._window
+        else:
+            self.duration = min(self._window,
+                                max(1, math.ceil(now - self._last_poll_time) + 1))
+        self._last_poll_time = now
+        realtime_data = self._device_coordinator.get_realtime_data(self.duration, None)
+        return {device: (data.get("data") or [], data.get("metadata") or {})
+                for device, data in realtime_data.items()}
+
+    def new_records(self, device: str, records: List[Any]) -> List[Any]:
+        '''
+        Drops the records of a device that were in the previous poll
+        '''
+        if not records:
+            return records
+        last_record = self._last_records.get(device)
+        self._last_records[device] = records[-1]
+        if last_record is None:
+            return records
+        for index in range(len(records) - 1, -1, -1):
+            if same_record(records[index], last_record):
+                return records[index + 1:]
+        return records
+
+    def reset(self) -> None:
+        self._last_poll_time = None
+        self._last_records = {}
+
+
+def _to_rows(records: List[Any]) -> np.ndarray:
+    '''
+    Converts records to a (rows, channels) float32 array. Non-numeric values,
+    e.g. triggers, are NaN.
+    '''
+    if isinstance(records[0], bytes):
+        return np.frombuffer(b"".join(records), dtype="<i2") \
+            .astype(np.float32)[:, np.newaxis]
+    try:
+        return np.asarray(records, dtype=np.float32).reshape(len(records), -1)
+    except (TypeError, ValueError):
+        pass
+    rows = np.full((len(records), max(len(record) for record in records)), np.nan,
+                   dtype=np.float32)
+    for row_index, record in enumerate(records):
+        for column, value in enumerate(record):
+            try:
+                rows[row_index, column] = float(value)
+            except (TypeError, ValueError):
+                pass
+    return rows
+
+
+class MonitoringStream():
+    '''
+    Streams decimated device data to monitoring clients over WebSocket
+
+    Attributes
+    ----------
+    bytes_sent: int
+        The number of sent bytes, for all clients
+
+    Parameters
+    ----------
+    device_coordinator: DeviceCoordinator
+        An instance of DeviceCoordinator class
+
+    port: int, default: 9330
+        TCP port to listen on
+
+    window: int, default: 5
+        The length of signal windows in seconds
+
+    points: int, default: 400
+        The number of min/max pairs of each channel in a window. Devices with
+        fewer samples in a window are not decimated
+
+    interval: float, default: 0.5
+        The time in seconds between frames
+
+    thumbnail_width: int, default: 160
+        The maximum width of camera thumbnails
+
+    thumbnail_interval: float, default: 1
+        The time in seconds between camera thumbnails
+
+    jpeg_quality: int, default: 60
+
+    cpu_budget: float, default: 0.05
+        The maximum share of a CPU core that polling and encoding may use
+
+    Example
+    -------
+    >>> monitoring_stream = MonitoringStream(device_coordinator, port=9330)
+    >>> monitoring_stream.start()
+    >>> # In the browser: new WebSocket("ws://{ip}:9330"), binaryType = "arraybuffer"
+    >>> monitoring_stream.stop()
+    '''
+    def __init__(self, device_coordinator, port: int = 9330, window: int = 5,
+                 points: int = 400, interval: float = 0.5, thumbnail_width: int = 160,
+                 thumbnail_interval: float = 1, jpeg_quality: int = 60,
+                 cpu_budget: float = 0.05):
+        self._device_coordinator = device_coordinator
+        self._window = window
+        self._points = points
+        self._interval = interval
+        self._thumbnail_width = thumbnail_width
+        self._thumbnail_interval = thumbnail_interval
+        self._jpeg_quality = jpeg_quality
+        self._cpu_budget = cpu_budget
+        self._buffers: Dict[str, RingBuffer] = {}
+        self._sampling_rates: Dict[str, float] = {}
+        self._bucket_sizes: Dict[str, int] = {}
+        # The number of rows of each device that are not sent yet
+        self._unsent: Dict[str, int] = {}
+        self._poller = RealtimeDataPoller(device_coordinator, window)
+        self._last_thumbnail_time = 0.0
+        self._clients: List[socket.socket] = []
+        # Clients that receive whole windows before they join the stream
+        self._new_clients: List[socket.socket] = []
+        self._clients_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self.bytes_sent = 0
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(("", port))
+        self._socket.listen()
+
+        if cv2 is None:
+            logging.warning("OpenCV is not installed. Camera thumbnails are disabled")
+
+    def get_port(self) -> int:
+        return self._socket.getsockname()[1]
+
+    def start(self) -> None:
+        '''
+        Starts accepting clients and streaming in background threads
+        '''
+        self._threads = [
+            threading.Thread(target=self._accept, name="MonitoringStream-Accept", daemon=True),
+            threading.Thread(target=self._stream, name="MonitoringStream-Stream", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        '''
+        Stops streaming and closes all connections
+        '''
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join()
+        self._socket.close()
+        with self._clients_lock:
+            for client in self._clients + self._new_clients:
+                client.close()
+            self._clients = []
+            self._new_clients = []
+
+    def _accept(self) -> None:
+        self._socket.settimeout(0.5)
+        while not self._stop_event.is_set():
+            try:
+                client, address = self._socket.accept()
+            except socket.timeout:
+                continue
+            try:
+                self._handshake(client)
+            except ConnectionAbortedError:
+                # Readiness checks (port_check) connect and close without a request
+                logging.debug("Monitoring client {0} closed before the handshake".format(address))
+                client.close()
+                continue
+            except (OSError, ValueError) as error:
+                logging.error("Monitoring client {0} failed: {1}".format(address, error))
+                client.close()
+                continue
+            logging.info("Monitoring client {0} connected".format(address))
+            with self._clients_lock:
+                self._new_clients.append(client)
+
+    @staticmethod
+    def _handshake(client: socket.socket) -> None:
+        client.settimeout(2)
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = client.recv(4096)
+            if not chunk and not request:
+                raise ConnectionAbortedError("Closed without a request")
+            if not chunk or len(request) > 65536:
+                raise ValueError("Incomplete WebSocket handshake")
+            request += chunk
+        key = None
+        for line in request.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"sec-websocket-key":
+                key = value.strip()
+        if key is None:
+            client.sendall(b"HTTP/1.1 426 Upgrade Required\r\nUpgrade: websocket\r\n\r\n")
+            raise ValueError("Not a WebSocket request")
+        accept = base64.b64encode(hashlib.sha1(key + _WEBSOCKET_GUID).digest())
+        client.sendall(b"HTTP/1.1 101 Switching Protocols\r\n"
+                       b"Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                       b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        # A client that does not read frames for a second is dropped
+        client.settimeout(1)
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _stream(self) -> None:
+        while not self._stop_event.is_set():
+            with self._clients_lock:
+                clients = list(self._clients)
+                new_clients = self._new_clients
+                self._new_clients = []
+            if not clients and not new_clients:
+                # Devices are not polled when nobody is watching
+                self._reset()
+                self._stop_event.wait(self._interval)
+                continue
+
+            start = time.monotonic()
+            cpu_start = time.thread_time()
+            try:
+                frames = self._poll()
+            except Exception as error:
+                logging.error("Monitoring poll failed: {0}".format(error))
+                frames = []
+            self._send(clients, frames)
+            if new_clients:
+                window_frames = [self._window_frame(device) for device in self._buffers]
+                self._send(new_clients, [frame for frame in window_frames if frame is not None])
+                with self._clients_lock:
+                    self._clients.extend(client for client in new_clients
+                                         if client.fileno() != -1)
+            cpu_time = time.thread_time() - cpu_start
+
+            # Waits at least long enough to keep the CPU use under the budget
+            delay = max(self._interval, cpu_time / self._cpu_budget)
+            if delay > self._interval:
+                logging.debug("Monitoring is throttled to {0:.2f} s".format(delay))
+            self._stop_event.wait(max(0, delay - (time.monotonic() - start)))
+
+    def _reset(self) -> None:
+        self._poller.reset()
+        self._buffers = {}
+        self._unsent = {}
+
+    def _poll(self) -> List[bytes]:
+        now = time.monotonic()
+        realtime_data = self._poller.poll()
+
+        frames = []
+        unix_time = time.time()
+        send_thumbnails = now - self._last_thumbnail_time >= self._thumbnail_interval
+        for device, (data, metadata) in realtime_data.items():
+            if not data:
+                continue
+            if isinstance(data[-1], np.ndarray) and data[-1].ndim == 3:
+                if send_thumbnails:
+                    frame = self._thumbnail(device, unix_time, data[-1])
+                    if frame is not None:
+                        frames.append(frame)
+                continue
+            records = self._poller.new_records(device, data)
+            if not records:
+                continue
+            rows = _to_rows(records)
+            buffer = self._buffer(device, rows, metadata, data, self._poller.duration)
+            buffer.extend(rows)
+            # Complete buckets since the last frame
+            bucket_size = self._bucket_sizes[device]
+            unsent = min(self._unsent[device] + len(rows), len(buffer))
+            buckets = unsent // bucket_size
+            self._unsent[device] = unsent - buckets * bucket_size
+            if buckets > 0:
+                frames.append(encode_signal_frame(
+                    device, unix_time, self._sampling_rates[device], bucket_size,
+                    decimate_min_max(buffer.tail(unsent), bucket_size),
+                    kind=FRAME_SIGNAL_UPDATE))
+        if send_thumbnails:
+            self._last_thumbnail_time = now
+        return frames
+
+    def _buffer(self, device: str, rows: np.ndarray, metadata: Dict[str, Any],
+                records: List[Any], duration: int) -> RingBuffer:
+        buffer = self._buffers.get(device)
+        if buffer is not None and buffer.channels == rows.shape[1]:
+            return buffer
+        sampling_rate = metadata.get("sampling_rate")
+        if sampling_rate is None:
+            if isinstance(records[-1], bytes):
+                sampling_rate = AUDIO_SAMPLING_RATE
+            else:
+                # The coordinator returned `duration` seconds of records
+                sampling_rate = max(1, len(records) // duration)
+        self._sampling_rates[device] = sampling_rate
+        self._bucket_sizes[device] = max(1, math.ceil(sampling_rate * self._window / self._points))
+        self._unsent[device] = 0
+        buffer = RingBuffer(int(sampling_rate * self._window), rows.shape[1])
+        self._buffers[device] = buffer
+        return buffer
+
+    def _window_frame(self, device: str) -> Optional[bytes]:
+        '''
+        Makes a frame of a device's whole window, up to the last sent bucket
+        '''
+        rows = self._buffers[device].latest()
+        rows = rows[:len(rows) - self._unsent[device]]
+        bucket_size = self._bucket_sizes[device]
+        if len(rows) < bucket_size:
+            return None
+        rows = rows[len(rows) % bucket_size:]
+        return encode_signal_frame(device, time.time(), self._sampling_rates[device],
+                                   bucket_size, decimate_min_max(rows, bucket_size))
+
+    def _thumbnail(self, device: str, unix_time: float, image: np.ndarray) -> Optional[bytes]:
+        if cv2 is None:
+            return None
+        step = max(1, math.ceil(image.shape[1] / self._thumbnail_width))
+        thumbnail = np.ascontiguousarray(image[::step, ::step])
+        encoded, jpeg = cv2.imencode(".jpg", thumbnail,
+                                     [cv2.IMWRITE_JPEG_QUALITY, self._jpeg_quality])
+        if not encoded:
+            return None
+        return encode_thumbnail_frame(device, unix_time, thumbnail.shape[1],
+                                      thumbnail.shape[0], jpeg.tobytes())
+
+    def _send(self, clients: List[socket.socket], frames: List[bytes]) -> None:
+        if not frames:
+            return
+        message = b"".join(_websocket_frame(frame) for frame in frames)
+        for client in clients:
+            try:
+                client.sendall(message)
+                self.bytes_sent += len(message)
+            except OSError as error:
+                logging.info("Monitoring client disconnected: {0}".format(error))
+                client.close()
+                with self._clients_lock:
+                    if client in self._clients:
+                        self._clients.remove(client)
@@ -1,11 +1,39 @@
 import os
+import sys
+import math
+import json
 import random
 import csv
+import struct
+import hashlib
 import argparse
-from typing import List
+import concurrent.futures
+from typing import Any, Dict, List, Optional, Tuple
 
 import pathlib
 
+# Stimulus ID: category, path, hash and dimensions, built by build_manifest
+MANIFEST_PATH = "stimuli/manifest.json"
+STIMULI_PATH = "stimuli/all_images"
+# The first digit of a stimulus ID is its category, the same as EMOTIONS
+CATEGORIES = {"1": "hvha",
+              "2": "hvla",
+              "3": "lvha",
+              "4": "lvla"}
+
+# Stimuli orders of a cohort, built by generate_cohort_orders
+ORDERS_PATH = "stimuli/orders.json"
+CONDITIONS = ["f2f", "remote"]
+# The number of stimuli of each category in each condition
+STIMULI_PER_CATEGORY = 2
+
+# Pre-resized images for each display resolution, built by build_assets
+ASSETS_PATH = "stimuli/assets"
+ASSET_INDEX_PATH = os.path.join(ASSETS_PATH, "index.json")
+ASSET_SOURCES = [STIMULI_PATH, "images"]
+ASSET_BACKGROUND = "images/gray_image.jpg"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
 def prepare_stimuli_list(subject_id: str):
     '''
     Prepare stimuli order for two settings
@@ -15,12 +43,14 @@ def prepare_stimuli_list(subject_id: str):
     subject_id: str
         A unique ID for each sucject(participant)
     '''
-    path = "stimuli/stimuli_categories"
-    categories = os.listdir(path)
-    categories.sort()
+    categories: Dict[str, List[str]] = {}
+    for stimulus in load_manifest().values():
+        if stimulus["selected"]:
+            categories.setdefault(stimulus["category"], []).append(
+                os.path.basename(stimulus["path"]))
     random_categories = []
-    for category in categories:
-        files = os.listdir(os.path.join(path, category))
+    for category in sorted(categories):
+        files = sorted(categories[category])
         random.shuffle(files)
         random_categories.append(files)
     random.shuffle(random_categories)
@@ -50,10 +80,456 @@ def prepare_stimuli_list(subject_id: str):
             csv_writer.writerow([stimuli])
     
 
+
+_manifest: Optional[Dict[str, Dict]] = None
+
+
+def load_manifest() -> Dict[str, Dict]:
+    '''
+    Reads the stimulus manifest once
+
+    Returns
+    -------
+    stimuli: Dict[str, Dict]
+        {stimulus ID: {"category", "path", "hash", "width", "height", "selected"}}.
+        Only selected stimuli are used in stimuli orders.
+    '''
+    global _manifest
+    if _manifest is None:
+        with open(MANIFEST_PATH, "r") as manifest_file:
+            _manifest = json.load(manifest_file)["stimuli"]
+    return _manifest
+
+
+def get_stimulus_file(stimulus_id: str) -> str:
+    '''
+    Returns the file name of a stimulus, e.g. 11.jpg
+
+    Raises
+    ------
+    KeyError
+        If the stimulus is not in the manifest
+    '''
+    return os.path.basename(load_manifest()[stimulus_id]["path"])
+
+
+def balanced_latin_square(size: int) -> List[List[int]]:
+    '''
+    Returns a Williams design: each row is the order of items for one subject.
+    Each item is in each position once, and for even sizes, each item
+    follows every other item once.
+    '''
+    first_row = [0]
+    low, high = 1, size - 1
+    for position in range(1, size):
+        if position % 2 == 1:
+            first_row.append(low)
+            low += 1
+        else:
+            first_row.append(high)
+            high -= 1
+    return [[(item + row) % size for item in first_row] for row in range(size)]
+
+
+def generate_cohort_orders(subject_count: int, seed: int = 0,
+                           first_subject: int = 1) -> Dict[str, Dict[str, List[str]]]:
+    '''
+    Makes the stimuli orders of a cohort in one pass and writes them to ORDERS_PATH.
+    The order of categories is counterbalanced with a balanced Latin square,
+    with a different row for each condition. The selected stimuli of each
+    category are split into two sets that alternate between the f2f and
+    remote conditions, and the order in each set alternates too. So every
+    stimulus appears equally often in each condition and position when
+    subject_count is a multiple of the cycle length (4 for 4 categories).
+
+    Parameters
+    ----------
+    subject_count: int
+        The number of subjects
+
+    seed: int, default: 0
+        The same seed makes the same orders
+
+    first_subject: int, default: 1
+        The ID of the first subject
+
+    Returns
+    -------
+    orders: Dict[str, Dict[str, List[str]]]
+        {subject ID: {condition: stimulus IDs}}
+    '''
+    random_generator = random.Random(seed)
+    categories: Dict[str, List[str]] = {}
+    for stimulus_id, stimulus in sorted(load_manifest().items()):
+        if stimulus["selected"]:
+            categories.setdefault(stimulus["category"], []).append(stimulus_id)
+    category_names = sorted(categories)
+    random_generator.shuffle(category_names)
+    for category in category_names:
+        if len(categories[category]) != 2 * STIMULI_PER_CATEGORY:
+            raise ValueError("Category {0} should have {1} selected stimuli".format(
+                category, 2 * STIMULI_PER_CATEGORY))
+        random_generator.shuffle(categories[category])
+
+    square = balanced_latin_square(len(category_names))
+    cycle = math.lcm(len(square), 4)
+    if subject_count % cycle != 0:
+        print("Warning: {0} subjects is not a multiple of {1}. "
+              "Stimuli will not be fully balanced".format(subject_count, cycle))
+    orders = {}
+    for index in range(subject_count):
+        rows = {"f2f": square[index % len(square)],
+                "remote": square[(index + len(square) // 2) % len(square)]}
+        subject_order = {}
+        for condition_no, condition in enumerate(CONDITIONS):
+            stimuli = []
+            for category_no in rows[condition]:
+                category_stimuli = categories[category_names[category_no]]
+                stimulus_set = (condition_no + index) % 2
+                selected = category_stimuli[stimulus_set * STIMULI_PER_CATEGORY:
+                                            (stimulus_set + 1) * STIMULI_PER_CATEGORY]
+                if (index // 2) % 2 == 1:
+                    selected = selected[::-1]
+                stimuli.extend(selected)
+            subject_order[condition] = stimuli
+        orders[str(first_subject + index).zfill(2)] = subject_order
+
+    with open(ORDERS_PATH, "w") as orders_file:
+        json.dump({"seed": seed, "subjects": orders}, orders_file, separators=(",", ":"))
+    global _orders
+    _orders = orders
+    return orders
+
+
+def check_balance(orders: Dict[str, Dict[str, List[str]]]) -> List[str]:
+    '''
+    Checks that every selected stimulus appears equally often in each condition
+    and in each position of the orders
+
+    Returns
+    -------
+    problems: List[str]
+        An empty list if orders are balanced
+    '''
+    selected = sorted(stimulus_id for stimulus_id, stimulus in load_manifest().items()
+                      if stimulus["selected"])
+    problems = []
+    for condition in CONDITIONS:
+        counts = {stimulus_id: 0 for stimulus_id in selected}
+        position_counts: Dict[Tuple[str, int], int] = {}
+        for subject_order in orders.values():
+            for position, stimulus_id in enumerate(subject_order[condition]):
+                counts[stimulus_id] += 1
+                category = stimulus_id[0]
+                position_counts[(category, position)] = \
+                    position_counts.get((category, position), 0) + 1
+        if len(set(counts.values())) > 1:
+            problems.append("{0}: stimuli appear {1} to {2} times".format(
+                condition, min(counts.values()), max(counts.values())))
+        if len(set(position_counts.values())) > 1:
+            problems.append("{0}: categories appear {1} to {2} times in a position".format(
+                condition, min(position_counts.values()), max(position_counts.values())))
+    return problems
+
+
+_orders: Optional[Dict[str, Dict[str, List[str]]]] = None
+
+
+def read_cohort_order(subject_id: str, condition: str) -> Optional[List[str]]:
+    '''
+    Returns a subject's stimuli order from the cohort orders as file names,
+    or None if the subject is not in the cohort
+
+    Parameters
+    ----------
+    condition: str
+        f2f or remote
+    '''
+    global _orders
+    if _orders is None:
+        if not os.path.exists(ORDERS_PATH):
+            return None
+        with open(ORDERS_PATH, "r") as orders_file:
+            _orders = json.load(orders_file)["subjects"]
+    subject_order = _orders.get(str(subject_id).zfill(2))
+    if subject_order is None:
+        return None
+    return [get_stimulus_file(stimulus_id) for stimulus_id in subject_order[condition]]
+
+
+def _image_size(image_path: str) -> Tuple[int, int]:
+    '''
+    Reads the width and height of a JPEG or PNG image from its header
+    '''
+    with open(image_path, "rb") as image_file:
+        data = image_file.read(26)
+        if data[:8] == b"\x89PNG\r\n\x1a\n":
+            return struct.unpack(">II", data[16:24])
+        if data[:2] != b"\xff\xd8":
+            raise ValueError("{0} is not a JPEG or PNG image".format(image_path))
+        image_file.seek(2)
+        while True:
+            marker, length = struct.unpack(">2sH", image_file.read(4))
+            # Start of frame markers, except DHT (C4), JPG (C8) and DAC (CC)
+            if marker[0] == 0xff and 0xc0 <= marker[1] <= 0xcf and \
+                    marker[1] not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack(">xHH", image_file.read(5))
+                return width, height
+            image_file.seek(length - 2, os.SEEK_CUR)
+
+
+def build_manifest(stimuli_path: str = STIMULI_PATH) -> Dict[str, Dict]:
+    '''
+    Writes the stimulus manifest from the images of a folder. Images are
+    named by stimulus ID. The selection of existing stimuli is kept, and
+    new stimuli are not selected.
+    '''
+    previous = load_manifest() if os.path.exists(MANIFEST_PATH) else {}
+    stimuli = {}
+    for name in sorted(os.listdir(stimuli_path)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        stimulus_id = os.path.splitext(name)[0]
+        image_path = os.path.join(stimuli_path, name)
+        width, height = _image_size(image_path)
+        stimuli[stimulus_id] = {"category": CATEGORIES[stimulus_id[0]],
+                                "path": image_path,
+                                "hash": _file_hash(image_path),
+                                "width": width,
+                                "height": height,
+                                "selected": previous.get(stimulus_id, {}).get("selected", False)}
+    with open(MANIFEST_PATH, "w") as manifest_file:
+        json.dump({"stimuli": stimuli}, manifest_file, indent=1)
+    global _manifest
+    _manifest = stimuli
+    return stimuli
+
+
+def _file_hash(file_path: str) -> str:
+    content_hash = hashlib.sha256()
+    with open(file_path, "rb") as image_file:
+        for block in iter(lambda: image_file.read(1024 * 1024), b""):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def get_asset_path(content_hash: str, width: int, height: int) -> str:
+    '''
+    Returns the path of an image's pixels for a display resolution.
+    Assets are raw 8-bit RGB rows without padding, width * height * 3 bytes.
+    '''
+    return os.path.join(ASSETS_PATH, "{0}x{1}".format(width, height), content_hash + ".rgb")
+
+
+def _read_asset_index() -> Dict:
+    if not os.path.exists(ASSET_INDEX_PATH):
+        return {"images": {}, "resolutions": []}
+    with open(ASSET_INDEX_PATH, "r") as index_file:
+        return json.load(index_file)
+
+
+# Backgrounds scaled to a display resolution by (path, width, height, interpolation)
+_backgrounds: Dict[Tuple[str, int, int, Any], Any] = {}
+
+
+def fit_image(source, width: int, height: int, background_path: str = ASSET_BACKGROUND,
+              high_quality: bool = False):
+    '''
+    Scales a decoded image (GdkPixbuf.Pixbuf) to fit a display resolution,
+    keeping its aspect ratio, on top of the background image. Assets and
+    images that are scaled when they are shown both use it, so they have the
+    same geometry. The scaled background is decoded once and copied for later images.
+
+    Parameters
+    ----------
+    high_quality: bool, default: False
+        If True, HYPER interpolation is used, which is too slow for the GTK
+        thread. Otherwise BILINEAR
+    '''
+    import gi
+    gi.require_version('GdkPixbuf', '2.0')
+    from gi.repository import GdkPixbuf
+
+    interpolation = GdkPixbuf.InterpType.HYPER if high_quality else GdkPixbuf.InterpType.BILINEAR
+    key = (background_path, width, height, interpolation)
+    background = _backgrounds.get(key)
+    if background is None:
+        background = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, width, height)
+        source_background = GdkPixbuf.Pixbuf.new_from_file(background_path)
+        source_background.composite(background, 0, 0, width, height, 0, 0,
+                                    width / source_background.get_width(),
+                                    height / source_background.get_height(),
+                                    interpolation, 255)
+        _backgrounds[key] = background
+    canvas = background.copy()
+    scale = min(width / source.get_width(), height / source.get_height())
+    scaled_width = max(1, round(source.get_width() * scale))
+    scaled_height = max(1, round(source.get_height() * scale))
+    x = (width - scaled_width) // 2
+    y = (height - scaled_height) // 2
+    source.composite(canvas, x, y, scaled_width, scaled_height, x, y, scale, scale,
+                     interpolation, 255)
+    return canvas
+
+
+def convert_asset(image_path: str, width: int, height: int, output_path: str,
+                  background_path: str = ASSET_BACKGROUND) -> None:
+    '''
+    Fits an image to a display resolution with fit_image, in high quality,
+    and writes its raw RGB pixels. It runs in a worker process.
+    '''
+    import gi
+    gi.require_version('GdkPixbuf', '2.0')
+    from gi.repository import GdkPixbuf
+
+    canvas = fit_image(GdkPixbuf.Pixbuf.new_from_file(image_path), width, height,
+                       background_path, high_quality=True)
+    pixels = canvas.read_pixel_bytes().get_data()
+    rowstride = canvas.get_rowstride()
+    if rowstride != width * 3:
+        pixels = b"".join(pixels[row * rowstride:row * rowstride + width * 3]
+                          for row in range(height))
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    temporary_path = output_path + ".tmp"
+    with open(temporary_path, "wb") as asset_file:
+        asset_file.write(pixels)
+    os.replace(temporary_path, output_path)
+
+
+def build_assets(resolutions: List[Tuple[int, int]],
+                 sources: List[str] = ASSET_SOURCES,
+                 max_workers: Optional[int] = None,
+                 force: bool = False) -> int:
+    '''
+    Builds pre-resized images of all source images for each display resolution.
+    Assets are named by the hash of the source content, so renamed or copied
+    images are converted once, and unchanged images are skipped on rebuild.
+    Conversions run in parallel in worker processes.
+
+    Parameters
+    ----------
+    resolutions: List[Tuple[int, int]]
+        (width, height) of the displays
+
+    sources: List[str]
+        Folders of source images
+
+    max_workers: int, default: None
+        The number of worker processes. By default it is the number of CPUs
+
+    force: bool, default: False
+        If True all assets are converted again, e.g. after changing the background
+
+    Returns
+    -------
+    count: int
+        The number of converted assets
+    '''
+    index = _read_asset_index()
+    previous_images = index["images"]
+    images = {}
+    jobs = []
+    for source in sources:
+        for name in sorted(os.listdir(source)):
+            image_path = os.path.normpath(os.path.join(source, name))
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            stat = os.stat(image_path)
+            entry = previous_images.get(image_path)
+            # Hashing is skipped if the file is not changed since the last build
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                entry = {"hash": _file_hash(image_path),
+                         "size": stat.st_size,
+                         "mtime": stat.st_mtime}
+            images[image_path] = entry
+            for width, height in resolutions:
+                asset_path = get_asset_path(entry["hash"], width, height)
+                if force or not os.path.exists(asset_path):
+                    jobs.append((image_path, width, height, asset_path))
+    # Images with the same content are converted once
+    jobs = list({job[3]: job for job in jobs}.values())
+
+    count = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(convert_asset, *job): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            image_path, width, height, _ = futures[future]
+            try:
+                future.result()
+                count += 1
+            except Exception as error:
+                print("Converting {0} to {1}x{2} failed: {3}".format(image_path, width, height, error))
+
+    resolutions = sorted(set(tuple(resolution) for resolution in index["resolutions"]) |
+                         set(resolutions))
+    os.makedirs(ASSETS_PATH, exist_ok=True)
+    with open(ASSET_INDEX_PATH + ".tmp", "w") as index_file:
+        json.dump({"images": images, "resolutions": resolutions}, index_file, indent=1)
+    os.replace(ASSET_INDEX_PATH + ".tmp", ASSET_INDEX_PATH)
+    print("Converted {0} assets for {1}".format(
+        count, ", ".join("{0}x{1}".format(*resolution) for resolution in resolutions)))
+    return count
+
+
+_asset_images: Optional[Dict[str, Dict]] = None
+
+
+def find_asset(image_path: str, width: int, height: int) -> Optional[str]:
+    '''
+    Returns the path of a pre-resized image, or None if it is not built for
+    the resolution or the source image is changed after the build
+    '''
+    global _asset_images
+    if _asset_images is None:
+        _asset_images = _read_asset_index()["images"]
+    image_path = os.path.normpath(image_path)
+    entry = _asset_images.get(image_path)
+    if entry is None:
+        return None
+    try:
+        stat = os.stat(image_path)
+    except OSError:
+        return None
+    if entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+        return None
+    asset_path = get_asset_path(entry["hash"], width, height)
+    return asset_path if os.path.exists(asset_path) else None
+
+
+def _parse_resolution(resolution: str) -> Tuple[int, int]:
+    width, height = resolution.lower().split("x")
+    return int(width), int(height)
+
+
 if __name__ == "__main__":
-    path = "stimuli/stimuli_categories"
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--subject_id", help="The subject ID", default=0)
+    parser.add_argument("-a", "--assets", action="store_true",
+                        help="Build pre-resized images instead of the stimuli order")
+    parser.add_argument("-r", "--resolutions", nargs="+", type=_parse_resolution,
+                        help="Display resolutions, e.g. 1920x1080. By default the connected monitors")
+    parser.add_argument("-j", "--jobs", help="The number of worker processes", type=int, default=None)
+    parser.add_argument("-f", "--force", action="store_true", help="Convert all assets again")
+    parser.add_argument("-m", "--manifest", action="store_true",
+                        help="Update the stimulus manifest from {0}".format(STIMULI_PATH))
+    parser.add_argument("-c", "--cohort", type=int,
+                        help="Generate orders of this number of subjects to {0}".format(ORDERS_PATH))
+    parser.add_argument("--seed", help="The seed of cohort orders", type=int, default=0)
     args = parser.parse_args()
-    subject_id: str = args.subject_id
-    prepare_stimuli_list(subject_id)
\ No newline at end of file
+    if args.manifest:
+        build_manifest()
+    elif args.cohort is not None:
+        problems = check_balance(generate_cohort_orders(args.cohort, seed=args.seed))
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+    elif args.assets:
+        resolutions = args.resolutions
+        if resolutions is None:
+            from screeninfo import get_monitors
+            resolutions = sorted(set((monitor.width, monitor.height) for monitor in get_monitors()))
+        build_assets(resolutions, max_workers=args.jobs, force=args.force)
+    else:
+        subject_id: str = args.subject_id
+        prepare_stimuli_list(subject_id)
\ No newline at end of file
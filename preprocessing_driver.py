@@ -0,0 +1,430 @@
+'''
+Runs preprocessing of recorded devices in parallel.
+Each device is preprocessed in a separate process, and many session
+folders can be reprocessed at once:
+
+    python preprocessing_driver.py output/p* output_remote/p*
+'''
+
+import os
+import sys
+import glob
+import time
+import logging
+import argparse
+import tempfile
+import multiprocessing
+import concurrent.futures
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+sys.path.insert(0, '../octopus-sensing/')
+
+from octopus_sensing.devices.common import SavingModeEnum
+
+EEG_CHANNELS = ["Fp1", "Fp2", "F7", "F3",
+                "F4", "F8", "T3", "C3",
+                "C4", "T4", "T5", "P3",
+                "P4", "T6", "O1", "O2"]
+
+# Device folder name in a session folder: device kind
+SESSION_DEVICES = {"eeg": "openbci_brainflow",
+                   "shimmer": "shimmer3"}
+
+# The time in seconds that a trial job waits for its data to be saved
+SEGMENT_TIMEOUT = 120
+
+
+class DeviceJob(NamedTuple):
+    '''
+    Everything a worker process needs to preprocess one device's recordings
+    '''
+    name: str
+    kind: str
+    input_path: str
+    output_path: str
+    channels: List[str]
+    saving_mode: int
+
+
+def preprocess_device(job: DeviceJob,
+                      openbci_sampling_rate: int = 125,
+                      shimmer3_sampling_rate: int = 128,
+                      signal_preprocess: bool = True) -> Tuple[float, Optional[int]]:
+    '''
+    Preprocesses all recorded files of one device. It runs in a worker process.
+
+    Returns
+    -------
+    result: Tuple[float, None]
+        The time in seconds that preprocessing took. The second item is
+        only used by preprocess_trial
+    '''
+    start = time.monotonic()
+    os.makedirs(job.output_path, exist_ok=True)
+    file_names = sorted(name for name in os.listdir(job.input_path)
+                        if os.path.isfile(os.path.join(job.input_path, name)))
+    if job.kind == "openbci_brainflow":
+        from octopus_sensing.preprocessing.openbci_brainflow import openbci_brainflow_preprocess
+        for file_name in file_names:
+            openbci_brainflow_preprocess(job.input_path, file_name, job.output_path,
+                                         job.channels,
+                                         saving_mode=job.saving_mode,
+                                         sampling_rate=openbci_sampling_rate,
+                                         signal_preprocess=signal_preprocess)
+    elif job.kind == "shimmer3":
+        from octopus_sensing.preprocessing.shimmer3 import shimmer3_preprocess
+        for file_name in file_names:
+            shimmer3_preprocess(job.input_path, file_name, job.output_path,
+                                saving_mode=job.saving_mode,
+                                sampling_rate=shimmer3_sampling_rate,
+                                signal_preprocess=signal_preprocess)
+    else:
+        raise ValueError("No preprocessing for device kind {0}".format(job.kind))
+    return time.monotonic() - start, None
+
+
+def _is_number(value: bytes) -> bool:
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def read_segment(file_path: str, start_offset: int, start_marker: str, stop_marker: str,
+                 timeout: float = SEGMENT_TIMEOUT) -> Tuple[bytes, bytes, int]:
+    '''
+    Reads the rows of a continuously saved recording between a START and a STOP
+    trigger. It waits until the STOP trigger is saved in the file.
+
+    Parameters
+    ----------
+    file_path: str
+        The recorded csv file
+
+    start_offset: int
+        The byte offset to start searching from. 0 means after the header, or
+        the start of the file for recordings without a header (BrainFlow)
+
+    start_marker: str
+        The trigger of the first row, e.g. START-01-01-11
+
+    stop_marker: str
+        The trigger of the last row, e.g. STOP-01-01-11
+
+    Returns
+    -------
+    segment: Tuple[bytes, bytes, int]
+        The header line, or b"" if the recording has none, the segment rows
+        and the byte offset after the segment
+    '''
+    deadline = time.monotonic() + timeout
+    # The trigger is the last column of a marked row
+    start_bytes = b"," + start_marker.encode()
+    stop_bytes = b"," + stop_marker.encode()
+    while True:
+        if os.path.exists(file_path):
+            with open(file_path, "rb") as recorded_file:
+                header = recorded_file.readline()
+                # Recordings without a header start with a numeric cell
+                if _is_number(header.split(b",", 1)[0]):
+                    header = b""
+                    recorded_file.seek(0)
+                if start_offset > recorded_file.tell():
+                    recorded_file.seek(start_offset)
+                rows: List[bytes] = []
+                for row in recorded_file:
+                    if not row.endswith(b"\n"):
+                        # The device is still writing this row
+                        break
+                    if rows or row.rstrip(b"\r\n").endswith(start_bytes):
+                        rows.append(row)
+                    if rows and row.rstrip(b"\r\n").endswith(stop_bytes):
+                        return header, b"".join(rows), recorded_file.tell()
+        if time.monotonic() > deadline:
+            raise TimeoutError("{0} is not saved in {1}".format(stop_marker, file_path))
+        time.sleep(0.5)
+
+
+def preprocess_trial(job: DeviceJob, file_name: str, experiment_id: str, stimulus_id: str,
+                     start_offset: int = 0, **options) -> Tuple[float, Optional[int]]:
+    '''
+    Preprocesses one trial of a continuously saved recording while the session
+    is running. The trial's rows are copied to a temporary folder with the
+    recording's file name, so preprocessed files have the same names as
+    preprocessing the whole recording. It runs in a worker process.
+
+    Returns
+    -------
+    result: Tuple[float, int]
+        The time in seconds that preprocessing took, and the byte offset
+        after the trial in the recording, which the next trial can start from
+    '''
+    start = time.monotonic()
+    stimulus_id = str(stimulus_id).zfill(2)
+    header, rows, end_offset = \
+        read_segment(os.path.join(job.input_path, file_name), start_offset,
+                     "START-{0}-{1}".format(experiment_id, stimulus_id),
+                     "STOP-{0}-{1}".format(experiment_id, stimulus_id))
+    with tempfile.TemporaryDirectory(prefix="segment-") as segment_path:
+        with open(os.path.join(segment_path, file_name), "wb") as segment_file:
+            if header:
+                segment_file.write(header)
+            segment_file.write(rows)
+        preprocess_device(job._replace(input_path=segment_path), **options)
+    return time.monotonic() - start, end_offset
+
+
+def trial_outputs(job: DeviceJob, experiment_id: str, stimulus_id: str) -> List[str]:
+    '''
+    Returns the preprocessed files of one trial of a continuously saved recording
+    '''
+    stimulus_id = str(stimulus_id).zfill(2)
+    if job.kind == "shimmer3":
+        # shimmer3_preprocess drops the first 7 characters ("shimmer") of the file name
+        name = "{0}-{1}".format(job.name, experiment_id)[7:]
+        return [os.path.join(job.output_path, signal,
+                             "{0}{1}-{2}.csv".format(signal, name, stimulus_id))
+                for signal in ("gsr", "ppg")]
+    return [os.path.join(job.output_path,
+                         "{0}-{1}-{2}.csv".format(job.name, experiment_id, stimulus_id))]
+
+
+def device_jobs(device_coordinator, output_path: str) -> List[DeviceJob]:
+    '''
+    Makes preprocessing jobs for the devices of a device coordinator.
+    Devices without a preprocessing module (audio, camera) are ignored,
+    the same as preprocess_devices.
+
+    Parameters
+    ----------
+    device_coordinator: DeviceCoordinator
+        The device coordinator of the session
+
+    output_path: str
+        Path for preprocessed files. Each device has a folder in it
+    '''
+    from octopus_sensing.devices import BrainFlowOpenBCIStreaming
+    from octopus_sensing.devices.shimmer3_streaming import Shimmer3Streaming
+
+    jobs = []
+    for device in device_coordinator.get_devices():
+        if isinstance(device, BrainFlowOpenBCIStreaming):
+            kind = "openbci_brainflow"
+            channels = device.get_channels()
+        elif isinstance(device, Shimmer3Streaming):
+            kind = "shimmer3"
+            channels = []
+        else:
+            continue
+        jobs.append(DeviceJob(device.get_name(), kind, device.get_output_path(),
+                              os.path.join(output_path, device.get_name()),
+                              channels, device.get_saving_mode()))
+    return jobs
+
+
+def session_jobs(session_path: str, output_path: str) -> List[DeviceJob]:
+    '''
+    Makes preprocessing jobs for a recorded session folder, e.g. output/p01.
+    Recordings are expected in {session_path}/eeg and {session_path}/shimmer,
+    saved in the continuous saving mode.
+    '''
+    jobs = []
+    for name, kind in SESSION_DEVICES.items():
+        input_path = os.path.join(session_path, name)
+        if not os.path.isdir(input_path):
+            continue
+        jobs.append(DeviceJob(name, kind, input_path, os.path.join(output_path, name),
+                              EEG_CHANNELS if kind == "openbci_brainflow" else [],
+                              SavingModeEnum.CONTINIOUS_SAVING_MODE))
+    return jobs
+
+
+class PreprocessingDriver():
+    '''
+    Preprocesses devices in a process pool. `start` and `start_trial` return
+    immediately, so they can be called from GTK callbacks, and `wait` collects
+    the results and reports the wall time of each device.
+
+    With `start_trial`, each trial is preprocessed as soon as its data is saved
+    during the session, so only waiting for the last trials is left at the end,
+    which `merge` does.
+
+    The pool is made when the driver is made, and its workers are started by a
+    fork server (or spawned where there is none), never forked from the
+    session process, which has device and GTK threads. Scripts that use the
+    driver should run main() only under `if __name__ == "__main__"`, because
+    workers import the main script.
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    max_workers: int, default: None
+        The number of worker processes. By default it is the number of CPUs
+
+    openbci_sampling_rate: int, default: 125
+        New sampling rate for openbci resampling
+
+    shimmer3_sampling_rate: int, default: 128
+        New sampling rate for shimmer3 resampling
+
+    signal_preprocess: bool, default: True
+        If True will apply preliminary preprocessing steps to clean signals
+    '''
+    def __init__(self, max_workers: Optional[int] = None,
+                 openbci_sampling_rate: int = 125,
+                 shimmer3_sampling_rate: int = 128,
+                 signal_preprocess: bool = True):
+        self._max_workers = max_workers
+        self._options = {"openbci_sampling_rate": openbci_sampling_rate,
+                         "shimmer3_sampling_rate": shimmer3_sampling_rate,
+                         "signal_preprocess": signal_preprocess}
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = \
+            self._new_executor()
+        self._futures: Dict[concurrent.futures.Future, DeviceJob] = {}
+        # The byte offset after the last preprocessed trial of each recording
+        self._offsets: Dict[str, int] = {}
+        # (jobs, experiment ID, stimulus ID) of start_trial calls
+        self._trials: List[Tuple[List[DeviceJob], str, str]] = []
+        self._start_time = 0.0
+
+    def start(self, jobs: List[DeviceJob]) -> None:
+        '''
+        Submits preprocessing jobs for all recorded files and returns immediately
+        '''
+        for job in jobs:
+            print("Start preprocessing {0} ({1})".format(job.name, job.input_path))
+            future = self._get_executor().submit(preprocess_device, job, **self._options)
+            self._futures[future] = job
+
+    def start_trial(self, jobs: List[DeviceJob], experiment_id: str, stimulus_id: str) -> None:
+        '''
+        Submits preprocessing jobs for one finished trial and returns immediately.
+        Devices should be in the continuous saving mode and the trial's data
+        should be saved, or be going to be saved, with a SAVE message.
+        '''
+        self._trials.append((jobs, experiment_id, stimulus_id))
+        for job in jobs:
+            file_name = "{0}-{1}.csv".format(job.name, experiment_id)
+            file_path = os.path.join(job.input_path, file_name)
+            future = self._get_executor().submit(preprocess_trial, job, file_name,
+                                                 experiment_id, stimulus_id,
+                                                 self._offsets.get(file_path, 0),
+                                                 **self._options)
+            future.add_done_callback(
+                lambda future, file_path=file_path: self._update_offset(file_path, future))
+            self._futures[future] = job
+
+    def _update_offset(self, file_path: str, future: concurrent.futures.Future) -> None:
+        if future.exception() is None:
+            end_offset = future.result()[1]
+            self._offsets[file_path] = max(self._offsets.get(file_path, 0), end_offset)
+
+    def _new_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = multiprocessing.get_context("spawn")
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self._max_workers,
+                                                      mp_context=context)
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._executor is None:
+            # A new pool after wait()
+            self._executor = self._new_executor()
+        if not self._futures:
+            self._start_time = time.monotonic()
+        return self._executor
+
+    def wait(self) -> Dict[str, float]:
+        '''
+        Waits for all submitted jobs and reports their wall time
+
+        Returns
+        -------
+        wall_times: Dict[str, float]
+            The total wall time of each device's preprocessing jobs in seconds,
+            by {input_path}. Failed jobs are not included.
+        '''
+        wall_times: Dict[str, float] = {}
+        for future in concurrent.futures.as_completed(self._futures):
+            job = self._futures[future]
+            try:
+                wall_time = future.result()[0]
+            except Exception as error:
+                print("Preprocessing {0} ({1}) failed: {2}".format(job.name, job.input_path, error))
+                logging.error("Preprocessing {0} ({1}) failed: {2}".format(
+                    job.name, job.input_path, error))
+                continue
+            wall_times[job.input_path] = wall_times.get(job.input_path, 0) + wall_time
+        for input_path, wall_time in wall_times.items():
+            message = "Preprocessing {0} took {1:.2f} s".format(input_path, wall_time)
+            print(message)
+            logging.info(message)
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._futures:
+            print("Preprocessing done in {0:.2f} s".format(time.monotonic() - self._start_time))
+        self._executor = None
+        self._futures = {}
+        return wall_times
+
+    def merge(self) -> Dict[str, float]:
+        '''
+        The final step after `start_trial`. It waits for the trial jobs, then
+        preprocesses the whole recording again for devices that miss the
+        output of a trial, e.g. because its job timed out. Trial outputs have
+        the same names as the whole recording's, so complete devices are left as they are.
+
+        Returns
+        -------
+        wall_times: Dict[str, float]
+            The same as `wait`
+        '''
+        wall_times = self.wait()
+        incomplete: Dict[str, DeviceJob] = {}
+        for jobs, experiment_id, stimulus_id in self._trials:
+            for job in jobs:
+                missing = [path for path in trial_outputs(job, experiment_id, stimulus_id)
+                           if not os.path.exists(path)]
+                if missing:
+                    logging.warning("Preprocessed trial {0} of {1} is missing: {2}".format(
+                        stimulus_id, job.name, missing))
+                    incomplete[job.input_path] = job
+        self._trials = []
+        if incomplete:
+            self.start(list(incomplete.values()))
+            for input_path, wall_time in self.wait().items():
+                wall_times[input_path] = wall_times.get(input_path, 0) + wall_time
+        return wall_times
+
+
+def get_output_path(session_path: str) -> str:
+    '''
+    output/p01 is preprocessed to preprocessed_output/p01 and
+    output_remote/p01 to preprocessed_remote_output/p01
+    '''
+    parent, session = os.path.split(os.path.normpath(session_path))
+    if os.path.basename(parent) == "output_remote":
+        return os.path.join("preprocessed_remote_output", session)
+    return os.path.join("preprocessed_output", session)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sessions", nargs="+",
+                        help="Session folders or patterns, e.g. output/p* output_remote/p*")
+    parser.add_argument("-j", "--jobs", help="The number of worker processes", type=int, default=None)
+    args = parser.parse_args()
+
+    driver = PreprocessingDriver(max_workers=args.jobs)
+    for pattern in args.sessions:
+        for session_path in sorted(glob.glob(pattern)):
+            driver.start(session_jobs(session_path, get_output_path(session_path)))
+    driver.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+'''
+Starts a session as soon as its components are ready, instead of after
+fixed delays, and reports how long each startup step took.
+'''
+
+import time
+import socket
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from gi.repository import GLib
+
+# Readiness check of a component. It should return True when the component is ready
+ReadinessCheck = Callable[[], bool]
+
+
+class StartupReport():
+    '''
+    Measures the duration of startup steps on the monotonic clock
+
+    Attributes
+    ----------
+    steps: List[Tuple[str, float]]
+        (step name, duration in seconds) in the order that they finished
+
+    Parameters
+    ----------
+    start_time: float, default: None
+        The monotonic time that the first step started. By default it is now
+
+    Example
+    -------
+    >>> report = StartupReport(start_time)
+    >>> report.mark("import")
+    >>> report.mark("device init")
+    >>> report.log()
+    '''
+    def __init__(self, start_time: Optional[float] = None):
+        self._start_time = time.monotonic() if start_time is None else start_time
+        self._last_time = self._start_time
+        self.steps: List[Tuple[str, float]] = []
+
+    def mark(self, step: str) -> float:
+        '''
+        Ends a step that started at the end of the previous one
+
+        Returns
+        -------
+        duration: float
+            The duration of the step in seconds
+        '''
+        now = time.monotonic()
+        duration = now - self._last_time
+        self._last_time = now
+        self.steps.append((step, duration))
+        return duration
+
+    def log(self) -> None:
+        '''
+        Prints and logs the duration of each step and the total startup time
+        '''
+        lines = ["{0:<16} {1:8.3f} s".format(step, duration) for step, duration in self.steps]
+        lines.append("{0:<16} {1:8.3f} s".format("total", self._last_time - self._start_time))
+        message = "Startup timing:\n" + "\n".join(lines)
+        print(message)
+        logging.info(message)
+
+
+class ReadinessGate():
+    '''
+    Polls the readiness checks of components in a background thread and calls
+    back in the GTK main loop when all of them are ready, or when the timeout
+    is reached.
+
+    Attributes
+    ----------
+    ready_times: Dict[str, float]
+        The time in seconds from `wait` until each component was ready
+
+    Parameters
+    ----------
+    checks: Dict[str, ReadinessCheck]
+        The readiness check of each component
+
+    timeout: float, default: 30
+        The maximum time in seconds to wait. Components that are not ready
+        by then are logged and the session starts anyway
+
+    interval: float, default: 0.1
+        The time in seconds between polls
+
+    Example
+    -------
+    >>> gate = ReadinessGate({"devices": devices_ready, "cache": lambda: True})
+    >>> gate.wait(start_session)
+    '''
+    def __init__(self, checks: Dict[str, ReadinessCheck], timeout: float = 30,
+                 interval: float = 0.1):
+        self._checks = checks
+        self._timeout = timeout
+        self._interval = interval
+        self.ready_times: Dict[str, float] = {}
+
+    def wait(self, callback: Callable[[List[str]], None]) -> None:
+        '''
+        Starts waiting and returns immediately
+
+        Parameters
+        ----------
+        callback: Callable[[List[str]], None]
+            It is called in the GTK main loop with the names of components
+            that were not ready, which is empty unless the timeout is reached
+        '''
+        threading.Thread(target=self._poll, args=(callback,),
+                         name="ReadinessGate", daemon=True).start()
+
+    def _poll(self, callback: Callable[[List[str]], None]) -> None:
+        start = time.monotonic()
+        pending = dict(self._checks)
+        while pending and time.monotonic() - start < self._timeout:
+            for name, check in list(pending.items()):
+                try:
+                    ready = check()
+                except Exception as error:
+                    logging.debug("Readiness check of {0} failed: {1}".format(name, error))
+                    ready = False
+                if ready:
+                    self.ready_times[name] = time.monotonic() - start
+                    logging.info("{0} is ready in {1:.3f} s".format(name, self.ready_times[name]))
+                    del pending[name]
+            if pending:
+                time.sleep(self._interval)
+        if pending:
+            logging.error("Not ready after {0} s: {1}".format(self._timeout, ", ".join(pending)))
+        GLib.idle_add(self._call_back, callback, list(pending))
+
+    @staticmethod
+    def _call_back(callback: Callable[[List[str]], None], not_ready: List[str]) -> bool:
+        callback(not_ready)
+        return False
+
+
+def device_checks(device_coordinator, probe_interval: float = 1) -> Dict[str, ReadinessCheck]:
+    '''
+    Makes a readiness check for each device of a device coordinator. A device
+    is ready when its process is alive, and for devices with realtime data,
+    when it returns data, which means it is streaming. Devices that only
+    record after the first START can not return data before the session:
+    AudioStreaming is ready when its process is alive, and cameras with frame
+    counters (SharedMemoryCameraStreaming) when they have captured a frame.
+
+    Realtime data is requested for all devices at once, at most every
+    `probe_interval` seconds and only after all of their processes are
+    alive, so starting devices are not flooded with requests. Use a
+    MeteredDeviceCoordinator when other threads also poll realtime data.
+    '''
+    from octopus_sensing.devices.realtime_data_device import RealtimeDataDevice
+
+    realtime_devices = [device for device in device_coordinator.get_devices()
+                        if isinstance(device, RealtimeDataDevice) and
+                        not hasattr(device, "get_counters") and
+                        not _captures_on_start(device)]
+    streaming: Dict[str, bool] = {}
+    last_probe_time = [0.0]
+
+    def probe() -> None:
+        if time.monotonic() - last_probe_time[0] < probe_interval or \
+                not all(device.is_alive() for device in realtime_devices):
+            return
+        last_probe_time[0] = time.monotonic()
+        realtime_data = device_coordinator.get_realtime_data(1, None)
+        for device in realtime_devices:
+            data = realtime_data.get(device.get_name()) or {}
+            streaming[device.get_name()] = len(data.get("data") or []) > 0
+
+    checks = {}
+    for device in device_coordinator.get_devices():
+        if hasattr(device, "get_counters"):
+            def check(device=device):
+                return device.is_alive() and device.get_counters()["captured"] > 0
+        elif device in realtime_devices:
+            def check(device=device):
+                if not streaming.get(device.get_name()):
+                    probe()
+                return streaming.get(device.get_name(), False)
+        else:
+            def check(device=device):
+                return device.is_alive()
+        checks[device.get_name()] = check
+    return checks
+
+
+def _captures_on_start(device) -> bool:
+    try:
+        from octopus_sensing.devices.audio_streaming import AudioStreaming
+    except ImportError:
+        # miniaudio is not installed, so there is no AudioStreaming device
+        return False
+    return isinstance(device, AudioStreaming)
+
+
+def port_check(host: str, port: int) -> ReadinessCheck:
+    '''
+    Makes a readiness check of a TCP server, e.g. the monitoring endpoint.
+    It connects and closes without sending anything.
+    '''
+    def check():
+        with socket.create_connection((host, port), timeout=0.5):
+            return True
+    return check
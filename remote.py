@@ -6,16 +6,23 @@ Steps:
 3- Open monitoring in another browser
 '''
 
+import time
+# The start of the startup timing report, before the imports
+STARTUP_TIME = time.monotonic()
+
 import os
 import logging
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.DEBUG)
-import time
 import datetime
-import http.client
-import pickle
-from windows import ImageWindow, MessageButtonWindow, TimerWindow
-from prepare_stimuli import prepare_stimuli_list
-import time
+from octopus_sensing.windows.timer_window import TimerWindow
+from windows import make_image_window, MessageButtonWindow
+from image_cache import PixbufCache, ImagePrefetcher
+from prepare_stimuli import prepare_stimuli_list, get_stimulus_file, read_cohort_order
+from trial_scheduler import TrialScheduler
+from epoch_index import EpochIndex
+from event_recorder import EventRecorder
+from trigger_sender import TriggerSender, make_transport
+from readiness import ReadinessGate, StartupReport, port_check
 import argparse
 from screeninfo import get_monitors
 import gi
@@ -31,6 +38,11 @@ EMOTIONS = {"1": "High-Valence, High-Arousal",
             "4": "Low-Valence, Low-Arousal"}
 
 def read_stimuli_order(subject_id):
+    # Orders of a generated cohort (prepare_stimuli.py --cohort) are used first
+    order = read_cohort_order(subject_id, "remote")
+    if order is not None:
+        print(order)
+        return order
     stimuli_order_file_path = "stimuli/remote/p{}_stimuli.csv".format(str(subject_id).zfill(2))
     print(stimuli_order_file_path)
     if not os.path.exists(stimuli_order_file_path):
@@ -39,26 +51,54 @@ def read_stimuli_order(subject_id):
     with open(stimuli_order_file_path, "r") as csv_file:
         reader = csv.reader(csv_file)
         for row in reader:
-            order.append(row[0])
+            # Orders have file names. Stimuli that are not in the manifest raise KeyError
+            order.append(get_stimulus_file(os.path.splitext(row[0])[0]))
     print(order)
     return order
 
 STIMULI_PATH = "stimuli/all_images/"
+FIXED_IMAGES = ["images/gray_image.jpg",
+                "images/fixation_cross.jpg",
+                "images/done_image.jpg"]
+
+# Onset of each phase in seconds. The session starts when all components are ready
+SESSION_TIMELINE = [("start", 0)]
+# The maximum time in seconds to wait for the trigger endpoint
+READINESS_TIMEOUT = 30
+TRIAL_TIMELINE = [("fixation_cross", 0),
+                  ("stimuli", 3),
+                  ("timer", 9)]
 
 class BackgroudWindow(Gtk.Window):
-    def __init__(self, experiment_id, subject_id, host):
-        self._host = host
-        self._http_client = http.client.HTTPConnection(self._host, timeout=3)
+    def __init__(self, experiment_id, subject_id, host, transport="udp",
+                 epoch_index_path=None, image_backend="pixbuf", startup_report=None,
+                 log_path=None, events_path=None):
+        self._trigger_sender = TriggerSender(make_transport(transport, host))
+        self._trigger_sender.start()
+        self._startup_report = startup_report or StartupReport()
         os.makedirs("logs", exist_ok=True)
         time_str = datetime.datetime.strftime(datetime.datetime.now(),
                                               "%Y-%m-%dT%H-%M-%S")
-        logging.basicConfig(filename='logs/exp2_f2f_log_{0}_{1}.log'.format(experiment_id, time_str),
-                            level=logging.DEBUG)
+        if log_path is None:
+            log_path = 'logs/exp2_f2f_log_{0}_{1}.log'.format(experiment_id, time_str)
+        logging.basicConfig(filename=log_path, level=logging.DEBUG)
+        if epoch_index_path is None:
+            epoch_index_path = 'logs/exp2_f2f_epochs_{0}_{1}.csv'.format(experiment_id, time_str)
+        self._epoch_index = EpochIndex(epoch_index_path)
+        # Events on the timing-critical path are written by a background thread
+        if events_path is None:
+            events_path = 'logs/exp2_f2f_events_{0}_{1}.jsonl'.format(experiment_id, time_str)
+        self._events = EventRecorder(events_path)
+        self._events.start()
         self._experiment_id = experiment_id
 
         self._stimuli_list = read_stimuli_order(subject_id)
 
         self._index = 0
+        self._session_scheduler = TrialScheduler(SESSION_TIMELINE, recorder=self._events)
+        self._trial_scheduler = TrialScheduler(TRIAL_TIMELINE, recorder=self._events)
+        # The number of trial scheduler records that are in the epoch index
+        self._indexed_records = 0
         logging.info("Emotion order is {}".format(self._stimuli_list))
 
         Gtk.Window.__init__(self, title="")
@@ -68,17 +108,37 @@ class BackgroudWindow(Gtk.Window):
         image_height = monitors[0].height
         print(image_width, image_height)
         background_path = "images/gray_image.jpg"
-        pixbuf = \
-            GdkPixbuf.Pixbuf.new_from_file_at_scale(background_path,
-                                                    image_width,
-                                                    image_height, False)
+        self._image_cache = PixbufCache()
+        self._prefetcher = ImagePrefetcher(self._image_cache)
+        pixbuf = self._image_cache.get(background_path, image_width, image_height, 0)
         image = Gtk.Image()
         image.set_from_pixbuf(pixbuf)
         image_box.pack_start(image, False, False, 0)
         self.add(image_box)
 
-        self.image_window = ImageWindow("image_window", monitor_no=1)
+        # Decoding all images before the first trial
+        session_images = \
+            FIXED_IMAGES + [STIMULI_PATH + stimulus for stimulus in self._stimuli_list]
+        self.image_window = make_image_window("image_window", monitor_no=1,
+                                              image_cache=self._image_cache,
+                                              backend=image_backend)
+        self._startup_report.mark("window creation")
+        self.image_window.preload(session_images)
         self.image_window.set_image(background_path)
+        self._startup_report.mark("asset preload")
+
+        if transport == "udp":
+            # The endpoint is up when it answers a clock ping
+            endpoint_check = lambda: self._trigger_sender.clock_sync.offset is not None
+        else:
+            endpoint_host, endpoint_port = host.rsplit(":", 1)
+            endpoint_check = port_check(endpoint_host, int(endpoint_port))
+        readiness_checks = {
+            "trigger endpoint": endpoint_check,
+            "stimulus cache": lambda: all(
+                self._image_cache.contains(self.image_window.get_cache_key(image_path))
+                for image_path in session_images)}
+        self._readiness_gate = ReadinessGate(readiness_checks, timeout=READINESS_TIMEOUT)
 
 
     def show(self, *args):
@@ -90,19 +150,25 @@ class BackgroudWindow(Gtk.Window):
         self.show_all()
         self.image_window.show_window()
 
-        GLib.timeout_add_seconds(5, self._show_message)
-        GLib.timeout_add_seconds(1, self._move_image_window)
+        self._readiness_gate.wait(self._on_ready)
         Gtk.main()
 
-    def _move_image_window(self, *args):
-        os.system("wmctrl -ir $(wmctrl -l |grep image_window |grep -v grep |cut -d ' ' -f1) -e 0,1200,0,-1,-1")
+    def _on_ready(self, not_ready):
+        '''
+        Starts the session when the trigger endpoint and the stimulus cache are ready
+        '''
+        self._startup_report.mark("readiness wait")
+        self._startup_report.log()
+        self._events.record("ready", not_ready=not_ready,
+                            ready_times=self._readiness_gate.ready_times)
+        self._session_scheduler.start({"start": self._show_message})
 
     def _show_message(self, *args, message="Start"):
         '''
         Showing a message before each stimuli
         '''
 
-        logging.info("Start time {0}".format(datetime.datetime.now()))
+        self._events.record("message", index=self._index)
         message = \
             MessageButtonWindow("Info", message)
         message.show()
@@ -110,71 +176,97 @@ class BackgroudWindow(Gtk.Window):
         if self._index >= 8:
             message.connect("destroy", self._done)
         else:
-            message.connect("destroy", self._show_fixation_cross)
+            message.connect("destroy", self._start_trial)
+
+    def _start_trial(self, *args):
+        '''
+        Scheduling all phases of a trial from now
+        '''
+        self._end_epoch()
+        self._epoch_index.start_trial(self._index + 1,
+                                      self._stimuli_list[self._index][:-4],
+                                      EMOTIONS[self._stimuli_list[self._index][0]])
+        self._trial_scheduler.start({"fixation_cross": self._show_fixation_cross,
+                                     "stimuli": self._show_stimuli,
+                                     "timer": self._show_timer})
+
+    def _end_epoch(self):
+        '''
+        Writing the finished trial to the epoch index, when its questionnaire is closed
+        '''
+        records = self._trial_scheduler.records
+        self._epoch_index.add_records(records[self._indexed_records:])
+        self._indexed_records = len(records)
+        # Devices record on the endpoint's clock
+        self._epoch_index.end_trial(endpoint_offset=self._trigger_sender.clock_sync.offset)
 
     def _show_fixation_cross(self, *args):
         '''
         Showing fixation cross before each stimuli
         '''
-        logging.info("Fixation cross {0}".format(datetime.datetime.now()))
+        self._events.record("fixation_cross", stimulus=self._stimuli_list[self._index])
         self.image_window.set_image("images/fixation_cross.jpg")
+        self.image_window.call_on_present(self._send_start)
 
-        logging.info(f"Sending START. Stimulus: {self._stimuli_list[self._index][:-4]}")
+    def _send_start(self, presentation_time):
+        '''
+        Sending START trigger with the time that fixation cross reached the screen
+        '''
+        self._events.record("fixation_cross_presented", presentation_time,
+                            stimulus=self._stimuli_list[self._index])
+        self._epoch_index.set_time("fixation_presented", presentation_time)
+        self._events.record("trigger", type="START", stimulus_id=self._stimuli_list[self._index][:-4])
         self.__post_trigger({
             'type': 'START',
             'experiment_id': self._experiment_id,
-            'stimulus_id': self._stimuli_list[self._index][:-4]})
+            'stimulus_id': self._stimuli_list[self._index][:-4],
+            'payload': {'presentation_time': presentation_time}})
 
-        GLib.timeout_add_seconds(3, self._show_stimuli)
-
-    def __post_trigger(self, msg_dict, retries=60):
-        try:
-            self._http_client.request("POST", "/",
-                            body=pickle.dumps(msg_dict),
-                            headers={'Accept': 'application/pickle'})
-            response = self._http_client.getresponse()
-            if response.status != 200:
-                logging.error("Sending start trigger. Got HTTP status: {0} {1}".format(response.status, response.reason))
-        except Exception as err:
-            if retries == 0:
-                retry_msg = "Gave up."
-            else:
-                retry_msg = "Re-trying."
-            logging.error(f"Sending start failed. {retry_msg}. Error: {err}")
-            if retries > 0:
-                time.sleep(1)
-                try:
-                    # re-creating the connection, in case we've lost the connection
-                    self._http_client = http.client.HTTPConnection(self._host, timeout=3)
-                except Exception as err:
-                    logging.error(f"Failed to re-create the HTTP connection: {err}")
-                self.__post_trigger(msg_dict, retries=retries - 1)
+    def __post_trigger(self, msg_dict):
+        # Delivery happens in the sender thread, so it never blocks the GUI
+        self._trigger_sender.send(msg_dict)
 
     def _show_stimuli(self, *args):
         '''
         Showing stimuli
         '''
-        logging.info("Stimuli {0} - {1}".format(self._stimuli_list[self._index],
-                                                datetime.datetime.now()))
+        self._events.record("stimuli", stimulus=self._stimuli_list[self._index])
         image_path = STIMULI_PATH + self._stimuli_list[self._index]
+        self._prefetcher.check(self.image_window.get_cache_key(image_path))
         self.image_window.set_image(image_path)
-        GLib.timeout_add_seconds(6, self._show_timer)
+        self.image_window.call_on_present(self._log_stimuli_onset)
+
+    def _log_stimuli_onset(self, presentation_time):
+        self._epoch_index.set_time("stimulus_presented", presentation_time)
+        self._events.record("stimuli_presented", presentation_time,
+                            stimulus=self._stimuli_list[self._index])
 
     def _show_timer(self, *args):
         '''
         Showing timer
         '''
-        logging.info("Start of Conversation {0} - {1}".format(self._stimuli_list[self._index],
-                                                              datetime.datetime.now()))
+        self._events.record("conversation", stimulus=self._stimuli_list[self._index])
 
         timer = TimerWindow("Timer", message=EMOTIONS[self._stimuli_list[self._index][0]],
                             width=600,
                             font_size=20)
         timer.show_window()
         timer.connect("destroy", self._questionnaire)
+        self._prefetch_next_stimuli()
+
+    def _prefetch_next_stimuli(self):
+        '''
+        Loading the next trial's stimuli in background while the current trial is running
+        '''
+        next_index = self._index + 1
+        if next_index >= len(self._stimuli_list):
+            return
+        image_path = STIMULI_PATH + self._stimuli_list[next_index]
+        self._prefetcher.prefetch(self.image_window.get_cache_key(image_path))
 
     def _questionnaire(self, *args):
-        logging.info(f"Sending STOP. Stimulus: {self._stimuli_list[self._index][:-4]}")
+        self._trial_scheduler.mark("questionnaire")
+        self._events.record("trigger", type="STOP", stimulus_id=self._stimuli_list[self._index][:-4])
         self.__post_trigger({
             'type': 'STOP',
             'experiment_id': self._experiment_id,
@@ -183,7 +275,8 @@ class BackgroudWindow(Gtk.Window):
         self._show_message(message="Please answer the questionnaire.")
 
     def _done(self, *args):
-        logging.info("Sending TERMINATE.")
+        self._end_epoch()
+        self._events.record("trigger", type="TERMINATE")
         self.__post_trigger({
             'type': 'TERMINATE',
             'experiment_id': self._experiment_id,
@@ -193,7 +286,11 @@ class BackgroudWindow(Gtk.Window):
         self.image_window.connect("destroy", self._terminate)
 
     def _terminate(self, *args):
+        logging.info("Stimuli prefetch hits: {0}, misses: {1}".format(
+            self._prefetcher.hits, self._prefetcher.misses))
         logging.info("End time{0}".format(datetime.datetime.now()))
+        self._events.stop()
+        self._trigger_sender.stop()
         self.destroy()
 
 
@@ -201,21 +298,28 @@ def get_input_parameters():
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--subject_id", help="The subject ID", default=0)
     #parser.add_argument("-t", "--task_id", help="The task ID", default=1)
+    parser.add_argument("-b", "--backend", help="The image rendering backend, pixbuf or gl",
+                        choices=["pixbuf", "gl"], default="pixbuf")
+    parser.add_argument("-r", "--transport", help="The trigger transport, http or udp",
+                        choices=["http", "udp"], default="udp")
     args = parser.parse_args()
     subject_id = args.subject_id
     task_id = 1  # args.task_id
-    return subject_id, task_id
+    return subject_id, task_id, args.transport, args.backend
 
 
 def main():
-    subject_id, task_id = get_input_parameters()
+    startup_report = StartupReport(STARTUP_TIME)
+    startup_report.mark("import")
+    subject_id, task_id, transport, image_backend = get_input_parameters()
     experiment_id = str(subject_id).zfill(2) + "-" + str(task_id).zfill(2)
 
-    # Make delay for initializing all processes
-    time.sleep(5)
-
-    main_window = BackgroudWindow(experiment_id, subject_id, "172.24.16.32:9331")
+    # There are no local devices. The session waits for the trigger endpoint instead
+    main_window = BackgroudWindow(experiment_id, subject_id, "172.24.16.32:9331",
+                                  transport=transport, image_backend=image_backend,
+                                  startup_report=startup_report)
     main_window.show()
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+'''
+Reads recorded sessions (e.g. output/p01) for offline analysis without
+loading whole recordings in memory.
+
+CSV recordings (eeg, shimmer) are converted once to column-major float64
+arrays in {cache_path}/{device}/{file}.npy, next to a JSON index of the rows
+between the START and STOP markers of each stimulus. Later reads memory-map
+the arrays, so a trial is a view into the file and nothing is copied.
+WAV recordings are memory-mapped in place. Videos are not supported,
+because compressed frames can not be memory-mapped.
+
+    >>> reader = SessionReader("output/p01")
+    >>> eeg = reader.trial("eeg", "11")
+    >>> fp1 = eeg[reader.columns("eeg").index("Fp1")]
+
+It can also be run to convert sessions before analysis:
+
+    python session_reader.py output/p01 output/p02
+'''
+
+import os
+import re
+import csv
+import json
+import wave
+import argparse
+import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from preprocessing_driver import EEG_CHANNELS
+
+# The number of rows that are parsed before writing them to the array
+CHUNK_SIZE = 65536
+INDEX_VERSION = 3
+
+# Columns with the time.time() of samples, in the order of preference
+TIME_COLUMNS = ["Unix Timestamp", "time", "Timestamp"]
+# Only cells like START-01-01-11 or STOP-01-01-11 are markers
+TRIGGER_PATTERN = re.compile(r"^(START|STOP)-")
+# The channels of devices whose recordings have no header, by device folder name
+DEVICE_CHANNELS = {"eeg": EEG_CHANNELS}
+# BrainFlow rows of OpenBCI boards have the package number, the channels,
+# other board columns, BrainFlow's Unix timestamp and its marker. The last row
+# of each read is followed by the time of day, time.time() and the trigger.
+BRAINFLOW_APPENDED_COLUMNS = ["time of day", "read time"]
+
+
+def _to_float(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    # Shimmer3 records times as text, e.g. 2022-02-10 14:22:31.123456
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return np.nan
+
+
+def _parse_trigger(trigger: str) -> Tuple[str, str]:
+    '''
+    Splits a marker like START-01-01-11 to its type and stimulus ID
+    '''
+    return trigger.split("-", 1)[0], trigger.rsplit("-", 1)[1]
+
+
+def _is_number(value: str) -> bool:
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def brainflow_columns(board_columns: int, channels: Optional[List[str]] = None) -> List[str]:
+    '''
+    Returns the column names of a headerless BrainFlow recording
+
+    Parameters
+    ----------
+    board_columns: int
+        The number of columns that BrainFlow returns, 24 for Cyton and 32 for Cyton-Daisy
+
+    channels: List[str], default: None
+        The channel names. By default they are channel_1, channel_2, ...
+    '''
+    # Both boards have 16 columns besides the channels
+    channel_count = max(0, board_columns - 16)
+    if channels is None or len(channels) != channel_count:
+        channels = ["channel_{0}".format(index + 1) for index in range(channel_count)]
+    other_count = max(0, board_columns - channel_count - 3)
+    return (["package_num"] + list(channels) +
+            ["board_{0}".format(index) for index in range(channel_count + 1,
+                                                          channel_count + 1 + other_count)] +
+            ["Unix Timestamp", "marker"] + BRAINFLOW_APPENDED_COLUMNS)
+
+
+def _stimulus_id_of(file_path: str) -> str:
+    '''
+    Recordings of the separated saving mode are named {device}-{experiment_id}-{stimulus_id}
+    '''
+    return os.path.splitext(os.path.basename(file_path))[0].rsplit("-", 1)[1]
+
+
+class CSVRecording():
+    '''
+    A memory-mapped CSV recording. The trigger column is kept only in the
+    trial index, dates are converted to Unix times, and other non-numeric
+    values are NaN. Recordings without a header (OpenBCI, saved by BrainFlow)
+    get the column names of brainflow_columns.
+
+    Attributes
+    ----------
+    columns: List[str]
+        The column names, in the order of the array's first axis
+
+    data: numpy.memmap
+        The recording with the shape of (columns, rows)
+
+    trials: Dict[str, Tuple[int, int]]
+        The first and one after the last row of each stimulus ID
+
+    Parameters
+    ----------
+    file_path: str
+        The recorded csv file
+
+    cache_path: str
+        The folder for the converted array and its index. The recording is
+        converted again if it changed after conversion.
+
+    channels: List[str], default: None
+        The channel names of a recording without a header
+    '''
+    def __init__(self, file_path: str, cache_path: str, channels: Optional[List[str]] = None):
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        array_path = os.path.join(cache_path, name + ".npy")
+        index_path = os.path.join(cache_path, name + ".json")
+        stat = os.stat(file_path)
+        index = None
+        if os.path.exists(index_path) and os.path.exists(array_path):
+            with open(index_path, "r") as index_file:
+                index = json.load(index_file)
+            if index.get("version") != INDEX_VERSION or \
+                    index["source_size"] != stat.st_size or \
+                    index["source_mtime"] != stat.st_mtime:
+                index = None
+        if index is None:
+            os.makedirs(cache_path, exist_ok=True)
+            index = self._convert(file_path, array_path, channels)
+            index.update(version=INDEX_VERSION,
+                         source_size=stat.st_size,
+                         source_mtime=stat.st_mtime)
+            with open(index_path, "w") as index_file:
+                json.dump(index, index_file)
+
+        self.columns: List[str] = index["columns"]
+        self.trials: Dict[str, Tuple[int, int]] = \
+            {stimulus_id: (start, stop) for stimulus_id, (start, stop) in index["trials"].items()}
+        self.data = np.load(array_path, mmap_mode="r")
+
+    def trial(self, stimulus_id: str) -> np.ndarray:
+        '''
+        Returns a view of a trial's rows with the shape of (columns, samples)
+        '''
+        start, stop = self.trials[str(stimulus_id).zfill(2)]
+        return self.data[:, start:stop]
+
+    @staticmethod
+    def _convert(file_path: str, array_path: str, channels: Optional[List[str]] = None) -> Dict:
+        # The first pass finds the size of array and the markers, so the
+        # second one can write rows to the memory-mapped array in chunks
+        with open(file_path, "r", newline="") as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader, [])
+            has_header = not (header and _is_number(header[0]))
+            if has_header:
+                trigger_column = header.index("trigger") if "trigger" in header \
+                    else len(header) - 1
+            else:
+                csv_file.seek(0)
+                reader = csv.reader(csv_file)
+            starts: Dict[str, int] = {}
+            trials: Dict[str, List[int]] = {}
+            row_count = 0
+            board_columns: Optional[int] = None
+            for row in reader:
+                if has_header:
+                    trigger = row[trigger_column] if len(row) > trigger_column else ""
+                else:
+                    # Rows without the appended columns have only the board columns
+                    board_columns = len(row) if board_columns is None \
+                        else min(board_columns, len(row))
+                    trigger = row[-1] if row else ""
+                if TRIGGER_PATTERN.match(trigger):
+                    action, stimulus_id = _parse_trigger(trigger)
+                    if action == "START":
+                        starts[stimulus_id] = row_count
+                    elif action == "STOP" and stimulus_id in starts:
+                        trials[stimulus_id] = [starts.pop(stimulus_id), row_count + 1]
+                row_count += 1
+        # In the separated saving mode, files end before the STOP marker
+        for stimulus_id, start in starts.items():
+            trials[stimulus_id] = [start, row_count]
+
+        if has_header:
+            columns = header[:trigger_column] + header[trigger_column + 1:]
+        else:
+            columns = brainflow_columns(board_columns or 0, channels)
+            trigger_column = len(columns)
+        data = np.lib.format.open_memmap(array_path, mode="w+", dtype=np.float64,
+                                         shape=(len(columns), row_count),
+                                         fortran_order=False)
+        with open(file_path, "r", newline="") as csv_file:
+            reader = csv.reader(csv_file)
+            if has_header:
+                next(reader)
+            chunk = np.full((CHUNK_SIZE, len(columns)), np.nan)
+            position = 0
+            chunk_size = 0
+            for row in reader:
+                del row[trigger_column:trigger_column + 1]
+                values = [_to_float(value) for value in row[:len(columns)]]
+                chunk[chunk_size, :len(values)] = values
+                chunk_size += 1
+                if chunk_size == CHUNK_SIZE:
+                    data[:, position:position + chunk_size] = chunk.T
+                    position += chunk_size
+                    chunk_size = 0
+                    chunk.fill(np.nan)
+            data[:, position:position + chunk_size] = chunk[:chunk_size].T
+        data.flush()
+        del data
+        return {"columns": columns, "rows": row_count, "trials": trials}
+
+
+class WAVRecording():
+    '''
+    A memory-mapped WAV recording of one stimulus (separated saving mode)
+
+    Attributes
+    ----------
+    sampling_rate: int
+
+    data: numpy.ndarray
+        A view of the samples with the shape of (channels, frames)
+    '''
+    def __init__(self, file_path: str):
+        with wave.open(file_path, "rb") as wav_file:
+            channels = wav_file.getnchannels()
+            sample_width = wav_file.getsampwidth()
+            frames = wav_file.getnframes()
+            self.sampling_rate = wav_file.getframerate()
+        dtype = {1: "u1", 2: "<i2", 4: "<i4"}[sample_width]
+        samples = np.memmap(file_path, dtype=dtype, mode="r",
+                            offset=self._data_offset(file_path),
+                            shape=(frames, channels))
+        self.data = samples.T
+
+    @staticmethod
+    def _data_offset(file_path: str) -> int:
+        with open(file_path, "rb") as wav_file:
+            wav_file.seek(12)
+            while True:
+                chunk_header = wav_file.read(8)
+                if len(chunk_header) < 8:
+                    raise ValueError("No data chunk in {0}".format(file_path))
+                chunk_id = chunk_header[:4]
+                chunk_size = int.from_bytes(chunk_header[4:], "little")
+                if chunk_id == b"data":
+                    return wav_file.tell()
+                # Chunks are padded to an even size
+                wav_file.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+class SessionReader():
+    '''
+    Gives per-trial views of a session's recordings by stimulus ID
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    session_path: str
+        A session folder with a folder for each device, e.g. output/p01
+
+    cache_path: str, default: None
+        The folder for converted recordings. By default it is {session_path}/columnar
+
+    channels: Dict[str, List[str]], default: None
+        The channel names of devices whose recordings have no header, by
+        device folder name. By default it is DEVICE_CHANNELS
+    '''
+    def __init__(self, session_path: str, cache_path: Optional[str] = None,
+                 channels: Optional[Dict[str, List[str]]] = None):
+        self._session_path = session_path
+        self._cache_path = cache_path or os.path.join(session_path, "columnar")
+        self._channels = DEVICE_CHANNELS if channels is None else channels
+        self._csv_recordings: Dict[str, List[CSVRecording]] = {}
+
+    def devices(self) -> List[str]:
+        '''
+        Returns the names of device folders that have CSV or WAV recordings
+        '''
+        return sorted(name for name in os.listdir(self._session_path)
+                      if os.path.isdir(os.path.join(self._session_path, name)) and
+                      self._files(name, (".csv", ".wav")))
+
+    def columns(self, device: str) -> List[str]:
+        '''
+        Returns the column names of a CSV device
+        '''
+        return self._recordings(device)[0].columns
+
+    def stimuli(self, device: str) -> List[str]:
+        '''
+        Returns the recorded stimulus IDs of a device
+        '''
+        stimuli = set()
+        for recording in self._recordings(device):
+            stimuli.update(recording.trials)
+        stimuli.update(_stimulus_id_of(path) for path in self._files(device, (".wav",)))
+        return sorted(stimuli)
+
+    def trial(self, device: str, stimulus_id: str) -> np.ndarray:
+        '''
+        Returns a view of a trial's data, with the shape of (columns, samples) for
+        CSV recordings and (channels, frames) for WAV recordings
+
+        Raises
+        ------
+        KeyError
+            If the device has no recording of the stimulus
+        '''
+        stimulus_id = str(stimulus_id).zfill(2)
+        for recording in self._recordings(device):
+            if stimulus_id in recording.trials:
+                return recording.trial(stimulus_id)
+        for path in self._files(device, (".wav",)):
+            if _stimulus_id_of(path) == stimulus_id:
+                return WAVRecording(path).data
+        raise KeyError("{0} has no recording of stimulus {1}".format(device, stimulus_id))
+
+    def time_slice(self, device: str, start: float, stop: float,
+                   time_column: Optional[str] = None) -> np.ndarray:
+        '''
+        Returns a view of the rows of a CSV device that were recorded between
+        two Unix times, e.g. the phase times of an epoch index. Rows are found
+        with a binary search on the time column. Rows without a time (NaN)
+        are dropped, and then the result is a copy instead of a view.
+
+        Parameters
+        ----------
+        time_column: str, default: None
+            By default it is the first column of TIME_COLUMNS that the device has
+        '''
+        for recording in self._recordings(device):
+            if time_column is None:
+                time_column = next(column for column in TIME_COLUMNS
+                                   if column in recording.columns)
+            times = recording.data[recording.columns.index(time_column)]
+            timed = np.flatnonzero(~np.isnan(times))
+            if len(timed) == len(times):
+                timed = None
+            else:
+                times = times[timed]
+            if len(times) == 0 or times[-1] < start:
+                continue
+            first = int(np.searchsorted(times, start, side="left"))
+            last = int(np.searchsorted(times, stop, side="right"))
+            if timed is None:
+                return recording.data[:, first:last]
+            return recording.data[:, timed[first:last]]
+        raise KeyError("{0} has no recording at {1}".format(device, start))
+
+    def convert(self) -> None:
+        '''
+        Converts all CSV recordings that are not converted yet
+        '''
+        for device in self.devices():
+            self._recordings(device)
+
+    def _files(self, device: str, extensions: Tuple[str, ...]) -> List[str]:
+        device_path = os.path.join(self._session_path, device)
+        return sorted(os.path.join(device_path, name) for name in os.listdir(device_path)
+                      if name.endswith(extensions))
+
+    def _recordings(self, device: str) -> List[CSVRecording]:
+        if device not in self._csv_recordings:
+            self._csv_recordings[device] = \
+                [CSVRecording(path, os.path.join(self._cache_path, device),
+                              self._channels.get(device))
+                 for path in self._files(device, (".csv",))
+                 if not path.endswith("-log.csv")]
+        return self._csv_recordings[device]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sessions", nargs="+", help="Session folders, e.g. output/p01")
+    args = parser.parse_args()
+    for session_path in args.sessions:
+        reader = SessionReader(session_path)
+        reader.convert()
+        for device in reader.devices():
+            print("{0} {1}: {2}".format(session_path, device, " ".join(reader.stimuli(device))))
+
+
+if __name__ == "__main__":
+    main()
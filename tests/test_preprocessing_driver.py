@@ -0,0 +1,48 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from preprocessing_driver import read_segment
+
+# BrainFlow rows have no header, and the trigger is after the appended time cells
+BRAINFLOW_ROWS = [b"0,1.0,-1.0,1792300000.0,0.0\n",
+                  b"1,1.0,-1.0,1792300000.008,0.0,10:00:00.008,1792300000.01,START-01-01-11\n",
+                  b"2,1.0,-1.0,1792300000.016,0.0\n",
+                  b"3,1.0,-1.0,1792300000.024,0.0,10:00:00.024,1792300000.03,STOP-01-01-11\n",
+                  b"4,1.0,-1.0,1792300000.032,0.0\n"]
+
+
+def test_brainflow_segment(tmp_path):
+    file_path = os.path.join(tmp_path, "eeg-01.csv")
+    with open(file_path, "wb") as recorded_file:
+        recorded_file.writelines(BRAINFLOW_ROWS)
+
+    header, rows, end_offset = read_segment(file_path, 0, "START-01-01-11", "STOP-01-01-11",
+                                            timeout=0)
+    assert header == b""
+    assert rows == b"".join(BRAINFLOW_ROWS[1:4])
+    assert end_offset == len(b"".join(BRAINFLOW_ROWS[:4]))
+
+
+def test_brainflow_segment_in_first_row(tmp_path):
+    file_path = os.path.join(tmp_path, "eeg-01.csv")
+    with open(file_path, "wb") as recorded_file:
+        recorded_file.writelines(BRAINFLOW_ROWS[1:])
+
+    header, rows, _ = read_segment(file_path, 0, "START-01-01-11", "STOP-01-01-11", timeout=0)
+    assert header == b""
+    assert rows == b"".join(BRAINFLOW_ROWS[1:4])
+
+
+def test_shimmer_segment(tmp_path):
+    file_path = os.path.join(tmp_path, "shimmer-01.csv")
+    with open(file_path, "wb") as recorded_file:
+        recorded_file.write(b"type,time stamp,GSR_ohm,time,trigger\n"
+                            b"0,1,100.0,1792300000.0,\n"
+                            b"0,2,100.0,1792300000.1,START-01-01-11\n"
+                            b"0,3,100.0,1792300000.2,STOP-01-01-11\n")
+
+    header, rows, _ = read_segment(file_path, 0, "START-01-01-11", "STOP-01-01-11", timeout=0)
+    assert header == b"type,time stamp,GSR_ohm,time,trigger\n"
+    assert rows == b"0,2,100.0,1792300000.1,START-01-01-11\n0,3,100.0,1792300000.2,STOP-01-01-11\n"
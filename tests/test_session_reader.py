@@ -0,0 +1,76 @@
+import os
+import sys
+import csv
+import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from preprocessing_driver import EEG_CHANNELS
+from session_reader import SessionReader
+
+START_TIME = 1792300000.0
+SAMPLING_RATE = 125
+# Cyton-Daisy rows have 32 columns
+BOARD_COLUMNS = 32
+
+
+def write_brainflow_recording(file_path, samples=1000, read_size=25, triggers=None):
+    '''
+    Writes a recording the way BrainFlowOpenBCIStreaming saves it: no header,
+    and only the last row of each read has the time of day, time.time() and
+    the trigger
+    '''
+    triggers = triggers or {}
+    with open(file_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        for sample in range(samples):
+            sample_time = START_TIME + sample / SAMPLING_RATE
+            row = [float(sample % 256)] + [float(sample % 7 - 3)] * (BOARD_COLUMNS - 3) + \
+                [sample_time, 0.0]
+            if sample % read_size == read_size - 1:
+                row.append(str(datetime.datetime.fromtimestamp(sample_time).time()))
+                row.append(sample_time + 0.01)
+                if sample in triggers:
+                    row.append(triggers[sample])
+            writer.writerow(row)
+
+
+def test_headerless_brainflow_recording(tmp_path):
+    os.makedirs(tmp_path / "eeg")
+    write_brainflow_recording(tmp_path / "eeg" / "eeg-01-01.csv",
+                              triggers={99: "START-01-01-11", 349: "STOP-01-01-11",
+                                        499: "START-01-01-12", 749: "STOP-01-01-12"})
+    reader = SessionReader(str(tmp_path))
+
+    columns = reader.columns("eeg")
+    assert columns[1:17] == EEG_CHANNELS
+    assert "trigger" not in columns
+    assert reader.stimuli("eeg") == ["11", "12"]
+
+    trial = reader.trial("eeg", "11")
+    assert trial.shape == (len(columns), 251)
+    assert trial[columns.index("package_num"), 0] == 99
+    assert trial[columns.index("Fp1"), 0] == 99 % 7 - 3
+
+    rows = reader.time_slice("eeg", START_TIME + 1, START_TIME + 2)
+    times = rows[columns.index("Unix Timestamp")]
+    assert len(times) == SAMPLING_RATE + 1
+    assert np.all((times >= START_TIME + 1) & (times <= START_TIME + 2))
+
+
+def test_trigger_column_only_has_markers(tmp_path):
+    os.makedirs(tmp_path / "shimmer")
+    with open(tmp_path / "shimmer" / "shimmer-01-01.csv", "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["type", "time stamp", "Acc_x", "Acc_y", "Acc_z",
+                         "GSR_ohm", "PPG_mv", "time", "trigger"])
+        for sample in range(10):
+            trigger = {2: "START-01-01-11", 3: "1.79e9", 7: "STOP-01-01-11"}.get(sample, "")
+            writer.writerow([0, sample, 1, 2, 3, 4, 5,
+                             "2026-10-18 10:00:0{0}.000000".format(sample), trigger])
+    reader = SessionReader(str(tmp_path))
+
+    assert reader.stimuli("shimmer") == ["11"]
+    assert reader.trial("shimmer", "11").shape[1] == 6
@@ -0,0 +1,118 @@
+import time
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from gi.repository import GLib
+
+# A list of (phase name, onset in seconds from the start of the timeline)
+Timeline = List[Tuple[str, float]]
+
+# GLib timers have millisecond resolution and can fire late. The timer is set
+# to fire this much earlier and the rest of the time is spent in a busy-wait.
+SPIN_MARGIN = 0.002
+
+
+class TrialScheduler():
+    '''
+    Runs the phases of a timeline at absolute deadlines on the monotonic clock.
+    All deadlines are computed from the start of the timeline, so a late phase
+    does not delay the next ones.
+
+    Attributes
+    ----------
+    records: List[Dict[str, Any]]
+        The planned and actual onset of each phase that has been run
+
+    Parameters
+    ----------
+    timeline: Timeline
+        A list of (phase name, onset in seconds from the start of the timeline)
+
+    spin_margin: float, default: 0.002
+        The time in seconds before each deadline that the scheduler busy-waits
+
+    recorder: EventRecorder, default: None
+        If it is set, onsets are recorded with it instead of logging, which
+        keeps formatting out of the time between the deadline and the callback
+
+    Example
+    -------
+    >>> scheduler = TrialScheduler([("fixation_cross", 0), ("stimuli", 3)])
+    >>> scheduler.start({"fixation_cross": show_fixation_cross,
+    ...                  "stimuli": show_stimuli})
+    '''
+    def __init__(self, timeline: Timeline, spin_margin: float = SPIN_MARGIN,
+                 recorder=None):
+        self._timeline = timeline
+        self._spin_margin = spin_margin
+        self._recorder = recorder
+        self._anchor: Optional[float] = None
+        # Pending GLib sources by phase name
+        self._sources: Dict[str, int] = {}
+        self.records: List[Dict] = []
+
+    def start(self, callbacks: Dict[str, Callable]) -> float:
+        '''
+        Schedules all phases of the timeline from now
+
+        Parameters
+        ----------
+        callbacks: Dict[str, Callable]
+            The function that should be called for each phase name
+
+        Returns
+        -------
+        anchor: float
+            The monotonic time that onsets are relative to
+        '''
+        self.cancel()
+        self._anchor = time.monotonic()
+        for phase, onset in self._timeline:
+            self._schedule(phase, self._anchor + onset, callbacks[phase])
+        return self._anchor
+
+    def mark(self, phase: str) -> float:
+        '''
+        Records the onset of a phase that is not driven by the timeline,
+        for example a phase that starts by closing a window
+
+        Returns
+        -------
+        onset: float
+            The monotonic time of the phase
+        '''
+        onset = time.monotonic()
+        self._record(phase, None, onset)
+        return onset
+
+    def cancel(self) -> None:
+        '''
+        Cancels the phases that have not been run yet
+        '''
+        for source in self._sources.values():
+            GLib.source_remove(source)
+        self._sources = {}
+
+    def _schedule(self, phase: str, deadline: float, callback: Callable) -> None:
+        delay = max(0, int((deadline - time.monotonic() - self._spin_margin) * 1000))
+        source = GLib.timeout_add(delay, self._fire, phase, deadline, callback,
+                                  priority=GLib.PRIORITY_HIGH)
+        self._sources[phase] = source
+
+    def _fire(self, phase: str, deadline: float, callback: Callable) -> bool:
+        while time.monotonic() < deadline:
+            pass
+        self._record(phase, deadline, time.monotonic())
+        self._sources.pop(phase, None)
+        callback()
+        return False
+
+    def _record(self, phase: str, planned: Optional[float], actual: float) -> None:
+        self.records.append({"phase": phase, "planned": planned, "actual": actual})
+        if self._recorder is not None:
+            self._recorder.record("phase", actual, phase=phase, planned=planned)
+        elif planned is None:
+            logging.info("Phase {0}: actual {1:.6f}".format(phase, actual))
+        else:
+            logging.info("Phase {0}: planned {1:.6f} actual {2:.6f} error {3:.3f} ms".format(
+                phase, planned, actual, (actual - planned) * 1000))
@@ -0,0 +1,153 @@
+'''
+Fixed-width binary encoding of trigger messages.
+
+Every message is 68 bytes in network byte order:
+
+    magic        2s   b"OT"
+    version      B    FORMAT_VERSION
+    type         B    see MESSAGE_TYPES
+    seq          I    sequence number
+    sender       I    ID of the sender, the same for all of its sockets
+    time fields  3d   meaning depends on the type, NaN for missing values
+    experiment   16s  UTF-8, zero padded
+    stimulus     16s  UTF-8, zero padded
+
+Decoding only unpacks numbers and strings, so unlike pickle, a datagram
+can not run code on the receiving machine.
+'''
+
+import math
+import struct
+from typing import Any, Dict, Optional
+
+MAGIC = b"OT"
+FORMAT_VERSION = 2
+
+MESSAGE_TYPES = {"START": 1,
+                 "STOP": 2,
+                 "TERMINATE": 3,
+                 "ACK": 4,
+                 "PING": 5,
+                 "PONG": 6}
+MESSAGE_NAMES = {code: name for name, code in MESSAGE_TYPES.items()}
+
+# The meaning of the three time fields for clock exchange messages.
+# For START, STOP and TERMINATE they are payload's timestamp and presentation_time.
+TIME_FIELDS = {"PING": ("t0", "offset", "rtt"),
+               "PONG": ("t0", "t1", "t2")}
+
+ID_SIZE = 16
+_STRUCT = struct.Struct("!2sBBIIddd{0}s{0}s".format(ID_SIZE))
+_pack = _STRUCT.pack
+_unpack = _STRUCT.unpack
+_NAN = math.nan
+MESSAGE_SIZE = _STRUCT.size
+
+
+class TriggerDecodeError(ValueError):
+    pass
+
+
+def _from_float(value: float) -> Optional[float]:
+    return None if math.isnan(value) else value
+
+
+def _encode_id(value: Any) -> bytes:
+    if value is None:
+        return b""
+    encoded = value.encode("utf-8") if isinstance(value, str) else str(value).encode("utf-8")
+    if len(encoded) > ID_SIZE:
+        raise ValueError("ID {0} is longer than {1} bytes".format(value, ID_SIZE))
+    return encoded
+
+
+def _decode_id(value: bytes) -> Optional[str]:
+    value = value.rstrip(b"\0")
+    if not value:
+        return None
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError as error:
+        raise TriggerDecodeError("Invalid ID: {0}".format(error))
+
+
+def encode(message: Dict[str, Any]) -> bytes:
+    '''
+    Encodes a trigger message dictionary
+
+    Parameters
+    ----------
+    message: Dict[str, Any]
+        A dictionary with `type`, `seq` and `sender` keys. Triggers can have `experiment_id`,
+        `stimulus_id` and `payload` with `timestamp` and `presentation_time`.
+        Clock exchange messages have the keys of TIME_FIELDS.
+
+    Returns
+    -------
+    data: bytes
+        MESSAGE_SIZE bytes
+    '''
+    message_type = message["type"]
+    type_code = MESSAGE_TYPES.get(message_type)
+    if type_code is None:
+        raise ValueError("Unknown message type {0}".format(message_type))
+    fields = TIME_FIELDS.get(message_type)
+    if fields is None:
+        payload = message.get("payload") or {}
+        time_0 = payload.get("timestamp")
+        time_1 = payload.get("presentation_time")
+        time_2 = None
+    else:
+        time_0, time_1, time_2 = [message.get(field) for field in fields]
+    return _pack(MAGIC, FORMAT_VERSION, type_code, message.get("seq", 0),
+                 message.get("sender", 0),
+                 _NAN if time_0 is None else time_0,
+                 _NAN if time_1 is None else time_1,
+                 _NAN if time_2 is None else time_2,
+                 _encode_id(message.get("experiment_id")),
+                 _encode_id(message.get("stimulus_id")))
+
+
+def decode(data: bytes) -> Dict[str, Any]:
+    '''
+    Decodes and checks a trigger message. This is safe to use on data from
+    the network.
+
+    Returns
+    -------
+    message: Dict[str, Any]
+        The same dictionary shape that `encode` takes
+
+    Raises
+    ------
+    TriggerDecodeError
+        If the data is not a valid message of the supported version
+    '''
+    if len(data) != MESSAGE_SIZE:
+        raise TriggerDecodeError("Expected {0} bytes, got {1}".format(MESSAGE_SIZE, len(data)))
+    magic, version, type_code, sequence, sender, time_0, time_1, time_2, \
+        experiment_id, stimulus_id = _unpack(data)
+    if magic != MAGIC:
+        raise TriggerDecodeError("Invalid magic {0!r}".format(magic))
+    if version != FORMAT_VERSION:
+        raise TriggerDecodeError("Unsupported version {0}".format(version))
+    message_type = MESSAGE_NAMES.get(type_code)
+    if message_type is None:
+        raise TriggerDecodeError("Unknown message type {0}".format(type_code))
+
+    message: Dict[str, Any] = {"type": message_type, "seq": sequence, "sender": sender}
+    fields = TIME_FIELDS.get(message_type)
+    if fields is not None:
+        message[fields[0]] = _from_float(time_0)
+        message[fields[1]] = _from_float(time_1)
+        message[fields[2]] = _from_float(time_2)
+    elif message_type != "ACK":
+        payload = {}
+        if time_0 == time_0:  # NaN is not equal to itself
+            payload["timestamp"] = time_0
+        if time_1 == time_1:
+            payload["presentation_time"] = time_1
+        message["experiment_id"] = _decode_id(experiment_id)
+        message["stimulus_id"] = _decode_id(stimulus_id)
+        message["payload"] = payload
+    return message
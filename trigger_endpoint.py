@@ -0,0 +1,300 @@
+import os
+import csv
+import time
+import socket
+import logging
+import threading
+import http.server
+import collections
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import msgpack
+from octopus_sensing.common.message import Message
+
+from trigger_codec import encode, decode
+
+# The maximum size of an HTTP trigger request body in bytes
+MAX_BODY_SIZE = 65536
+
+
+class HTTPTriggerEndpoint():
+    '''
+    Listens for trigger messages in HTTP POST requests and passes them to the
+    device coordinator. It replaces DeviceMessageHTTPEndpoint, which unpickles
+    request bodies that have no Accept header, so anyone on the network could
+    run code on the recording machine. Here bodies are only decoded as
+    msgpack (`Accept: application/msgpack`, as HTTPTriggerTransport sends),
+    and other requests are rejected.
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    device_coordinator: DeviceCoordinator
+        An instance of DeviceCoordinator class
+
+    port: int, default: 9331
+        TCP port to listen on
+
+    Example
+    -------
+    >>> trigger_endpoint = HTTPTriggerEndpoint(device_coordinator, port=9331)
+    >>> trigger_endpoint.start()
+    >>> # You need to stop it after your program finished.
+    >>> trigger_endpoint.stop()
+    '''
+    def __init__(self, device_coordinator, port: int = 9331):
+        self._device_coordinator = device_coordinator
+        # The socket is bound here, so requests can be sent as soon as it is made
+        self._server = http.server.ThreadingHTTPServer(("", port), self._make_handler())
+        self._thread: Optional[threading.Thread] = None
+
+    def get_port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> None:
+        '''
+        Starts listening in a background thread
+        '''
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="HTTPTriggerEndpoint-Thread",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        '''
+        Stops listening and closes the socket
+        '''
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+        self._server.server_close()
+
+    def _make_handler(self):
+        endpoint = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # Keeps the connection of HTTPTriggerTransport open between triggers
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, and with Nagle's algorithm
+            # the body would wait for the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                content_length = int(self.headers.get("Content-Length", "-1"))
+                if content_length < 0 or content_length > MAX_BODY_SIZE:
+                    self._reply(400, "Content-Length should be between 0 and {0}".format(
+                        MAX_BODY_SIZE))
+                    return
+                body = self.rfile.read(content_length)
+                if "msgpack" not in self.headers.get("Accept", ""):
+                    self._reply(415, "Only application/msgpack bodies are accepted")
+                    return
+                try:
+                    endpoint._dispatch(msgpack.unpackb(body))
+                except (ValueError, TypeError, KeyError, msgpack.UnpackException) as error:
+                    self._reply(400, "Invalid trigger: {0}".format(error))
+                    return
+                self._reply(200, "message dispatched")
+
+            def _reply(self, status: int, text: str) -> None:
+                body = msgpack.packb(text)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/msgpack")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _dispatch(self, request: Any) -> None:
+        if not isinstance(request, dict) or not isinstance(request.get('type'), str):
+            raise ValueError("The body should be a dictionary with a 'type' string")
+        for key in ('experiment_id', 'stimulus_id'):
+            if request.get(key) is not None and not isinstance(request[key], str):
+                raise ValueError("'{0}' should be a string".format(key))
+        payload = request.get('payload')
+        if payload is not None and not isinstance(payload, dict):
+            raise ValueError("'payload' should be a dictionary")
+        self._device_coordinator.dispatch(Message(request['type'], payload,
+                                                  request.get('experiment_id'),
+                                                  request.get('stimulus_id')))
+
+
+class UDPTriggerEndpoint():
+    '''
+    Listens for trigger messages in UDP datagrams and passes them to the
+    device coordinator. It is a lightweight alternative to HTTPTriggerEndpoint.
+    Each datagram has a sequence number and is acknowledged, so the sender
+    can re-send lost ones. Re-sent messages are acknowledged again but are
+    dispatched only once, also when the sender re-sends from a new socket. Datagrams are in the fixed-width format of
+    trigger_codec, which is decoded without running any code from the network.
+
+    It also answers the sender's clock exchanges (PING), and estimates the
+    clock offset from each PING when it arrives: the smallest one-way time
+    (t1 - t0) of the recent PINGs, minus half of the smallest round trip time
+    that the sender has measured. The estimate converts the sender timestamp
+    of each marker to this machine's clock, and is stored with the marker.
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    device_coordinator: DeviceCoordinator
+        An instance of DeviceCoordinator class
+
+    port: int, default: 9331
+        UDP port to listen on
+
+    output_path: str, default: None
+        If it is set, the clock offset series and the received markers will
+        be recorded in {output_path}/clock_offset.csv and {output_path}/markers.csv
+
+    clock_window: int, default: 8
+        The number of recent PINGs that the offset is estimated from
+
+    Example
+    -------
+    >>> trigger_endpoint = UDPTriggerEndpoint(device_coordinator, port=9331)
+    >>> trigger_endpoint.start()
+    >>> # You need to stop it after your program finished.
+    >>> trigger_endpoint.stop()
+    '''
+    def __init__(self, device_coordinator, port: int = 9331,
+                 output_path: Optional[str] = None, clock_window: int = 8):
+        self._device_coordinator = device_coordinator
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(("", port))
+        # The last dispatched sequence number by sender ID
+        self._last_sequences: Dict[int, int] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        # The sender's clock minus this machine's clock is -offset
+        self._clock_offset: Optional[float] = None
+        # t1 - t0 of recent PINGs
+        self._one_way_times: Deque[float] = collections.deque(maxlen=clock_window)
+
+        self._clock_file_path = None
+        self._markers_file_path = None
+        if output_path is not None:
+            os.makedirs(output_path, exist_ok=True)
+            self._clock_file_path = os.path.join(output_path, "clock_offset.csv")
+            self._markers_file_path = os.path.join(output_path, "markers.csv")
+            self._write_row(self._clock_file_path,
+                            ["receive_time", "unix_time", "offset", "rtt", "sender_offset"])
+            self._write_row(self._markers_file_path,
+                            ["type", "experiment_id", "stimulus_id", "sender_time",
+                             "corrected_time", "corrected_unix_time", "arrival_time",
+                             "clock_offset"])
+
+    def get_port(self) -> int:
+        return self._socket.getsockname()[1]
+
+    def start(self) -> None:
+        '''
+        Starts listening in a background thread
+        '''
+        self._thread = threading.Thread(target=self._listen,
+                                        name="UDPTriggerEndpoint-Thread",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        '''
+        Stops listening and closes the socket
+        '''
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._socket.close()
+
+    def _listen(self) -> None:
+        self._socket.settimeout(0.5)
+        while not self._stop_event.is_set():
+            try:
+                datagram, address = self._socket.recvfrom(65535)
+            except socket.timeout:
+                continue
+            arrival_time = time.monotonic()
+            try:
+                self._handle(decode(datagram), address, arrival_time)
+            except Exception as error:
+                logging.error("Invalid trigger datagram from {0}: {1}".format(address, error))
+
+    def _handle(self, request: Dict[str, Any], address: Tuple[str, int],
+                arrival_time: float) -> None:
+        sequence = request['seq']
+        if request['type'] == 'PING':
+            self._socket.sendto(encode({'type': 'PONG', 'seq': sequence,
+                                        't0': request['t0'], 't1': arrival_time,
+                                        't2': time.monotonic()}),
+                                address)
+            self._update_clock(arrival_time, request['t0'], request.get('rtt'),
+                               request.get('offset'))
+            return
+
+        self._socket.sendto(encode({'type': 'ACK', 'seq': sequence}), address)
+        sender = request['sender']
+        if sequence <= self._last_sequences.get(sender, 0):
+            return
+        self._last_sequences[sender] = sequence
+
+        payload = request.get('payload', None)
+        if isinstance(payload, dict):
+            payload = self._correct_timestamps(request, payload, arrival_time)
+        message = Message(request['type'],
+                          payload,
+                          request.get('experiment_id', None),
+                          request.get('stimulus_id', None))
+        self._device_coordinator.dispatch(message)
+
+    def _update_clock(self, receive_time: float, t0: float, rtt: Optional[float],
+                      sender_offset: Optional[float]) -> None:
+        self._one_way_times.append(receive_time - t0)
+        # Before the sender has a round trip time, the one-way delay is not removed
+        offset = min(self._one_way_times) - (rtt or 0) / 2
+        self._clock_offset = offset
+        if self._clock_file_path is not None:
+            self._write_row(self._clock_file_path,
+                            [receive_time, self._to_unix_time(receive_time), offset, rtt,
+                             sender_offset])
+
+    def _correct_timestamps(self, request: Dict[str, Any], payload: Dict[str, Any],
+                            arrival_time: float) -> Dict[str, Any]:
+        '''
+        Adds the sender times converted to this machine's clock to the payload.
+        Without a clock estimate the arrival time is used.
+        '''
+        payload = dict(payload)
+        sender_time = payload.get('presentation_time', payload.get('timestamp'))
+        if sender_time is None or self._clock_offset is None:
+            corrected_time = arrival_time
+        else:
+            corrected_time = sender_time + self._clock_offset
+        payload['corrected_time'] = corrected_time
+        payload['corrected_unix_time'] = self._to_unix_time(corrected_time)
+        payload['clock_offset'] = self._clock_offset
+
+        if self._markers_file_path is not None:
+            self._write_row(self._markers_file_path,
+                            [request['type'], request.get('experiment_id'),
+                             request.get('stimulus_id'), sender_time, corrected_time,
+                             payload['corrected_unix_time'], arrival_time,
+                             self._clock_offset])
+        return payload
+
+    @staticmethod
+    def _to_unix_time(monotonic_time: float) -> float:
+        # Recorded samples are stamped with time.time()
+        return time.time() - (time.monotonic() - monotonic_time)
+
+    @staticmethod
+    def _write_row(file_path: str, row: List[Any]) -> None:
+        with open(file_path, 'a') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(row)
@@ -0,0 +1,353 @@
+import time
+import queue
+import random
+import socket
+import logging
+import threading
+import collections
+import http.client
+import msgpack
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import trigger_codec
+
+
+class HTTPTriggerTransport():
+    '''
+    Sends trigger messages to an HTTPTriggerEndpoint over one persistent
+    HTTP connection
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    host: str
+        The address of endpoint, e.g. "172.24.16.32:9331"
+
+    timeout: float, default: 3
+        The timeout of each request in seconds
+    '''
+    def __init__(self, host: str, timeout: float = 3):
+        self._host = host
+        self._timeout = timeout
+        self._http_client: Optional[http.client.HTTPConnection] = None
+
+    def send(self, msg_dict: Dict[str, Any]) -> None:
+        '''
+        Sends a message and waits for the response. Raises an exception if
+        the message is not delivered.
+        '''
+        if self._http_client is None:
+            self._http_client = http.client.HTTPConnection(self._host, timeout=self._timeout)
+        self._http_client.request("POST", "/",
+                                  body=msgpack.packb(msg_dict),
+                                  headers={'Accept': 'application/msgpack'})
+        response = self._http_client.getresponse()
+        # The body should be read completely to reuse the connection
+        response.read()
+        if response.status != 200:
+            raise RuntimeError("Got HTTP status: {0} {1}".format(response.status,
+                                                                 response.reason))
+
+    def reset(self) -> None:
+        '''
+        Closes the connection. A new one will be made by the next send
+        '''
+        if self._http_client is not None:
+            self._http_client.close()
+        self._http_client = None
+
+    def close(self) -> None:
+        self.reset()
+
+
+class UDPTriggerTransport():
+    '''
+    Sends trigger messages to a UDPTriggerEndpoint in sequence-numbered
+    datagrams. Each datagram is re-sent until it is acknowledged.
+    Datagrams carry a random sender ID that stays the same when the socket
+    is re-made, and a message keeps its sequence number when it is sent
+    again, so the endpoint dispatches it only once.
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    host: str
+        The address of endpoint, e.g. "172.24.16.32:9331"
+
+    timeout: float, default: 3
+        The time in seconds to wait for the acknowledgement before giving up
+
+    resend_interval: float, default: 0.05
+        The time in seconds to wait for the acknowledgement before re-sending
+    '''
+    def __init__(self, host: str, timeout: float = 3, resend_interval: float = 0.05):
+        address, port = host.split(":")
+        self._address = (address, int(port))
+        self._timeout = timeout
+        self._resend_interval = resend_interval
+        self._sequence = 0
+        self._sender_id = random.getrandbits(32)
+        self._socket: Optional[socket.socket] = None
+
+    def send(self, msg_dict: Dict[str, Any]) -> None:
+        '''
+        Sends a message and waits for its acknowledgement. Raises an exception if
+        the message is not acknowledged. The sequence number is stored in
+        msg_dict, so sending the same dictionary again is a re-send.
+        '''
+        self._connect()
+        if 'seq' not in msg_dict:
+            msg_dict['seq'] = self._next_sequence()
+        sequence = msg_dict['seq']
+        datagram = trigger_codec.encode(dict(msg_dict, sender=self._sender_id))
+        deadline = time.monotonic() + self._timeout
+        while time.monotonic() < deadline:
+            self._socket.send(datagram)
+            if self._wait_for_reply('ACK', sequence) is not None:
+                return
+        raise TimeoutError("No acknowledgement for message {0}".format(sequence))
+
+    def ping(self, offset: Optional[float] = None,
+             rtt: Optional[float] = None) -> Tuple[float, float, float, float]:
+        '''
+        Does one NTP-style time exchange with the endpoint. The current clock
+        estimate is sent along, so the endpoint can record it.
+        A lost ping is not re-sent.
+
+        Returns
+        -------
+        times: Tuple[float, float, float, float]
+            (t0, t1, t2, t3): sending time of ping, receiving time on the endpoint,
+            sending time of reply on the endpoint and receiving time of reply
+        '''
+        self._connect()
+        sequence = self._next_sequence()
+        t0 = time.monotonic()
+        self._socket.send(trigger_codec.encode({'type': 'PING', 'seq': sequence,
+                                                'sender': self._sender_id,
+                                                't0': t0, 'offset': offset, 'rtt': rtt}))
+        reply = self._wait_for_reply('PONG', sequence)
+        t3 = time.monotonic()
+        if reply is None:
+            raise TimeoutError("No reply for ping {0}".format(sequence))
+        return t0, reply['t1'], reply['t2'], t3
+
+    def _connect(self) -> None:
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.connect(self._address)
+            self._socket.settimeout(self._resend_interval)
+
+    def _next_sequence(self) -> int:
+        self._sequence += 1
+        return self._sequence
+
+    def _wait_for_reply(self, reply_type: str, sequence: int) -> Optional[Dict[str, Any]]:
+        try:
+            while True:
+                try:
+                    reply = trigger_codec.decode(self._socket.recv(65535))
+                except trigger_codec.TriggerDecodeError as error:
+                    logging.error("Invalid reply from trigger endpoint: {0}".format(error))
+                    continue
+                # Replies to re-sent older messages are ignored
+                if reply.get('type') == reply_type and reply.get('seq') == sequence:
+                    return reply
+        except socket.timeout:
+            return None
+
+    def reset(self) -> None:
+        '''
+        Closes the socket. A new one will be made by the next send
+        '''
+        if self._socket is not None:
+            self._socket.close()
+        self._socket = None
+
+    def close(self) -> None:
+        self.reset()
+
+
+class ClockSync():
+    '''
+    Estimates the offset between this machine's monotonic clock and the
+    endpoint's monotonic clock from NTP-style time exchanges.
+    The estimate comes from the exchange with the smallest round trip time
+    among the recent ones, because it has the least queueing delay.
+
+    Attributes
+    ----------
+    offset: float
+        The endpoint's clock minus this machine's clock in seconds. None before the first exchange
+
+    rtt: float
+        The round trip time of the exchange that offset comes from, in seconds
+
+    Parameters
+    ----------
+    window: int, default: 8
+        The number of recent exchanges that are kept
+    '''
+    def __init__(self, window: int = 8):
+        self._samples: Deque[Tuple[float, float]] = collections.deque(maxlen=window)
+        self.offset: Optional[float] = None
+        self.rtt: Optional[float] = None
+
+    def add(self, t0: float, t1: float, t2: float, t3: float) -> None:
+        '''
+        Adds an exchange. See UDPTriggerTransport.ping for the meaning of times
+        '''
+        rtt = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        self._samples.append((rtt, offset))
+        self.rtt, self.offset = min(self._samples)
+
+
+def make_transport(transport_type: str, host: str):
+    '''
+    Creates a trigger transport
+
+    Parameters
+    ----------
+    transport_type: str
+        It can be "http" or "udp"
+
+    host: str
+        The address of endpoint, e.g. "172.24.16.32:9331"
+    '''
+    if transport_type == "http":
+        return HTTPTriggerTransport(host)
+    elif transport_type == "udp":
+        return UDPTriggerTransport(host)
+    raise ValueError("Unknown trigger transport {0}".format(transport_type))
+
+
+class TriggerSender(threading.Thread):
+    '''
+    Delivers trigger messages from a background thread, so the GTK thread
+    only puts messages in a queue and returns immediately.
+    Messages are delivered in order, and a failed message is re-sent with
+    exponential backoff until it is delivered (at-least-once delivery).
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    transport: HTTPTriggerTransport or UDPTriggerTransport
+        The transport that sends messages. It should have `send`, `reset` and `close` methods
+
+    max_queue_size: int, default: 100
+        The maximum number of messages waiting for delivery
+
+    initial_backoff: float, default: 0.05
+        The delay in seconds before the first re-try
+
+    max_backoff: float, default: 2
+        The maximum delay in seconds between re-tries
+
+    ping_interval: float, default: 1
+        The time in seconds between clock exchanges when there is no message to send.
+        Only transports that have a `ping` method (UDP) do clock exchanges
+
+    Example
+    -------
+    >>> sender = TriggerSender(HTTPTriggerTransport("127.0.0.1:9331"))
+    >>> sender.start()
+    >>> sender.send({'type': 'START', 'experiment_id': '01-01', 'stimulus_id': '11'})
+    >>> sender.stop()
+    '''
+    def __init__(self, transport, max_queue_size: int = 100,
+                 initial_backoff: float = 0.05, max_backoff: float = 2,
+                 ping_interval: float = 1):
+        super().__init__(name="TriggerSender", daemon=True)
+        self._transport = transport
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+        self._give_up = threading.Event()
+        self._stopping = threading.Event()
+        self._ping_interval = ping_interval
+        self.clock_sync = ClockSync()
+
+    def send(self, msg_dict: Dict[str, Any]) -> bool:
+        '''
+        Puts a message in the delivery queue. The enqueue time is added to
+        the message payload as `timestamp` (monotonic clock in seconds).
+
+        Returns
+        -------
+        queued: bool
+            False if the queue is full and the message is dropped
+        '''
+        payload = dict(msg_dict.get('payload') or {})
+        payload.setdefault('timestamp', time.monotonic())
+        message = dict(msg_dict, payload=payload)
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            logging.error("Trigger queue is full. Dropped {0}".format(message))
+            return False
+        return True
+
+    def run(self) -> None:
+        self._ping()
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                message = self._queue.get(timeout=self._ping_interval)
+            except queue.Empty:
+                self._ping()
+                continue
+            # None only wakes the thread up to stop
+            if message is not None:
+                self._deliver(message)
+        self._transport.close()
+
+    def stop(self, timeout: float = 10) -> None:
+        '''
+        Waits until all queued messages are delivered, then stops the thread.
+        Messages that are not delivered until the timeout will be dropped.
+        '''
+        self._stopping.set()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            # The thread stops after the queued messages without the wake-up
+            pass
+        self.join(timeout)
+        if self.is_alive():
+            self._give_up.set()
+            logging.error("Could not deliver {0} trigger messages in {1} seconds".format(
+                self._queue.qsize(), timeout))
+
+    def _ping(self) -> None:
+        if not hasattr(self._transport, "ping"):
+            return
+        try:
+            self.clock_sync.add(*self._transport.ping(self.clock_sync.offset,
+                                                      self.clock_sync.rtt))
+        except Exception as error:
+            logging.debug("Clock exchange failed: {0}".format(error))
+            self._transport.reset()
+
+    def _deliver(self, message: Dict[str, Any]) -> None:
+        backoff = self._initial_backoff
+        while not self._give_up.is_set():
+            try:
+                start = time.monotonic()
+                self._transport.send(message)
+                logging.info("Sent {0} trigger in {1:.3f} ms. Queued for {2:.3f} ms".format(
+                    message['type'], (time.monotonic() - start) * 1000,
+                    (start - message['payload']['timestamp']) * 1000))
+                return
+            except Exception as error:
+                logging.error("Sending {0} trigger failed. Re-trying in {1:.2f} s. Error: {2}".format(
+                    message['type'], backoff, error))
+                self._transport.reset()
+                self._give_up.wait(backoff)
+                backoff = min(backoff * 2, self._max_backoff)
+        logging.error("Gave up sending {0}".format(message))
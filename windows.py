@@ -12,9 +12,19 @@
 # You should have received a copy of the GNU General Public License along with Octopus Sensing.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import logging
+import time
+import collections
 from screeninfo import get_monitors
-from gi.repository import Gtk, GdkPixbuf, GLib, Gst
+from gi.repository import Gtk, Gdk, GdkPixbuf, GLib, Gst
 import gi
+from image_cache import PixbufCache, load_pixbuf
+from prepare_stimuli import find_asset, fit_image
+try:
+    from OpenGL import GL
+except ImportError:
+    # Only GLImageWindow needs PyOpenGL
+    GL = None
 gi.require_version('Gtk', '3.0')
 gi.require_version('Gst', '1.0')
 
@@ -24,6 +34,37 @@ Gst.init_check(None)
 
 
 FONT_STYLE = "<span font_desc='Tahoma 18'>{}</span>"
+# Present callbacks are called with the frame time if no paint comes in this many ms
+PRESENT_TIMEOUT_MS = 200
+
+
+def get_monitor_geometry(monitor_no):
+    '''
+    Returns the position and size of a monitor in the coordinates that GTK
+    windows use
+
+    Parameters
+    ----------
+    monitor_no: int
+        The ID of monitor. It can be 0, 1, ...
+
+    Returns
+    -------
+    geometry: Gdk.Rectangle
+        x, y, width and height of the monitor
+    '''
+    display = Gdk.Display.get_default()
+    monitor = display.get_monitor(monitor_no) if display is not None else None
+    if monitor is not None:
+        return monitor.get_geometry()
+    # Without a GDK display (e.g. before GTK is initialized) monitors are read from Xrandr
+    screen_monitor = get_monitors()[monitor_no]
+    geometry = Gdk.Rectangle()
+    geometry.x = screen_monitor.x
+    geometry.y = screen_monitor.y
+    geometry.width = screen_monitor.width
+    geometry.height = screen_monitor.height
+    return geometry
 
 class MessageButtonWindow(Gtk.Window):
     '''
@@ -105,29 +146,162 @@ class ImageWindow(Gtk.Window):
     
     monitor_no: int, default: 0
         The ID of monitor for displaying of image. It can be 0, 1, ...
+        The window is placed and made fullscreen on this monitor.
+
+    image_cache: PixbufCache, default: None
+        The cache of decoded images. Windows can share one cache.
+        If it is None, the window creates its own cache
 
     '''
-    def __init__(self, title, monitor_no=0):
+    def __init__(self, title, monitor_no=0, image_cache=None):
         Gtk.Window.__init__(self, title=title)
 
         self._image_box = Gtk.Box()
-        monitors = get_monitors()
-        self._image_width = monitors[monitor_no].width
-        self._image_height = monitors[monitor_no].height
-        self._image = Gtk.Image()
+        self._monitor_no = monitor_no
+        self._monitor_geometry = get_monitor_geometry(monitor_no)
+        self._image_width = self._monitor_geometry.width
+        self._image_height = self._monitor_geometry.height
+        if image_cache is None:
+            image_cache = PixbufCache()
+        self._image_cache = image_cache
+        self._swap_pending = False
+        self._present_callbacks = []
+        self._present_timeout_id = None
+        # Monotonic time in seconds that the last image reached the screen
+        self.presentation_time = None
+        self.connect("realize", self._on_realize)
+        self._image = self._create_image_widget()
         self._image_box.pack_start(self._image, False, False, 0)
         self.add(self._image_box)
         self.modal = True
-        self.fullscreen()
-    
+        self._place_on_monitor()
+
+    def _create_image_widget(self):
+        return Gtk.Image()
+
+    def _place_on_monitor(self):
+        '''
+        Moves the window to its monitor and makes it fullscreen there.
+        The position is set before the window is mapped, so window managers
+        that ignore fullscreen_on_monitor still open it on the right monitor.
+        '''
+        self.move(self._monitor_geometry.x, self._monitor_geometry.y)
+        screen = self.get_screen()
+        display = Gdk.Display.get_default()
+        if screen is not None and display is not None and \
+                self._monitor_no < display.get_n_monitors():
+            self.fullscreen_on_monitor(screen, self._monitor_no)
+        else:
+            self.fullscreen()
+
+    def preload(self, image_paths):
+        '''
+        Decodes and scales a list of images for this window's monitor
+        before they are needed
+
+        Parameters
+        ----------
+        image_paths: List[str]
+            The list of image paths in the order that they will be shown
+        '''
+        self._image_cache.preload(image_paths,
+                                  self._image_width,
+                                  self._image_height,
+                                  self._monitor_no)
+
+    def get_cache_key(self, image_path):
+        '''
+        Returns the key of an image in the image cache for this window's monitor
+        '''
+        return (image_path, self._image_width, self._image_height, self._monitor_no)
+
     def set_image(self, image_path):
-        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(
-            image_path, self._image_width, self._image_height, False)
+        pixbuf = self._image_cache.get(image_path,
+                                       self._image_width,
+                                       self._image_height,
+                                       self._monitor_no)
+        self.set_pixbuf(pixbuf)
+
+    def set_pixbuf(self, pixbuf):
+        '''
+        Shows an already decoded and scaled image
+
+        Parameters
+        ----------
+        pixbuf: GdkPixbuf.Pixbuf
+            The image in the size of this window's monitor
+        '''
         self._image.set_from_pixbuf(pixbuf)
+        self._swap_pending = True
         #self.set_screen(monitor_no)
         self._image_box.show()
         self._image.show()
 
+    def call_on_present(self, callback):
+        '''
+        Calls the callback when the last image set on the window is painted
+        and presented on the screen. If nothing is painted in
+        PRESENT_TIMEOUT_MS, it is called with the frame time instead
+
+        Parameters
+        ----------
+        callback: Callable[[float], Any]
+            It receives the presentation time in seconds on the monotonic
+            clock (the same clock as time.monotonic)
+        '''
+        if self.get_frame_clock() is None or not self.get_mapped():
+            # Nothing will be painted, so there is no frame to wait for
+            callback(time.monotonic())
+            return
+        self._present_callbacks.append(callback)
+        if self._present_timeout_id is None:
+            self._present_timeout_id = GLib.timeout_add(PRESENT_TIMEOUT_MS,
+                                                        self._on_present_timeout)
+
+    def _on_present_timeout(self):
+        self._present_timeout_id = None
+        self._swap_pending = False
+        frame_clock = self.get_frame_clock()
+        if frame_clock is None:
+            # The window is unrealized
+            presentation_time = time.monotonic()
+        else:
+            presentation_time = frame_clock.get_frame_time() / 1000000
+        logging.warning("Presentation was not confirmed in {0} ms. Using the frame time".format(
+            PRESENT_TIMEOUT_MS))
+        self._call_present_callbacks(presentation_time)
+        return GLib.SOURCE_REMOVE
+
+    def _call_present_callbacks(self, presentation_time):
+        callbacks = self._present_callbacks
+        self._present_callbacks = []
+        for callback in callbacks:
+            callback(presentation_time)
+
+    def _on_realize(self, *args):
+        self.get_frame_clock().connect("after-paint", self._on_after_paint)
+
+    def _on_after_paint(self, frame_clock):
+        if not self._swap_pending:
+            return
+        self._swap_pending = False
+        if self._present_timeout_id is not None:
+            GLib.source_remove(self._present_timeout_id)
+            self._present_timeout_id = None
+
+        # Frame clock times are in microseconds on the monotonic clock.
+        # The presentation time is only known if the compositor reports it,
+        # otherwise we use the predicted one or the frame time.
+        presentation_time = 0
+        timings = frame_clock.get_current_timings()
+        if timings is not None:
+            presentation_time = timings.get_presentation_time() or \
+                timings.get_predicted_presentation_time()
+        if not presentation_time:
+            presentation_time = frame_clock.get_frame_time()
+        self.presentation_time = presentation_time / 1000000
+        self._call_present_callbacks(self.presentation_time)
+
 
     def show_and_destroy_window(self, timeout):
         GLib.timeout_add_seconds(timeout, self.destroy)
@@ -135,3 +309,315 @@ class ImageWindow(Gtk.Window):
     
     def show_window(self):
         self.show()
+
+
+class GLImageWindow(ImageWindow):
+    '''
+    An ImageWindow that draws images with OpenGL. Each image is uploaded
+    to the GPU once, as a texture, and showing an image only changes the
+    texture that is drawn in the next frame, so there is no CPU copy of
+    the image on each swap. Frames are synchronized with the frame clock
+    (vsync), and presentation times are reported the same as ImageWindow.
+    It needs PyOpenGL and an OpenGL 3.2 context. It also runs with a
+    software renderer, e.g. Mesa llvmpipe under Xvfb.
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    The same as ImageWindow, and
+
+    max_textures: int, default: 64
+        The number of textures that are kept on the GPU. The least recently
+        shown ones are deleted first
+    '''
+    VERTEX_SHADER = """
+        #version 150
+        out vec2 uv;
+        void main() {
+            // A full screen triangle strip from the vertex IDs 0..3
+            vec2 position = vec2(float(gl_VertexID % 2), float(gl_VertexID / 2));
+            uv = vec2(position.x, 1.0 - position.y);
+            gl_Position = vec4(position * 2.0 - 1.0, 0.0, 1.0);
+        }
+    """
+    FRAGMENT_SHADER = """
+        #version 150
+        in vec2 uv;
+        out vec4 color;
+        uniform sampler2D image;
+        void main() {
+            color = texture(image, uv);
+        }
+    """
+
+    def __init__(self, title, monitor_no=0, image_cache=None, max_textures=64):
+        if GL is None:
+            raise RuntimeError("GLImageWindow needs PyOpenGL. Install it with pip install PyOpenGL")
+        # Textures by pixbuf. Pixbufs that are not uploaded yet are uploaded
+        # when the GL context is ready.
+        self._textures = collections.OrderedDict()
+        self._max_textures = max_textures
+        self._pending_uploads = []
+        self._current_pixbuf = None
+        self._program = None
+        self._vertex_array = None
+        super().__init__(title, monitor_no=monitor_no, image_cache=image_cache)
+
+    def _create_image_widget(self):
+        area = Gtk.GLArea()
+        area.set_required_version(3, 2)
+        area.set_auto_render(False)
+        area.set_size_request(self._image_width, self._image_height)
+        area.connect("realize", self._on_gl_realize)
+        area.connect("unrealize", self._on_gl_unrealize)
+        area.connect("render", self._on_render)
+        return area
+
+    def preload(self, image_paths):
+        '''
+        Decodes, scales and uploads a list of images before they are needed
+        '''
+        super().preload(image_paths)
+        for image_path in image_paths:
+            key = self.get_cache_key(image_path)
+            if self._image_cache.contains(key):
+                self._queue_upload(self._image_cache.get(*key))
+        self._upload_pending()
+
+    def set_pixbuf(self, pixbuf):
+        self._queue_upload(pixbuf)
+        self._current_pixbuf = pixbuf
+        self._swap_pending = True
+        # The GL area is realized, and renders, only when it is shown
+        self._image_box.show()
+        self._image.show()
+        self._image.queue_render()
+
+    def _queue_upload(self, pixbuf):
+        if pixbuf not in self._textures and pixbuf not in self._pending_uploads:
+            self._pending_uploads.append(pixbuf)
+
+    def _upload_pending(self):
+        if not self._image.get_realized():
+            return
+        self._image.make_current()
+        if self._image.get_error() is not None:
+            return
+        for pixbuf in self._pending_uploads:
+            self._textures[pixbuf] = self._upload(pixbuf)
+        self._pending_uploads = []
+        while len(self._textures) > self._max_textures:
+            old_pixbuf, texture = self._textures.popitem(last=False)
+            if old_pixbuf is self._current_pixbuf:
+                self._textures[old_pixbuf] = texture
+                continue
+            GL.glDeleteTextures([texture])
+
+    @staticmethod
+    def _pixel_data(pixbuf):
+        '''
+        Returns the pixels of a pixbuf in rows of 4-byte aligned length,
+        which is GL's default unpack alignment
+        '''
+        row_size = pixbuf.get_width() * pixbuf.get_n_channels()
+        aligned_row_size = (row_size + 3) // 4 * 4
+        rowstride = pixbuf.get_rowstride()
+        height = pixbuf.get_height()
+        data = pixbuf.read_pixel_bytes().get_data()
+        if rowstride == aligned_row_size:
+            # The last row of a pixbuf is not padded
+            return data + bytes(rowstride * height - len(data))
+        padding = bytes(aligned_row_size - row_size)
+        return b"".join(data[row * rowstride:row * rowstride + row_size] + padding
+                        for row in range(height))
+
+    @staticmethod
+    def _upload(pixbuf):
+        pixel_format = GL.GL_RGBA if pixbuf.get_has_alpha() else GL.GL_RGB
+        texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 4)
+        GL.glPixelStorei(GL.GL_UNPACK_ROW_LENGTH, 0)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, pixel_format,
+                        pixbuf.get_width(), pixbuf.get_height(), 0,
+                        pixel_format, GL.GL_UNSIGNED_BYTE,
+                        GLImageWindow._pixel_data(pixbuf))
+        return texture
+
+    def _on_gl_realize(self, area):
+        area.make_current()
+        if area.get_error() is not None:
+            logging.error("Could not create an OpenGL context: {0}".format(area.get_error()))
+            return
+        self._program = GL.glCreateProgram()
+        for shader_type, source in ((GL.GL_VERTEX_SHADER, self.VERTEX_SHADER),
+                                    (GL.GL_FRAGMENT_SHADER, self.FRAGMENT_SHADER)):
+            shader = GL.glCreateShader(shader_type)
+            GL.glShaderSource(shader, source)
+            GL.glCompileShader(shader)
+            if not GL.glGetShaderiv(shader, GL.GL_COMPILE_STATUS):
+                raise RuntimeError(GL.glGetShaderInfoLog(shader))
+            GL.glAttachShader(self._program, shader)
+            GL.glDeleteShader(shader)
+        GL.glLinkProgram(self._program)
+        if not GL.glGetProgramiv(self._program, GL.GL_LINK_STATUS):
+            raise RuntimeError(GL.glGetProgramInfoLog(self._program))
+        # Core profile needs a vertex array even without vertex buffers
+        self._vertex_array = GL.glGenVertexArrays(1)
+        self._upload_pending()
+
+    def _on_gl_unrealize(self, area):
+        area.make_current()
+        if area.get_error() is not None:
+            return
+        if self._textures:
+            GL.glDeleteTextures(list(self._textures.values()))
+        # Textures are uploaded again if the window is realized again
+        self._pending_uploads = list(self._textures) + self._pending_uploads
+        self._textures = collections.OrderedDict()
+        if self._program is not None:
+            GL.glDeleteProgram(self._program)
+            GL.glDeleteVertexArrays(1, [self._vertex_array])
+        self._program = None
+
+    def _on_render(self, area, context):
+        self._upload_pending()
+        GL.glClearColor(0, 0, 0, 1)
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT)
+        texture = self._textures.get(self._current_pixbuf)
+        if self._program is None or texture is None:
+            return True
+        self._textures.move_to_end(self._current_pixbuf)
+        GL.glUseProgram(self._program)
+        GL.glActiveTexture(GL.GL_TEXTURE0)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+        GL.glBindVertexArray(self._vertex_array)
+        GL.glDrawArrays(GL.GL_TRIANGLE_STRIP, 0, 4)
+        return True
+
+
+IMAGE_WINDOW_BACKENDS = {"pixbuf": ImageWindow,
+                         "gl": GLImageWindow}
+
+
+def make_image_window(title, monitor_no=0, image_cache=None, backend="pixbuf"):
+    '''
+    Creates an image window with a rendering backend
+
+    Parameters
+    ----------
+    backend: str, default: "pixbuf"
+        "pixbuf" shows images in a Gtk.Image, and "gl" draws them with OpenGL.
+        See ImageWindow and GLImageWindow for the other parameters
+    '''
+    return IMAGE_WINDOW_BACKENDS[backend](title, monitor_no=monitor_no,
+                                          image_cache=image_cache)
+
+
+class ImagePresenter():
+    '''
+    Shows the same image on several ImageWindows at once.
+    Each image is decoded once and scaled once for each distinct monitor
+    resolution, then it is swapped on all windows in the same main-loop iteration.
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    windows: List[ImageWindow]
+        The windows that show the image
+
+    image_cache: PixbufCache
+        The image cache that is shared by windows
+    '''
+    def __init__(self, windows, image_cache):
+        self._windows = windows
+        self._image_cache = image_cache
+
+    def preload(self, image_paths):
+        '''
+        Decodes and scales a list of images for all windows before they are needed
+
+        Parameters
+        ----------
+        image_paths: List[str]
+            The list of image paths in the order that they will be shown
+        '''
+        loaded = []
+        for image_path in image_paths:
+            keys = [window.get_cache_key(image_path) for window in self._windows]
+            missing = [key for key in keys if not self._image_cache.contains(key)]
+            if any(self._image_cache.is_full(key[1], key[2]) for key in missing):
+                logging.warning(
+                    "Image cache is full. {0} and the rest of images will be "
+                    "loaded on demand".format(image_path))
+                break
+            self._load(image_path)
+            loaded.append(image_path)
+        # Images are in the cache now. Windows with textures upload them.
+        for window in self._windows:
+            window.preload(loaded)
+
+    def set_image(self, image_path):
+        '''
+        Shows an image on all windows
+
+        Parameters
+        ----------
+        image_path: str
+            The path of image
+        '''
+        pixbufs = self._load(image_path)
+        swap_times = []
+        for window in self._windows:
+            window.set_pixbuf(pixbufs[window.get_cache_key(image_path)])
+            swap_times.append(time.perf_counter())
+        skew = (swap_times[-1] - swap_times[0]) * 1000
+        logging.info("Image {0} swapped on {1} windows. Skew: {2:.3f} ms".format(
+            image_path, len(self._windows), skew))
+
+        presentation_times = []
+
+        def on_present(presentation_time):
+            presentation_times.append(presentation_time)
+            if len(presentation_times) == len(self._windows):
+                logging.info("Image {0} presented on {1} windows. Skew: {2:.3f} ms".format(
+                    image_path, len(self._windows),
+                    (max(presentation_times) - min(presentation_times)) * 1000))
+
+        for window in self._windows:
+            window.call_on_present(on_present)
+
+    def _load(self, image_path):
+        '''
+        Returns a dictionary of cache key: pixbuf for all windows
+        '''
+        pixbufs = {}
+        scaled = {}
+        source = None
+        for window in self._windows:
+            key = window.get_cache_key(image_path)
+            size = (key[1], key[2])
+            if self._image_cache.contains(key):
+                pixbufs[key] = self._image_cache.get(*key)
+            elif size in scaled:
+                pixbufs[key] = scaled[size]
+                self._image_cache.put(key, scaled[size])
+            elif find_asset(image_path, size[0], size[1]) is not None:
+                pixbufs[key] = load_pixbuf(image_path, size[0], size[1])
+                self._image_cache.put(key, pixbufs[key])
+            else:
+                if source is None:
+                    source = GdkPixbuf.Pixbuf.new_from_file(image_path)
+                pixbuf = fit_image(source, size[0], size[1])
+                pixbufs[key] = pixbuf
+                self._image_cache.put(key, pixbuf)
+            scaled[size] = pixbufs[key]
+        return pixbufs